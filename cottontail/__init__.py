@@ -1,7 +1,58 @@
+"""
+Messaging patterns over RabbitMQ.
+
+The client classes are imported from their submodules on first access, so 'import cottontail'
+does not import pika or any submodule until one is used.
+"""
+import importlib
+import sys
+import types
+
 __version__ = '0.0.1'
 
-from cottontail.base import EXCHANGE_FANOUT, EXCHANGE_DIRECT, EXCHANGE_HEADERS, EXCHANGE_TOPIC
-from cottontail.queue import QueueWorker, QueueServer
-from cottontail.pubsub import Publisher, Subscriber
-from cottontail.topic import TopicPublisher, TopicSubscriber
-from cottontail.rpc import RPCServer, RPCClient
\ No newline at end of file
+# The submodule defining each public name
+_EXPORTS = {
+    'EXCHANGE_FANOUT': 'base',
+    'EXCHANGE_DIRECT': 'base',
+    'EXCHANGE_HEADERS': 'base',
+    'EXCHANGE_TOPIC': 'base',
+    'QueueWorker': 'queue',
+    'QueueServer': 'queue',
+    'Publisher': 'pubsub',
+    'Subscriber': 'pubsub',
+    'TopicPublisher': 'topic',
+    'TopicSubscriber': 'topic',
+    'HeadersPublisher': 'headers',
+    'HeadersSubscriber': 'headers',
+    'MATCH_ALL': 'headers',
+    'MATCH_ANY': 'headers',
+    'RPCServer': 'rpc',
+    'RPCClient': 'rpc',
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+class _LazyModule(types.ModuleType):
+    """
+    The cottontail package, importing each public name from its submodule when it is first accessed.
+    """
+    # Python 2 clears the globals of a module once it is no longer referenced
+    _module = sys.modules[__name__]
+
+    def __getattr__(self, name):
+        if name not in _EXPORTS:
+            raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
+        value = getattr(importlib.import_module('{}.{}'.format(__name__, _EXPORTS[name])), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_EXPORTS))
+
+
+_package = _LazyModule(__name__, __doc__)
+for _name in ('__file__', '__path__', '__package__', '__version__', '__all__'):
+    setattr(_package, _name, globals()[_name])
+sys.modules[__name__] = _package
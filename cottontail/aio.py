@@ -0,0 +1,927 @@
+"""
+Asyncio implementations of the Cottontail messaging patterns.
+
+Each class here mirrors its blocking counterpart, but runs on a non-blocking pika
+connection driven by an asyncio event loop. Broker round-trips return futures
+instead of blocking. Many clients, consumers and RPC calls can therefore share
+one thread.
+
+On Python 2 this needs trollius, installed with the 'asyncio' extra::
+
+    pip install cottontail[asyncio]
+
+Example::
+
+    worker = AsyncQueueWorker('queue')
+    yield From(worker.connect())            # or: await worker.connect()
+    messages = yield From(worker.subscribe('queue_test'))
+    async for message in messages:
+        handle(message.body)
+        worker.acknowledge(message.delivery_tag)
+"""
+import collections
+import uuid
+
+import pika
+from pika.adapters import base_connection
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+try:
+    StopAsyncIteration
+except NameError:
+    StopAsyncIteration = StopIteration
+
+import errors
+import utils
+from base import CottontailBase, EXCHANGE_TYPES, Message, queue_arguments
+from confirms import PublishBatch, DEFAULT_WINDOW
+from connection import connect_async
+from pubsub import Publisher, Subscriber
+from queue import QueueServer, QueueWorker
+from rpc import RPCServer, RPCClient
+from topic import TopicPublisher, TopicSubscriber
+
+
+def _create_future(loop):
+    """
+    Create a future bound to 'loop'.
+    """
+    if hasattr(loop, 'create_future'):
+        return loop.create_future()
+    return asyncio.Future(loop=loop)
+
+
+def _resolved(loop, result=None):
+    """
+    Create a future bound to 'loop' that already holds 'result'.
+    """
+    future = _create_future(loop)
+    future.set_result(result)
+    return future
+
+
+def _resolve_with_frame(future):
+    """
+    Build a pika callback that resolves 'future' with the frame it is invoked with.
+    """
+    def callback(frame=None):
+        if not future.done():
+            future.set_result(frame)
+    return callback
+
+
+def _then(loop, result, callback):
+    """
+    Chain 'callback' after 'result', which may be a future or a plain value from a no-op override.
+
+    Returns:
+        asyncio.Future: Resolves with the return value of 'callback', flattening returned futures
+    """
+    chained = _create_future(loop)
+
+    def run(value):
+        try:
+            outcome = callback(value)
+        except Exception as e:
+            chained.set_exception(e)
+            return
+        if isinstance(outcome, asyncio.Future):
+            outcome.add_done_callback(lambda f: _copy_future(f, chained))
+        else:
+            chained.set_result(outcome)
+
+    if isinstance(result, asyncio.Future):
+        def on_done(future):
+            if future.cancelled():
+                chained.cancel()
+            elif future.exception() is not None:
+                chained.set_exception(future.exception())
+            else:
+                run(future.result())
+        result.add_done_callback(on_done)
+    else:
+        run(result)
+
+    return chained
+
+
+def _create_channel_with_qos(client):
+    """
+    Open a channel for 'client' and apply its prefetch_count and prefetch_size before it is used.
+
+    Returns:
+        asyncio.Future: Resolves with the opened pika.channel.Channel
+    """
+    def set_qos(channel):
+        future = _create_future(client.loop)
+        channel.basic_qos(_resolve_with_frame(future), prefetch_size=client.prefetch_size,
+                          prefetch_count=client.prefetch_count)
+        return _then(client.loop, future, lambda _: channel)
+
+    return _then(client.loop, AsyncCottontailBase._create_channel(client), set_qos)
+
+
+def _copy_future(source, destination):
+    """
+    Copy the outcome of the 'source' future onto the 'destination' future.
+    """
+    if destination.done():
+        return
+    if source.cancelled():
+        destination.cancel()
+    elif source.exception() is not None:
+        destination.set_exception(source.exception())
+    else:
+        destination.set_result(source.result())
+
+
+class _IOLoopAdapter(object):
+    """
+    Presents an asyncio event loop through the IOLoop interface that pika's connection adapters expect.
+
+    Args:
+        loop (asyncio.AbstractEventLoop): The event loop to drive the connection with
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._handlers = {}
+
+    def add_handler(self, fd, handler, events):
+        self._handlers[fd] = handler
+        self.update_handler(fd, events)
+
+    def update_handler(self, fd, events):
+        handler = self._handlers[fd]
+
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+        if events & base_connection.BaseConnection.READ:
+            self.loop.add_reader(fd, handler, fd, base_connection.BaseConnection.READ)
+        if events & base_connection.BaseConnection.WRITE:
+            self.loop.add_writer(fd, handler, fd, base_connection.BaseConnection.WRITE)
+
+    def remove_handler(self, fd):
+        self._handlers.pop(fd, None)
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+
+    def add_timeout(self, deadline, callback_method):
+        return self.loop.call_later(deadline, callback_method)
+
+    def remove_timeout(self, timeout_id):
+        timeout_id.cancel()
+
+    def start(self):
+        """
+        The event loop is owned by the application, which is responsible for running it.
+        """
+        pass
+
+    def stop(self):
+        pass
+
+
+class AsyncioConnection(base_connection.BaseConnection):
+    """
+    A pika connection adapter that runs on an asyncio event loop.
+
+    Args:
+        parameters (pika.connection.Parameters, optional): Connection parameters
+        on_open_callback (callable, optional): Called with the connection once it is open
+        on_open_error_callback (callable, optional): Called with the connection and error if it can't be opened
+        on_close_callback (callable, optional): Called with the connection, reply code and reply text on close
+        loop (asyncio.AbstractEventLoop, optional): The event loop to use, defaults to the current event loop
+    """
+
+    def __init__(self, parameters=None, on_open_callback=None, on_open_error_callback=None,
+                 on_close_callback=None, loop=None):
+        self.ioloop = _IOLoopAdapter(loop or asyncio.get_event_loop())
+        super(AsyncioConnection, self).__init__(parameters,
+                                                on_open_callback,
+                                                on_open_error_callback,
+                                                on_close_callback,
+                                                self.ioloop,
+                                                False)
+
+    def _adapter_connect(self):
+        error = super(AsyncioConnection, self)._adapter_connect()
+        if not error:
+            self.ioloop.add_handler(self.socket.fileno(), self._handle_events, self.event_state)
+        return error
+
+    def _adapter_disconnect(self):
+        if self.socket:
+            self.ioloop.remove_handler(self.socket.fileno())
+        super(AsyncioConnection, self)._adapter_disconnect()
+
+
+class MessageIterator(object):
+    """
+    An asynchronous iterator over the messages delivered to one consumer.
+
+    Supports 'async for', or awaiting 'get()' directly where that syntax is unavailable.
+
+    Args:
+        loop (asyncio.AbstractEventLoop): The event loop the consumer runs on
+        queue (str): The name of the queue being consumed
+        consumer_tag (str): The consumer tag assigned by pika
+    """
+
+    def __init__(self, loop, queue, consumer_tag):
+        self.loop = loop
+        self.queue = queue
+        self.consumer_tag = consumer_tag
+        self._messages = collections.deque()
+        self._waiters = collections.deque()
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.get(StopAsyncIteration)
+
+    def get(self, stop_exception=StopIteration):
+        """
+        Wait for the next message.
+
+        Returns:
+            asyncio.Future: Resolves with the next Message, or fails with 'stop_exception' once closed
+        """
+        future = _create_future(self.loop)
+        if self._messages:
+            future.set_result(self._messages.popleft())
+        elif self._closed:
+            future.set_exception(stop_exception())
+        else:
+            self._waiters.append((future, stop_exception))
+        return future
+
+    def put(self, message):
+        while self._waiters:
+            future, _ = self._waiters.popleft()
+            if not future.done():
+                future.set_result(message)
+                return
+        self._messages.append(message)
+
+    def close(self):
+        """
+        Stop iteration once the already delivered messages have been consumed.
+        """
+        self._closed = True
+        while self._waiters:
+            future, stop_exception = self._waiters.popleft()
+            if not future.done():
+                future.set_exception(stop_exception())
+
+
+class AsyncCottontailBase(CottontailBase):
+    """
+    A service base class for implementing messaging patterns on an asyncio event loop.
+
+    Construction does not touch the network. Await 'connect()', or use the client as an
+    'async with' context manager, before publishing or subscribing.
+
+    Args:
+        exchange_name (str, optional): Name of the message exchange to create, defaults to ''.
+        hostname (str, optional): Hostname for this client, defaults to 'localhost'.
+        port (int, optional): Numeric port for this client, defaults to '5672'.
+        logger (module, optional): The logging module to use with this Client instance, default is 'utils.logger'.
+        loop (asyncio.AbstractEventLoop, optional): The event loop to run on, defaults to the current event loop.
+        **kw: Further options of CottontailBase, such as 'codec', 'compression' or 'retry'.
+    """
+
+    def __init__(self, exchange_name='', hostname='localhost', port=5672, logger=utils.logger, loop=None, **kw):
+        self.loop = loop or asyncio.get_event_loop()
+        self._closed = None
+        self._consumers = {}
+
+        # Connecting is left to 'connect', on the event loop
+        kw['lazy'] = True
+        super(AsyncCottontailBase, self).__init__(exchange_name, hostname, port, logger, **kw)
+
+    def __aenter__(self):
+        return self.connect()
+
+    def __aexit__(self, exc_type, exc_value, traceback):
+        return self.close_connection()
+
+    def connect(self):
+        """
+        Open the connection and channel, and declare the exchange.
+
+        Returns:
+            asyncio.Future: Resolves with this client once it is ready for use
+        """
+        ready = _create_future(self.loop)
+        self._closed = _create_future(self.loop)
+
+        def on_open(connection):
+            declared = _then(self.loop, self._create_channel(), self._on_channel_open)
+            declared.add_done_callback(lambda f: _copy_future(f, ready))
+
+        def on_open_error(connection, error=None):
+            if not ready.done():
+                ready.set_exception(errors.CottontailError(
+                    "Could not connect to {}:{}: {}".format(self._parameters.host, self._parameters.port, error),
+                    errors.UNKNOWN
+                ))
+
+        self.logger.info("Setting up an asyncio pika connection on %s:%s", self._parameters.host, self._parameters.port)
+        self._connection = connect_async(
+            self._parameters,
+            self.loop,
+            on_open_callback=on_open,
+            on_open_error_callback=on_open_error,
+            on_close_callback=self._on_connection_closed,
+        )
+
+        return ready
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        self._channel.add_on_close_callback(self._on_channel_closed)
+        return _then(self.loop, self._declare_exchange(self.exchange_name), lambda _: self)
+
+    def _create_channel(self):
+        """
+        Open a new channel on the connection
+
+        Returns:
+            asyncio.Future: Resolves with the opened pika.channel.Channel
+        """
+        self.logger.info("Setting up a new channel on the connection")
+        future = _create_future(self.loop)
+        self._connection.channel(on_open_callback=_resolve_with_frame(future))
+        return future
+
+    def _declare_exchange(self, exchange_name):
+        """
+        Setup the exchange on RabbitMQ
+
+        Returns:
+            asyncio.Future: Resolves with the Exchange.DeclareOk frame
+
+        Raises:
+            CottontailError: If exchange_type is not in the valid EXCHANGE_TYPES.
+        """
+        if self.exchange_type not in EXCHANGE_TYPES:
+            raise errors.CottontailError("'{}' is not a valid exchange type".format(self.exchange_type), errors.INVALID)
+
+        self.exchange_name = exchange_name
+        self.exchange = (self.exchange_name, self.exchange_type)
+
+        self.logger.info("Declaring exchange '%s' of type '%s' on channel '%s'",
+                         exchange_name, self.exchange_type, self._channel)
+
+        if not self.exchange_name:
+            self.logger.warn("Using the default exchange ('') makes subscription unavailable")
+
+        future = _create_future(self.loop)
+        self._channel.exchange_declare(
+            _resolve_with_frame(future),
+            exchange=self.exchange_name,
+            exchange_type=self.exchange_type
+        )
+        return future
+
+    def declare_queue(self, name, durable=True, exclusive=False, arguments=None, max_priority=None,
+                      message_ttl=None, max_length=None, lazy_queue=False):
+        """
+        Args:
+            name (string): Name of the queue to declare
+            durable (bool, optional): Survive reboots of the broker, defaults to True.
+            exclusive (bool, optional): Only allow access by the current connection, defaults to False.
+            arguments (dict, optional): Optional queue arguments, defaults to None.
+            max_priority (int, optional): Highest message priority the queue orders messages by, defaults to None.
+            message_ttl (int, optional): Milliseconds after which messages expire, defaults to None.
+            max_length (int, optional): Most messages held, defaults to None for no limit.
+            lazy_queue (bool, optional): Keep messages on disk rather than in memory, default is False.
+
+        Returns:
+            asyncio.Future: Resolves with the name of the successfully declared queue
+        """
+        params = {
+            'durable': durable,
+            'exclusive': exclusive,
+        }
+        if name:
+            params['queue'] = name
+        arguments = queue_arguments(arguments, max_priority, message_ttl, max_length, lazy_queue)
+        if arguments:
+            params['arguments'] = arguments
+
+        self.logger.info("Declaring queue '%s' on channel '%s'", name, self._channel)
+        future = _create_future(self.loop)
+        self._channel.queue_declare(_resolve_with_frame(future), **params)
+        return _then(self.loop, future, lambda frame: frame.method.queue)
+
+    def delete_queue(self, name):
+        """
+        Args:
+            name (string): Name of the queue to delete
+
+        Returns:
+            asyncio.Future: Resolves with the Queue.DeleteOk frame
+
+        Raises:
+            TypeError: If 'name' is not a string
+        """
+        if not isinstance(name, basestring):
+            raise TypeError("You must specify a queue's 'name' as a string.")
+
+        self.logger.info("Deleting queue '%s' on channel '%s'", name, self._channel)
+        future = _create_future(self.loop)
+        self._channel.queue_delete(_resolve_with_frame(future), queue=name)
+        return future
+
+    def _bind_to_queue(self, queue, topic):
+        """
+        Returns:
+            asyncio.Future: Resolves with the Queue.BindOk frame
+        """
+        self.logger.info("Binding to queue: '%s' on exchange: '%s'. Looking for messages of topic: '%s'",
+                         queue, self.exchange_name, topic)
+        future = _create_future(self.loop)
+        self._channel.queue_bind(_resolve_with_frame(future), queue, self.exchange_name, routing_key=topic)
+        return future
+
+    def subscribe(self, queue_name=None, topic=None, acknowledge=True, exclusive=False):
+        """
+        Subscribe to the messages of a particular queue
+
+        Messages are not acknowledged automatically; call 'acknowledge' with each
+        message's delivery tag once it has been handled.
+
+        Args:
+            queue_name (basestring, optional): The name of the queue to subscribe to, defaults to None.
+            topic (basestring, optional): The topic or key to filter messages by, defaults to None.
+            acknowledge (bool, optional): Whether the broker should expect an 'ack' for each message, default is True.
+            exclusive (bool, optional): Declare the queue as exclusive to this connection, default is False.
+
+        Returns:
+            asyncio.Future: Resolves with a MessageIterator over the delivered messages
+        """
+        def bind(queue):
+            return _then(self.loop, self._bind_to_queue(queue, topic), lambda _: declare_retry_queues(queue))
+
+        def declare_retry_queues(queue):
+            if self.retry is None:
+                return consume(queue, False)
+            return _then(self.loop, self._declare_retry_queues(queue), lambda retried: consume(queue, retried))
+
+        def consume(queue, retried):
+            consumer_tag = self._channel.basic_consume(self._handle_delivery, queue=queue, no_ack=not acknowledge)
+            if not acknowledge:
+                self._no_ack_consumers.add(consumer_tag)
+            if retried:
+                self._retry_queues[consumer_tag] = queue
+            self._consumers[consumer_tag] = MessageIterator(self.loop, queue, consumer_tag)
+            return self._consumers[consumer_tag]
+
+        return _then(self.loop, self._declare_subscribed_queue(queue_name, exclusive), bind)
+
+    def _declare_retry_queues(self, queue):
+        """
+        Returns:
+            asyncio.Future: Resolves with True once the delay queues and the dead letter queue are declared, or
+                with False if failed deliveries from the queue are requeued rather than retried
+        """
+        if queue.startswith('amq.'):
+            self.logger.warn("Failed deliveries from server-named queue '%s' are requeued, not retried", queue)
+            return _resolved(self.loop, False)
+
+        declared = [self.declare_queue(name, arguments=arguments) for name, arguments in self.retry.delay_queues(queue)]
+        if self.retry.dead_letter:
+            declared.append(self.declare_queue(self.retry.dead_letter_queue(queue)))
+        return _then(self.loop, asyncio.gather(*declared, loop=self.loop), lambda _: True)
+
+    def unsubscribe(self, messages):
+        """
+        Cancel a consumer and end iteration over its messages
+
+        Args:
+            messages (MessageIterator): The iterator returned by 'subscribe'
+
+        Returns:
+            asyncio.Future: Resolves with the Basic.CancelOk frame
+        """
+        future = _create_future(self.loop)
+        self._channel.basic_cancel(_resolve_with_frame(future), consumer_tag=messages.consumer_tag)
+        self._consumers.pop(messages.consumer_tag, None)
+        messages.close()
+        return future
+
+    def listen(self):
+        """
+        Wait while deliveries are processed by the running event loop
+
+        Returns:
+            asyncio.Future: Resolves with True once the connection has closed
+
+        Raises:
+            CottontailError: If the client has not connected
+        """
+        if self._closed is None:
+            raise errors.CottontailError("Connect the client before listening", errors.INVALID)
+        return self._closed
+
+    def _ensure_open(self):
+        """
+        Not used on an event loop: clients are connected explicitly with 'connect'.
+        """
+        pass
+
+    def batch(self, window=DEFAULT_WINDOW):
+        """
+        Start a batch of messages published with publisher confirms
+
+        Args:
+            window (int, optional): Maximum number of unconfirmed messages in flight, defaults to 1000.
+
+        Returns:
+            AsyncPublishBatch: The batch, to be opened with 'open' or used as an 'async with' context manager
+        """
+        return AsyncPublishBatch(self, window=window)
+
+    def publish_many(self, messages, window=DEFAULT_WINDOW):
+        """
+        Publish many messages to the exchange with publisher confirms
+
+        Args:
+            messages (iterable): (topic, content) tuples to publish, in order.
+            window (int, optional): Maximum number of unconfirmed messages in flight, defaults to 1000.
+
+        Returns:
+            asyncio.Future: Resolves with one bool per message, True if the broker acked it and False if it was nacked
+        """
+        def publish(batch):
+            for topic, content in messages:
+                batch.publish(topic, content)
+            return _then(self.loop, batch.flush(), lambda results: close(batch, results))
+
+        def close(batch, results):
+            batch.close()
+            self.logger.info('Published a batch of %s messages, %s acknowledged', len(results), results.count(True))
+            return results
+
+        return _then(self.loop, self.batch(window).open(), publish)
+
+    def close_connection(self):
+        """
+        Closes the connection to RabbitMQ
+
+        Returns:
+            asyncio.Future: Resolves with True once the connection has closed
+        """
+        self.logger.info('Closing connection: %s', self._connection)
+        if self._connection is None or self._connection.is_closed:
+            return _resolved(self.loop, True)
+
+        self._connection.close()
+        return self._closed
+
+    ####################
+    # Callback methods #
+    ####################
+
+    def _on_message(self, channel, basic_deliver, properties, body):
+        """
+        Default callback for message delivery, handing the message to its consumer's MessageIterator.
+        """
+        consumer = self._consumers.get(basic_deliver.consumer_tag)
+        if consumer is not None:
+            consumer.put(Message(basic_deliver.routing_key, basic_deliver.delivery_tag, properties, body))
+
+    def _on_channel_closed(self, channel, reply_code, reply_text):
+        self.logger.warn("Channel %s was closed: (%s) %s", channel, reply_code, reply_text)
+        for consumer in self._consumers.values():
+            consumer.close()
+        self._consumers = {}
+
+    def _on_connection_closed(self, connection, reply_code, reply_text):
+        self.logger.info("Connection closed: (%s) %s", reply_code, reply_text)
+        for consumer in self._consumers.values():
+            consumer.close()
+        self._consumers = {}
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(True)
+
+
+class AsyncPublishBatch(PublishBatch):
+    """
+    A batch of messages published with publisher confirms on an event loop.
+
+    'publish' never blocks: messages beyond the 'window' of unconfirmed messages are held back and
+    published as confirms arrive. Await 'flush' for the per-message results::
+
+        batch = yield From(client.batch(window=500).open())
+        for n in xrange(10000):
+            batch.publish('test', str(n))
+        results = yield From(batch.flush())
+        batch.close()
+
+    Args:
+        client (AsyncCottontailBase): The connected client whose connection and exchange are used for publishing.
+        window (int, optional): Maximum number of unconfirmed messages in flight, defaults to 1000.
+    """
+
+    def __init__(self, client, window=DEFAULT_WINDOW):
+        super(AsyncPublishBatch, self).__init__(client, window)
+        self._held = collections.deque()
+        self._flushed = None
+
+    def __aenter__(self):
+        return self.open()
+
+    def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.close()
+            return _resolved(self.client.loop, False)
+        return _then(self.client.loop, self.flush(), lambda _: self.close())
+
+    def open(self):
+        """
+        Open a channel on the client's connection and put it into confirm mode.
+
+        Returns:
+            asyncio.Future: Resolves with this batch once its channel is open
+        """
+        def confirm(channel):
+            self._channel = channel
+            channel.add_on_close_callback(self._on_channel_closed)
+            channel.confirm_delivery(self._on_delivery_confirmation)
+            return self
+
+        return _then(self.client.loop, AsyncCottontailBase._create_channel(self.client), confirm)
+
+    def publish(self, topic, content, headers=None, priority=None, expiration=None):
+        """
+        Publish a message without waiting for its confirm, or hold it back while the window is full.
+
+        Returns:
+            int: The index of this message in 'results'
+        """
+        body, properties = self.client._prepare_message(topic, content, headers, priority, expiration)
+
+        index = len(self.results)
+        self.results.append(None)
+        self._held.append((index, topic, content, body, properties))
+        self._publish_held()
+        return index
+
+    def flush(self):
+        """
+        Wait for every message to be published and acked or nacked by the broker.
+
+        Returns:
+            asyncio.Future: Resolves with the per-message results
+        """
+        if self._flushed is None or self._flushed.done():
+            self._flushed = _create_future(self.client.loop)
+        self._check_flushed()
+        return self._flushed
+
+    def _publish_held(self):
+        while self._held and len(self._unconfirmed) < self.window:
+            index, topic, content, body, properties = self._held.popleft()
+            self._channel.basic_publish(
+                exchange=self.client.exchange_name,
+                routing_key=topic,
+                body=body,
+                properties=properties,
+            )
+            self.client._record_publish(topic, content, body)
+            self._delivery_tag += 1
+            self._unconfirmed[self._delivery_tag] = index
+
+    def _check_flushed(self):
+        if self._flushed is not None and not self._flushed.done() and not self._unconfirmed and not self._held:
+            self._flushed.set_result(self.results)
+
+    def _on_delivery_confirmation(self, method_frame):
+        super(AsyncPublishBatch, self)._on_delivery_confirmation(method_frame)
+        self._publish_held()
+        self._check_flushed()
+
+    def _on_channel_closed(self, channel, reply_code, reply_text):
+        """
+        Give up on the messages still unconfirmed or held back, which keep a result of None.
+        """
+        self._unconfirmed.clear()
+        self._held.clear()
+        self._check_flushed()
+
+
+class AsyncPublisher(Publisher, AsyncCottontailBase):
+    """
+    An asyncio server class for publishing messages in a pub/sub pattern.
+    """
+    pass
+
+
+class AsyncSubscriber(Subscriber, AsyncCottontailBase):
+    """
+    An asyncio worker class for consuming messages in a pub/sub pattern.
+    """
+    pass
+
+
+class AsyncTopicPublisher(TopicPublisher, AsyncCottontailBase):
+    """
+    An asyncio server class for publishing messages of a particular topic.
+    """
+    pass
+
+
+class AsyncTopicSubscriber(TopicSubscriber, AsyncCottontailBase):
+    """
+    An asyncio worker class for consuming messages of a particular topic.
+
+    Without handlers, messages are iterated from the MessageIterator 'subscribe' resolves with.
+    Once handlers are registered, 'subscribe' binds the queue to their patterns and each delivery
+    is dispatched to the matching handlers on the event loop, then acknowledged, as with
+    TopicSubscriber.
+    """
+
+    def add_handler(self, pattern, function):
+        """
+        Register a function to handle the messages whose routing keys match a pattern
+
+        Args:
+            pattern (basestring): The topic pattern, where '*' matches one word and '#' zero or more
+            function (callable): Called with the basic_deliver, properties and decoded body of each matching message
+        """
+        bound = pattern in self.router.patterns
+        self.router.add(pattern, function)
+        if not bound:
+            for consumer in self._consumers.values():
+                AsyncCottontailBase._bind_to_queue(self, consumer.queue, pattern)
+
+    def _bind_to_queue(self, queue, topic):
+        """
+        Returns:
+            asyncio.Future: Resolves once the queue is bound to 'topic', or when no topic is given and
+                handlers are registered, to the pattern of every handler
+        """
+        if topic is not None or not self.router:
+            return AsyncCottontailBase._bind_to_queue(self, queue, topic)
+
+        return asyncio.gather(*[AsyncCottontailBase._bind_to_queue(self, queue, pattern)
+                                for pattern in self.router.patterns], loop=self.loop)
+
+    def _on_message(self, channel, basic_deliver, properties, body):
+        if not self.router:
+            return AsyncCottontailBase._on_message(self, channel, basic_deliver, properties, body)
+        return super(AsyncTopicSubscriber, self)._on_message(channel, basic_deliver, properties, body)
+
+
+class AsyncQueueServer(QueueServer, AsyncCottontailBase):
+    """
+    An asyncio server class for publishing messages to a queue.
+    """
+    pass
+
+
+class AsyncQueueWorker(QueueWorker, AsyncCottontailBase):
+    """
+    An asyncio worker class for consuming messages in a queue.
+
+    Overwritten methods:
+        _create_channel: Alter prefetch_count and prefetch_size once the channel has opened
+    """
+
+    def _create_channel(self):
+        return _create_channel_with_qos(self)
+
+
+class AsyncRPCServer(RPCServer, AsyncCottontailBase):
+    """
+    An asyncio server class for handling RPC requests.
+
+    '_execute_call' may return a plain value, or a future or coroutine for work that
+    itself awaits I/O; the reply is published once it resolves.
+
+    A call that raises, or whose future fails, is retried if the server has a retry policy, and
+    otherwise rejected and requeued, as calls failing in the executor pool of an RPCServer are.
+
+    Overwritten methods:
+        _create_channel: Alter prefetch_count and prefetch_size once the channel has opened
+        _on_message: Execute the call and publish its reply from the event loop
+    """
+
+    def _create_channel(self):
+        return _create_channel_with_qos(self)
+
+    def _on_message(self, channel, basic_deliver, properties, body):
+        # Kept for retrying the request if its call fails
+        raw_body = self._delivery_body
+        try:
+            args, kwargs = self._process_message(body)
+            self.logger.debug("Executing RPC function")
+            response = self._execute_call(*args, **kwargs)
+        except Exception as e:
+            self._on_call_failed(basic_deliver, properties, raw_body, e)
+            return
+
+        def reply(result):
+            self.logger.debug("Returning response message")
+            reply_body, reply_properties = self._prepare_reply(properties, result)
+            channel.basic_publish(
+                exchange='',
+                routing_key=properties.reply_to,
+                properties=reply_properties,
+                body=reply_body
+            )
+            self.acknowledge(basic_deliver.delivery_tag)
+
+        if asyncio.iscoroutine(response):
+            ensure_future = getattr(asyncio, 'ensure_future', None) or getattr(asyncio, 'async')
+            response = ensure_future(response, loop=self.loop)
+
+        replied = _then(self.loop, response, reply)
+        replied.add_done_callback(lambda future: self._on_call_done(future, basic_deliver, properties, raw_body))
+
+    def _on_call_done(self, future, basic_deliver, properties, body):
+        if not future.cancelled() and future.exception() is not None:
+            self._on_call_failed(basic_deliver, properties, body, future.exception())
+
+
+class AsyncRPCClient(RPCClient, AsyncCottontailBase):
+    """
+    An asyncio client class for submitting RPC requests.
+
+    Any number of calls may be outstanding at once; replies are matched to their
+    calls by correlation id.
+
+    Overwritten methods:
+        connect: Subscribe to the callback queue once connected
+        call: Return a future instead of blocking
+        _on_message: Resolve the future of the matching call
+
+    Attributes:
+        callback_queue (string): Name of the callback queue
+    """
+
+    def __init__(self, **kw):
+        self.callback_queue = None
+        self._calls = {}
+        super(AsyncRPCClient, self).__init__(**kw)
+
+    def connect(self):
+        def subscribe(_):
+            return _then(self.loop, self.subscribe(exclusive=True, acknowledge=False), set_callback_queue)
+
+        def set_callback_queue(messages):
+            self.callback_queue = messages.queue
+            return self
+
+        return _then(self.loop, AsyncCottontailBase.connect(self), subscribe)
+
+    def _on_message(self, channel, basic_deliver, properties, body):
+        self._log_message('reply', basic_deliver.routing_key, body)
+        future = self._calls.pop(properties.correlation_id, None)
+        if future is not None and not future.done():
+            future.set_result(body)
+
+    def call(self, function, *fn_args, **fn_kwargs):
+        """
+        Submit an RPC request
+
+        Args:
+            function (str): The name of the RPC queue serving the function
+
+        Returns:
+            asyncio.Future: Resolves with the body of the reply; cancelling it discards the reply
+        """
+        correlation_id = str(uuid.uuid4())
+        future = _create_future(self.loop)
+        self._calls[correlation_id] = future
+        future.add_done_callback(lambda f: self._calls.pop(correlation_id, None))
+
+        body, content_encoding = self._compress_body(self._compose_message(*fn_args, **fn_kwargs))
+
+        self._channel.basic_publish(
+            exchange='',
+            routing_key=function,
+            properties=pika.BasicProperties(
+                reply_to=self.callback_queue,
+                correlation_id=correlation_id,
+                content_type=self.codec.content_type if self.codec else None,
+                content_encoding=content_encoding,
+            ),
+            body=body)
+        return future
+
+    def _on_connection_closed(self, connection, reply_code, reply_text):
+        for future in self._calls.values():
+            if not future.done():
+                future.set_exception(errors.CottontailError("Connection closed before the RPC reply", errors.UNKNOWN))
+        self._calls = {}
+        super(AsyncRPCClient, self)._on_connection_closed(connection, reply_code, reply_text)
@@ -1,6 +1,16 @@
+import collections
+import socket
+import time
 import pika
+from pika import exceptions, spec
 import errors
 import utils
+from connection import connect, declared_on, is_declared, remember_declared, forget_declared
+from serialization import get_codec, resolve_codec, is_binary, RawCodec
+from compression import get_compressor, resolve_compressor, DEFAULT_THRESHOLD
+from confirms import PublishBatch, DEFAULT_WINDOW
+from cache import freeze
+from chunking import iter_chunks, chunk_headers, new_stream_id, DEFAULT_CHUNK_SIZE
 
 EXCHANGE_DIRECT = u'direct'
 EXCHANGE_TOPIC = u'topic'
@@ -8,6 +18,48 @@ EXCHANGE_FANOUT = u'fanout'
 EXCHANGE_HEADERS = u'headers'
 EXCHANGE_TYPES = {EXCHANGE_DIRECT, EXCHANGE_TOPIC, EXCHANGE_FANOUT, EXCHANGE_HEADERS}
 
+# Errors raised by pika when the connection to the broker is lost
+CONNECTION_ERRORS = (exceptions.AMQPConnectionError, socket.error)
+
+_RAW_CODEC = RawCodec()
+
+Message = collections.namedtuple('Message', ['routing_key', 'delivery_tag', 'properties', 'body'])
+
+# The AMQP method sent for each channel method that declarations are pipelined with
+_PIPELINED_METHODS = {
+    'exchange_declare': spec.Exchange.Declare,
+    'queue_declare': spec.Queue.Declare,
+    'queue_bind': spec.Queue.Bind,
+}
+
+
+def queue_arguments(arguments=None, max_priority=None, message_ttl=None, max_length=None, lazy_queue=False):
+    """
+    Build the optional arguments of a queue declaration
+
+    Args:
+        arguments (dict, optional): Other queue arguments, defaults to None.
+        max_priority (int, optional): Highest message priority the queue orders messages by, from 1 to 255,
+            defaults to None for no priorities.
+        message_ttl (int, optional): Milliseconds after which messages expire, defaults to None for no expiry.
+        max_length (int, optional): Most messages held, dropping or dead-lettering the oldest beyond it,
+            defaults to None for no limit.
+        lazy_queue (bool, optional): Keep messages on disk rather than in memory, default is False.
+
+    Returns:
+        dict: The queue arguments
+    """
+    arguments = dict(arguments or {})
+    if max_priority is not None:
+        arguments['x-max-priority'] = max_priority
+    if message_ttl is not None:
+        arguments['x-message-ttl'] = int(message_ttl)
+    if max_length is not None:
+        arguments['x-max-length'] = max_length
+    if lazy_queue:
+        arguments['x-queue-mode'] = 'lazy'
+    return arguments
+
 
 class CottontailBase(object):
     """
@@ -21,9 +73,54 @@ class CottontailBase(object):
         exchange_type (str, optional): Exchange type to create ('headers', 'topic', 'direct', 'fanout'), defaults to 'direct'.
         confirm_delivery (bool, optional): Whether to request 'ack' messages from consumers, default is True.
         logger (module, optional): The logging module to use with this Client instance, default is 'utils.logger'.
+        ack_batch_size (int, optional): Coalesce acknowledgements into one 'multiple' ack per this many messages, default is 1.
+        ack_interval (int, optional): Milliseconds after which coalesced acknowledgements are sent regardless, default is None.
+        connection_pool (ConnectionPool, optional): Lease a channel from this pool rather than opening a connection, default is None.
+        codec (Codec or str, optional): Codec, or content type of a registered codec, to encode published content with.
+            Default is None, which publishes strings in the 'topic:content' format.
+        compression (Compressor or str, optional): Compressor, or encoding of a registered compressor, for published
+            bodies. Default is None, for no compression.
+        compression_threshold (int, optional): Size in bytes from which bodies are compressed, default is 1024.
+        reconnect (bool, optional): Reconnect and restore the client's topology when the connection is lost, default is False.
+        reconnect_delay (float, optional): Seconds before the first reconnection attempt, doubling after each failure,
+            default is 1.
+        reconnect_max_delay (float, optional): Most seconds between reconnection attempts, default is 30.
+        reconnect_attempts (int, optional): Attempts after which 'listen' gives up, default is None to retry forever.
+        publish_buffer_size (int, optional): Messages buffered by 'publish' while reconnecting, default is 1000.
+        batch_size (int, optional): Hand deliveries to '_on_batch' in batches of up to this many rather than to
+            '_on_message' one at a time, default is None.
+        batch_interval (int, optional): Milliseconds after which a partial batch is handed to '_on_batch', default is None.
+        body_view (bool, optional): Deliver bodies without a codec as memoryviews over the received frames rather than
+            strings, default is False.
+        lazy (bool, optional): Connect and declare the exchange on first use rather than on construction, so creating a
+            client costs no round trips, default is False.
+        pipeline_topology (bool, optional): Declare the exchange, named queues and bindings without waiting for each
+            reply, confirming them together with one round trip in 'flush_topology', default is False.
+        retry (RetryPolicy, optional): Retry deliveries whose handler raises through delay queues with exponential
+            backoff, parking them on a dead letter queue after too many attempts, default is None.
 
     Attributes:
         logger (module): The logging module to use with this Client instance.
+        ack_batch_size (int): Number of acknowledgements coalesced into one 'multiple' ack.
+        ack_interval (int): Milliseconds after which coalesced acknowledgements are sent, or None.
+        codec (Codec): Codec that published content is encoded with, or None.
+        compressor (Compressor): Compressor that large published bodies are compressed with, or None.
+        compression_threshold (int): Size in bytes from which bodies are compressed.
+        log_sample_rate (float): Fraction of published and delivered messages logged at DEBUG, default 1.0.
+        log_body_limit (int): Maximum number of body characters included when a message is logged, default 256.
+        reconnect (bool): Whether to reconnect and restore the client's topology when the connection is lost.
+        reconnect_delay (float): Seconds before the first reconnection attempt.
+        reconnect_max_delay (float): Most seconds between reconnection attempts.
+        reconnect_attempts (int): Attempts after which 'listen' gives up, or None to retry forever.
+        publish_buffer_size (int): Messages buffered by 'publish' while reconnecting.
+        batch_size (int): Most deliveries handed to '_on_batch' at once, or None to handle them one at a time.
+        batch_interval (int): Milliseconds after which a partial batch is handed to '_on_batch', or None.
+        body_view (bool): Whether bodies without a codec are delivered as memoryviews.
+        lazy (bool): Whether the client connects on first use rather than on construction.
+        pipeline_topology (bool): Whether declarations are pipelined rather than each waiting for its reply.
+        retry (RetryPolicy): How deliveries whose handler raises are retried, or None to requeue them.
+        exclusive_consumer (bool): Whether queues are consumed exclusively, refusing other consumers, default False.
+        metrics (MetricsRegistry): Registry the client records metrics in, or None, set for every client by 'metrics.enable'.
         exchange_name (string): Exchange name to create, default '', the default exchange.
         exchange_type (string): Exchange type to create ('headers', 'topic', 'direct', or 'fanout'), default 'direct'.
         exchange (tuple): The exchange name and type represented as a tuple.
@@ -33,23 +130,119 @@ class CottontailBase(object):
     """
 
     exchange_type = EXCHANGE_DIRECT
-
-    def __init__(self, exchange_name='', hostname='localhost', port=5672, logger=utils.logger):
+    ack_batch_size = 1
+    ack_interval = None
+    codec = None
+    compressor = None
+    compression_threshold = DEFAULT_THRESHOLD
+    log_sample_rate = 1.0
+    log_body_limit = utils.DEFAULT_BODY_LIMIT
+    reconnect = False
+    reconnect_delay = 1.0
+    reconnect_max_delay = 30.0
+    reconnect_attempts = None
+    publish_buffer_size = 1000
+    batch_size = None
+    batch_interval = None
+    body_view = False
+    lazy = False
+    pipeline_topology = False
+    retry = None
+    exclusive_consumer = False
+    metrics = None
+    _connection_pool = None
+    _connection = None
+    _channel = None
+
+    def __init__(self, exchange_name='', hostname='localhost', port=5672, logger=utils.logger,
+                 ack_batch_size=1, ack_interval=None, connection_pool=None, codec=None,
+                 compression=None, compression_threshold=DEFAULT_THRESHOLD, reconnect=False,
+                 reconnect_delay=1.0, reconnect_max_delay=30.0, reconnect_attempts=None,
+                 publish_buffer_size=1000, batch_size=None, batch_interval=None, body_view=False, lazy=False,
+                 pipeline_topology=False, retry=None):
         # Setup logging
         self.logger = logger
 
-        # Initial setup of the connection to the Pika core
-        self.logger.info("Setting up a pika connection on {}:{}".format(hostname, port))
-        self._connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host=hostname,
-                port=port
-            )
+        self.codec = resolve_codec(codec)
+        self.compressor = resolve_compressor(compression)
+        self.compression_threshold = compression_threshold
+        self.body_view = body_view
+
+        self.ack_batch_size = ack_batch_size
+        self.ack_interval = ack_interval
+
+        # Deliveries awaiting a coalesced acknowledgement, in delivery order, and those already handled
+        self._delivered = collections.deque()
+        self._handled = set()
+        self._ack_timeout = None
+        self._no_ack_consumers = set()
+
+        # Deliveries collected for '_on_batch', and those among them that need no acknowledgement
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._batch = []
+        self._batch_no_ack = set()
+        self._batch_timeout = None
+
+        self.reconnect = reconnect
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reconnect_attempts = reconnect_attempts
+        self.publish_buffer_size = publish_buffer_size
+
+        # Queues, bindings and consumers to restore on reconnection, and messages published while disconnected
+        self._topology = []
+        self.pipeline_topology = pipeline_topology
+        self._declared = set()
+        self._unconfirmed = []
+
+        # The queue consumed by each consumer whose failed deliveries are retried
+        self.retry = retry
+        self._retry_queues = {}
+        self._publish_buffer = collections.deque()
+        self._next_reconnect = 0
+        self._reconnect_failures = 0
+
+        # Initial setup of the connection to the Pika core, unless one is leased from a pool with the channel
+        self._parameters = pika.ConnectionParameters(
+            host=hostname,
+            port=port
         )
+        self._connection_pool = connection_pool
 
-        self._channel = self._create_channel()
+        self.exchange_name = exchange_name
+        self.exchange = (exchange_name, self.exchange_type)
+        self.lazy = lazy
+        if not lazy:
+            self._open()
+
+    def _open(self):
+        """
+        Connect and declare the exchange
+        """
+        self._connect()
+        self._declare_exchange(self.exchange_name)
+
+    def _ensure_open(self):
+        """
+        Connect a lazy client on its first use
+        """
+        if self._channel is None:
+            self._open()
+
+    def _connect(self):
+        """
+        Open the connection, unless one is leased from the pool with the channel, and the channel
+        """
+        self._channel_reusable = True
+        self._unconfirmed = []
+        if self._connection_pool is None:
+            self.logger.info("Setting up a pika connection on %s:%s", self._parameters.host, self._parameters.port)
+            self._connection = connect(self._parameters)
 
-        self._declare_exchange(exchange_name)
+        self._channel = self._create_channel()
+        # Shared with the other clients of a pooled connection
+        self._declared = declared_on(self._connection)
 
     def _declare_exchange(self, exchange_name):
         """
@@ -67,16 +260,22 @@ class CottontailBase(object):
         self.exchange_name = exchange_name
         self.exchange = (self.exchange_name, self.exchange_type)
 
-        self.logger.info("Declaring exchange '{}' of type '{}' on channel '{}'".format(
-            exchange_name,
-            self.exchange_type,
-            self._channel
-        ))
+        self.logger.info("Declaring exchange '%s' of type '%s' on channel '%s'",
+                         exchange_name, self.exchange_type, self._channel)
 
         if not self.exchange_name:
             self.logger.warn("Using the default exchange ('') makes subscription unavailable")
 
-        self._channel.exchange_declare(*self.exchange)
+        # Another client of this process has declared it already
+        declaration = ('exchange',) + self.exchange
+        if is_declared(self._parameters, declaration):
+            return
+
+        if self.pipeline_topology and self.exchange_name:
+            self._pipeline('exchange_declare', {'exchange': self.exchange_name, 'type': self.exchange_type})
+        else:
+            self._channel.exchange_declare(*self.exchange)
+        remember_declared(self._parameters, declaration)
 
     def _create_channel(self):
         """
@@ -86,20 +285,34 @@ class CottontailBase(object):
             (pika.channel.Channel): The created Channel object
         """
 
+        if self._connection_pool is not None:
+            self.logger.info("Leasing a channel from the connection pool")
+            self._connection, channel = self._connection_pool.lease(self._parameters)
+            return channel
+
         self.logger.info("Setting up a new channel on the connection")
         return self._connection.channel()
 
-    def declare_queue(self, name, durable=True, exclusive=False):
+    def declare_queue(self, name, durable=True, exclusive=False, arguments=None, max_priority=None,
+                      message_ttl=None, max_length=None, lazy_queue=False):
         """
         Args:
             name (string): Name of the queue to declare
 
             durable (bool, optional): Survive reboots of the broker, defaults to True so we can increase reliability.
             exclusive (bool, optional): Only allow access by the current connection, defaults to True.
+            arguments (dict, optional): Optional queue arguments, e.g. 'x-message-ttl' or 'x-dead-letter-exchange',
+                defaults to None.
+            max_priority (int, optional): Highest message priority the queue orders messages by, from 1 to 255,
+                defaults to None for no priorities.
+            message_ttl (int, optional): Milliseconds after which messages expire, defaults to None for no expiry.
+            max_length (int, optional): Most messages held, dropping the oldest beyond it, defaults to None for no limit.
+            lazy_queue (bool, optional): Keep messages on disk rather than in memory, default is False.
 
         Returns:
             basestring: The name of the successfully declared queue
         """
+        self._ensure_open()
 
         params = {
             'durable': durable,
@@ -107,11 +320,31 @@ class CottontailBase(object):
         }
         if name:
             params['queue'] = name
-
-        self.logger.info("Declaring queue '{}' on channel '{}'".format(name, self._channel))
-        result = self._channel.queue_declare(**params)
-
-        return result.method.queue
+        arguments = queue_arguments(arguments, max_priority, message_ttl, max_length, lazy_queue)
+        if arguments:
+            params['arguments'] = arguments
+
+        # Named queues shared between connections need declaring once per process, exclusive ones once per connection
+        declaration = self._declaration('queue_declare', params)
+        if name and (declaration in self._declared or not exclusive and is_declared(self._parameters, declaration)):
+            self.logger.debug("Queue '%s' is already declared", name)
+            self._topology.append(('queue_declare', params, name))
+            return name
+
+        self.logger.info("Declaring queue '%s' on channel '%s'", name, self._channel)
+        if name and self.pipeline_topology:
+            # The name is known, so there is no need to wait for the reply
+            self._pipeline('queue_declare', params)
+        else:
+            name = self._channel.queue_declare(**params).method.queue
+
+        if params.get('queue') and exclusive:
+            self._declared.add(declaration)
+        elif params.get('queue'):
+            remember_declared(self._parameters, declaration)
+
+        self._topology.append(('queue_declare', params, name))
+        return name
 
     def delete_queue(self, name):
         """
@@ -128,51 +361,298 @@ class CottontailBase(object):
         if not isinstance(name, basestring):
             raise TypeError("You must specify a queue's 'name' as a string.")
 
-        self.logger.info("Deleting queue '{}' on channel '{}'".format(name, self._channel))
+        self._ensure_open()
+        forget_declared(self._parameters, 'queue', name)
+        self._declared.difference_update([declaration for declaration in self._declared if declaration[1] == name])
+        self._unconfirmed = [(method, params) for method, params in self._unconfirmed if params.get('queue') != name]
+        self.logger.info("Deleting queue '%s' on channel '%s'", name, self._channel)
         self._channel.queue_delete(
             queue=name,
             if_unused=False,
             if_empty=False,
             nowait=False)
 
-    def _bind_to_queue(self, queue, topic):
+        self._topology = [
+            (method, params, declared) for method, params, declared in self._topology
+            if declared != name and params.get('queue') != name
+        ]
+
+    def _bind_to_queue(self, queue, topic, arguments=None):
+        """
+
+        """
+        self._ensure_open()
+
+        self.logger.info("Binding to queue: '%s' on exchange: '%s'. Looking for messages of topic: '%s'",
+                         queue, self.exchange_name, topic)
+        params = {'exchange': self.exchange_name, 'queue': queue, 'routing_key': topic}
+        if arguments:
+            params['arguments'] = arguments
+
+        # Binding again on the same connection changes nothing
+        declaration = self._declaration('queue_bind', params)
+        if declaration in self._declared:
+            self.logger.debug("Queue '%s' is already bound with '%s'", queue, topic)
+            # Another client of the connection may have bound it, and this client restores it on reconnection
+            if ('queue_bind', params, None) not in self._topology:
+                self._topology.append(('queue_bind', params, None))
+            return
+
+        if self.pipeline_topology:
+            self._pipeline('queue_bind', params)
+        else:
+            self._channel.queue_bind(**params)
+        self._declared.add(declaration)
+        self._topology.append(('queue_bind', params, None))
+
+    def _pipeline(self, method, params):
+        """
+        Send a declaration without waiting for its reply, to be verified by 'flush_topology' with a passive
+        declaration of its exchange or queue.
+
+        pika's BlockingChannel waits for a reply to every method but acknowledgements, even with
+        'nowait' set and no reply coming, so the frame is sent directly rather than through the
+        channel method.
+
+        Args:
+            method (str): The channel method, 'exchange_declare', 'queue_declare' or 'queue_bind'
+            params (dict): The parameters of the declaration
+        """
+        self._channel._send_method(_PIPELINED_METHODS[method](nowait=True, **params))
+        if method == 'exchange_declare':
+            probe = ('exchange_declare', {'exchange': params['exchange'], 'passive': True})
+        else:
+            probe = ('queue_declare', {'queue': params['queue'], 'passive': True})
+        if probe not in self._unconfirmed:
+            self._unconfirmed.append(probe)
+
+    def flush_topology(self):
+        """
+        Wait for the broker to process the declarations pipelined since the last flush, passively declaring
+        each exchange and queue they declared or bound. Called by 'listen', and after restoring the topology
+        on reconnection.
+
+        Raises:
+            ChannelClosed: If the broker rejected one of the declarations, or one of them is missing,
+                closing the channel
+        """
+        unconfirmed, self._unconfirmed = self._unconfirmed, []
+        for method, params in unconfirmed:
+            getattr(self._channel, method)(**params)
+
+    def _prepare_message(self, topic, content, headers=None, priority=None, expiration=None):
+        """
+        Build the body and properties of a message to be published
+
+        Args:
+            topic (str): The topic of the message, to be read by subscribers of that topic.
+            content (object): The contents of the message to be sent, a string or binary object unless the client
+                has a codec
+            headers (dict, optional): Application headers of the message, defaults to None.
+            priority (int, optional): Priority of the message on queues declared with a 'max_priority',
+                defaults to None.
+            expiration (int, optional): Milliseconds after which the message expires, defaults to None.
+
+        Returns:
+            tuple: The message body and its pika.BasicProperties
+
+        Raises:
+            TypeError: If the client has no codec and 'content' is neither a string nor binary
+        """
+
+        if self.codec is not None:
+            message = self.codec.encode(content)
+            content_type = self.codec.content_type
+        elif isinstance(content, basestring):
+            # Format the message as a : separated string
+            message = "{}:{}".format(topic, content)
+            content_type = None
+        elif is_binary(content):
+            # Binary content is sent as the body unchanged, without the topic prefix
+            message = _RAW_CODEC.encode(content)
+            content_type = _RAW_CODEC.content_type
+        else:
+            raise TypeError("You must specify a message as a string or binary object.")
+
+        message, content_encoding = self._compress_body(message)
+        properties = pika.BasicProperties(
+            delivery_mode=2,
+            content_type=content_type,
+            content_encoding=content_encoding,
+            headers=headers,
+            priority=priority,
+            expiration=str(int(expiration)) if expiration is not None else None,
+        )
+
+        return message, properties
+
+    def _compress_body(self, body):
         """
+        Compress a message body if the client has a compressor and the body reaches the compression threshold
+
+        Args:
+            body (str): The encoded message body
 
+        Returns:
+            tuple: The body to send and its content_encoding, which is None if it was not compressed
+        """
+        if self.compressor is None or len(body) < self.compression_threshold:
+            return body, None
+        return self.compressor.compress(body), self.compressor.encoding
+
+    def _decode_body(self, properties, body):
         """
+        Decode a delivered message body, first inflating it with the compressor registered for its
+        content_encoding, then decoding it with the codec registered for its content_type
 
-        self.logger.info("Binding to queue: '{}' on exchange: '{}'. Looking for messages of topic: '{}'".format(
-            queue,
-            self.exchange_name,
-            topic
-        ))
-        self._channel.queue_bind(exchange=self.exchange_name, queue=queue, routing_key=topic)
+        Args:
+            properties (pika.Spec.BasicProperties): The message properties
+            body (str): The message body as delivered
 
-    def publish(self, topic, content):
+        Returns:
+            object: The decoded content, or the body unchanged if nothing is registered for its content_encoding
+                and content_type, as a memoryview if 'body_view' is set
+        """
+        compressor = get_compressor(properties.content_encoding) if properties.content_encoding else None
+        if compressor is not None:
+            body = compressor.decompress(body)
+
+        codec = get_codec(properties.content_type) if properties.content_type else None
+        if codec is None or isinstance(codec, RawCodec):
+            return memoryview(body) if self.body_view else body
+        return codec.decode(body)
+
+    def publish(self, topic, content, headers=None, priority=None, expiration=None):
         """
         Publish a message with a specified topic to the exchange
 
         Args:
             topic (str): The topic of the message, to be read by subscribers of that topic.
-            content (str): The contents of the message to be sent
+            content (object): The contents of the message to be sent, a string unless the client has a codec.
+                A bytearray, memoryview, buffer, mmap or file-like object is sent as the body unchanged.
+            headers (dict, optional): Application headers of the message, which headers exchanges route on,
+                defaults to None.
+            priority (int, optional): Priority of the message on queues declared with a 'max_priority', delivered
+                ahead of lower priority messages, defaults to None.
+            expiration (int, optional): Milliseconds after which the message expires and is dropped by the broker
+                if it has not been delivered, defaults to None.
 
         Raises:
-            TypeError: If 'content' is not a string
+            TypeError: If the client has no codec and 'content' is neither a string nor binary
+            CottontailError: If the connection is lost and the publish buffer is full
+        """
+
+        message, properties = self._prepare_message(topic, content, headers, priority, expiration)
+        self._send_message(topic, message, properties)
+        self._record_publish(topic, content, message)
+
+    def publish_stream(self, topic, source, chunk_size=DEFAULT_CHUNK_SIZE, headers=None):
         """
+        Publish a large message as a sequence of chunk messages, holding only one chunk in memory.
+        Consumers mixing in chunking.StreamConsumer reassemble it.
+
+        Args:
+            topic (str): The topic of the message, to be read by subscribers of that topic.
+            source (file or iterable): A file-like object, read from its current position, or an iterable of byte strings
+            chunk_size (int, optional): Size in bytes of each chunk, defaults to 1 MB.
+            headers (dict, optional): Application headers set on every chunk, defaults to None.
 
-        if not isinstance(content, basestring):
-            raise TypeError("You must specify a message as a string.")
+        Returns:
+            str: The stream id shared by the chunks
 
-        # Format the message as a : separated string
-        message = "{}:{}".format(topic, content)
-        self.logger.info('Sending message :{}:{}'.format(topic, content))
-        self._channel.basic_publish(
-            exchange=self.exchange_name,
-            routing_key=topic,
-            body=message,
-            properties=pika.BasicProperties(
+        Raises:
+            CottontailError: If the connection is lost and the publish buffer is full
+        """
+        stream_id = new_stream_id()
+        chunks = iter_chunks(source, chunk_size)
+        chunk = next(chunks)
+        index = 0
+        while chunk is not None:
+            # The last chunk carries the number of chunks
+            following = next(chunks, None)
+            count = index + 1 if following is None else None
+            message_headers = dict(headers or {}, **chunk_headers(stream_id, index, chunk_size, count))
+
+            body, content_encoding = self._compress_body(chunk)
+            properties = pika.BasicProperties(
                 delivery_mode=2,
-            ),
-        )
+                content_type=RawCodec.content_type,
+                content_encoding=content_encoding,
+                headers=message_headers,
+            )
+            self._send_message(topic, body, properties)
+            chunk = following
+            index += 1
+
+        self.logger.debug('Published streamed message %s in %s chunks', stream_id, index)
+        return stream_id
+
+    def _send_message(self, topic, message, properties):
+        """
+        Publish a prepared message, buffering it while the connection is being restored
+
+        Args:
+            topic (str): The routing key of the message
+            message (str): The message body
+            properties (pika.BasicProperties): The message properties
+        """
+        self._ensure_open()
+
+        # Keep messages in order behind any still buffered from an outage
+        if self._publish_buffer:
+            self._reconnect(block=False)
+        if self._publish_buffer:
+            self._buffer_publish(topic, message, properties)
+            return
+
+        try:
+            self._channel.basic_publish(
+                exchange=self.exchange_name,
+                routing_key=topic,
+                body=message,
+                properties=properties,
+            )
+        except CONNECTION_ERRORS:
+            if not self.reconnect:
+                raise
+            self.logger.warn("Lost the connection while publishing, buffering messages until it is restored")
+            self._buffer_publish(topic, message, properties)
+            self._reconnect(block=False)
+
+    def batch(self, window=DEFAULT_WINDOW):
+        """
+        Start a batch of messages published with publisher confirms
+
+        Args:
+            window (int, optional): Maximum number of unconfirmed messages in flight, defaults to 1000.
+
+        Returns:
+            PublishBatch: A context manager whose 'publish' method pipelines messages to the exchange
+        """
+        self._ensure_open()
+        return PublishBatch(self, window=window)
+
+    def publish_many(self, messages, window=DEFAULT_WINDOW):
+        """
+        Publish many messages to the exchange with publisher confirms, waiting until all are confirmed
+
+        Args:
+            messages (iterable): (topic, content) tuples to publish, in order.
+            window (int, optional): Maximum number of unconfirmed messages in flight, defaults to 1000.
+
+        Returns:
+            list: One bool per message, True if the broker acked it and False if it was nacked
+
+        Raises:
+            TypeError: If the client has no codec and any message content is not a string
+        """
+        with self.batch(window=window) as batch:
+            for topic, content in messages:
+                batch.publish(topic, content)
+
+        self.logger.info('Published a batch of %s messages, %s acknowledged',
+                         len(batch.results), batch.results.count(True))
+        return batch.results
 
     def subscribe(self, queue_name=None, topic=None, acknowledge=True, exclusive=False):
         """
@@ -193,42 +673,311 @@ class CottontailBase(object):
         # if not self.exchange_name:
         #     raise errors.CottontailError("The default exchange is not eligible for subscription", errors.INVALID)
 
-        queue = self.declare_queue(queue_name, exclusive=exclusive)
+        queue = self._declare_subscribed_queue(queue_name, exclusive)
 
         self._bind_to_queue(queue, topic)
 
         # self.logger.info('Subscribing to topic: {}'.format(topic))
-        self._channel.basic_consume(self._on_message, queue=queue, no_ack=not acknowledge)
+        return self._consume(queue, acknowledge)
+
+    def _declare_subscribed_queue(self, name, exclusive):
+        """
+        Declare the queue 'subscribe' consumes. Override this to declare it with queue arguments.
+
+        Returns:
+            basestring: The name of the queue
+        """
+        return self.declare_queue(name, exclusive=exclusive)
+
+    def _consume(self, queue, acknowledge):
+        """
+        Start consuming a queue, delivering its messages to '_handle_delivery'
+
+        Args:
+            queue (basestring): The name of the queue
+            acknowledge (bool): Whether the broker should expect an 'ack' for each message
+
+        Returns:
+            basestring: The name of the queue
+        """
+        retried = self.retry is not None and self._declare_retry_queues(queue)
+
+        self._channel_reusable = False
+        params = {'queue': queue, 'no_ack': not acknowledge}
+        if self.exclusive_consumer:
+            params['exclusive'] = True
+        consumer_tag = self._channel.basic_consume(self._handle_delivery, **params)
+        if not acknowledge:
+            self._no_ack_consumers.add(consumer_tag)
+        if retried:
+            self._retry_queues[consumer_tag] = queue
+        self._topology.append(('basic_consume', params, consumer_tag))
 
         return queue
 
+    def _declare_retry_queues(self, queue):
+        """
+        Declare the delay queues and the dead letter queue of a consumed queue
+
+        Returns:
+            bool: True if failed deliveries from the queue can be retried
+        """
+        if queue.startswith('amq.'):
+            # Names starting with 'amq.' are reserved, so server-named queues get no delay queues
+            self.logger.warn("Failed deliveries from server-named queue '%s' are requeued, not retried", queue)
+            return False
+
+        for name, arguments in self.retry.delay_queues(queue):
+            self.declare_queue(name, arguments=arguments)
+        if self.retry.dead_letter:
+            self.declare_queue(self.retry.dead_letter_queue(queue))
+        return True
+
     def listen(self):
         """
         Listen continuously on the subscriber socket for incoming messages.
         """
+        self._ensure_open()
+        self.flush_topology()
         self.logger.info('Listening for messages...')
-        self._channel.start_consuming()
+        try:
+            while True:
+                try:
+                    self._channel.start_consuming()
+                    return
+                except CONNECTION_ERRORS:
+                    if not self.reconnect:
+                        raise
+                    self.logger.warn("Lost the connection while listening, reconnecting")
+                    self._reconnect()
+        finally:
+            if self._batch and self._connection.is_open:
+                self._dispatch_batch()
+            if self._coalescing_acks and self._connection.is_open:
+                self.flush_acks()
+
+    def _buffer_publish(self, topic, message, properties):
+        """
+        Hold a message to publish once the connection is restored
+
+        Raises:
+            CottontailError: If the publish buffer is full
+        """
+        if len(self._publish_buffer) >= self.publish_buffer_size:
+            raise errors.CottontailError(
+                "The connection is lost and {} messages are already buffered".format(len(self._publish_buffer)),
+                errors.UNAVAILABLE
+            )
+        self._publish_buffer.append((self.exchange_name, topic, message, properties))
+
+    def _flush_publish_buffer(self):
+        """
+        Publish the messages buffered while disconnected, in order, stopping if the connection is lost again
+        """
+        while self._publish_buffer:
+            exchange, topic, message, properties = self._publish_buffer[0]
+            self._channel.basic_publish(exchange=exchange, routing_key=topic, body=message, properties=properties)
+            self._publish_buffer.popleft()
+
+    def _reconnect(self, block=True):
+        """
+        Reconnect, restore the topology and publish any buffered messages, backing off exponentially
+        between failed attempts.
+
+        Messages being published as the connection was lost may be published twice, and deliveries
+        not yet acknowledged are redelivered by the broker.
+
+        Args:
+            block (bool, optional): Sleep between attempts until reconnected, defaults to True. Otherwise
+                make at most one attempt, and none until the backoff since the last failure has passed.
+
+        Returns:
+            bool: True if reconnected
+
+        Raises:
+            AMQPConnectionError: If blocking and 'reconnect_attempts' attempts have failed
+        """
+        while True:
+            delay = self._next_reconnect - time.time()
+            if delay > 0:
+                if not block:
+                    return False
+                time.sleep(delay)
+
+            try:
+                self._connect()
+                self._replay_topology()
+                self._flush_publish_buffer()
+            except CONNECTION_ERRORS as e:
+                self._reconnect_failures += 1
+                if block and self.reconnect_attempts is not None and self._reconnect_failures >= self.reconnect_attempts:
+                    raise
+                backoff = min(self.reconnect_delay * 2 ** (self._reconnect_failures - 1), self.reconnect_max_delay)
+                self._next_reconnect = time.time() + backoff
+                self.logger.warn("Reconnection attempt %s failed, retrying in %ss: %r",
+                                 self._reconnect_failures, backoff, e)
+                if not block:
+                    return False
+                continue
+
+            self.logger.info("Reconnected after %s failed attempts", self._reconnect_failures)
+            self._reconnect_failures = 0
+            self._next_reconnect = 0
+            return True
+
+    def _replay_topology(self):
+        """
+        Declare the exchange, queues, bindings and consumers of this client again on a new channel.
+        Server-named queues get new names, which later bindings and consumers follow.
+
+        Returns:
+            dict: The new name of each server-named queue by its old name
+        """
+        # Deliveries on the lost channel can no longer be acknowledged, the broker requeues them
+        retry_queues, self._retry_queues = self._retry_queues, {}
+        self._delivered.clear()
+        self._handled.clear()
+        self._ack_timeout = None
+        self._no_ack_consumers.clear()
+        self._batch = []
+        self._batch_no_ack.clear()
+        self._batch_timeout = None
+
+        # The broker may have restarted and lost what was declared
+        forget_declared(self._parameters)
+        self._declare_exchange(self.exchange_name)
+
+        renamed = {}
+        topology = []
+        for method, params, declared in self._topology:
+            params = dict(params)
+            if 'queue' in params:
+                params['queue'] = renamed.get(params['queue'], params['queue'])
+
+            # Queues declared and bound more than once are restored once
+            declaration = self._declaration(method, params)
+            if declaration is not None and declaration in self._declared:
+                continue
+
+            if method == 'queue_declare' and self.pipeline_topology and 'queue' in params:
+                self._pipeline(method, params)
+            elif method == 'queue_declare':
+                result = self._channel.queue_declare(**params)
+                renamed[declared] = result.method.queue
+                declared = result.method.queue
+            elif method == 'basic_consume':
+                self._channel_reusable = False
+                consumer_tag, declared = declared, self._channel.basic_consume(self._handle_delivery, **params)
+                if params['no_ack']:
+                    self._no_ack_consumers.add(declared)
+                if consumer_tag in retry_queues:
+                    self._retry_queues[declared] = params['queue']
+            elif self.pipeline_topology:
+                self._pipeline(method, params)
+            else:
+                getattr(self._channel, method)(**params)
+
+            if declaration is not None:
+                self._declared.add(declaration)
+            topology.append((method, params, declared))
+
+        self._topology = topology
+        self.flush_topology()
+        self.logger.info("Restored %s queues, bindings and consumers", len(topology))
+        return renamed
+
+    def _declaration(self, method, params):
+        """
+        Key of a named queue declaration or a binding in the topology, by which repeats are recognized
+
+        Returns:
+            tuple: The key, or None for declarations of server-named queues and consumers
+        """
+        arguments = freeze(params.get('arguments') or {})
+        if method == 'queue_declare' and params.get('queue'):
+            return 'queue', params['queue'], params['durable'], params['exclusive'], arguments
+        if method == 'queue_bind':
+            return 'binding', params['queue'], params['exchange'], params['routing_key'], arguments
+        return None
+
+    @property
+    def _coalescing_acks(self):
+        return self.ack_batch_size > 1 or bool(self.ack_interval)
 
     def acknowledge(self, message_receipt):
         """
         Acknowledge the message delivery from RabbitMQ by sending a Basic.Ack RPC method for the delivery tag.
 
+        When acknowledgements are coalesced, the ack is deferred and later sent together with others
+        as a single Basic.Ack with 'multiple' set, covering only deliveries that have all been handled.
+
         Args:
             message_receipt (int): The delivery tag from the Basic.Deliver frame
 
         """
-        self.logger.info('Acknowledging message: {}'.format(message_receipt))
-        self._channel.basic_ack(message_receipt)
+        if self.metrics is not None:
+            self.metrics.counter('cottontail_acked_total').inc()
+
+        if not self._coalescing_acks or message_receipt not in self._delivered:
+            self.logger.debug('Acknowledging message: %s', message_receipt)
+            self._channel.basic_ack(message_receipt)
+            return
+
+        self._handled.add(message_receipt)
+        if len(self._handled) >= self.ack_batch_size:
+            self.flush_acks()
+        elif self.ack_interval and self._ack_timeout is None:
+            self._ack_timeout = self._connection.add_timeout(self.ack_interval / 1000.0, self._on_ack_timeout)
+
+    def flush_acks(self, final=False):
+        """
+        Send the coalesced acknowledgements for handled deliveries.
+
+        Deliveries are acked with one 'multiple' ack up to the first one still being handled.
+        Handled deliveries after that one are left pending, unless 'final' is set, in which case
+        they are acked individually.
+
+        Args:
+            final (bool, optional): Acknowledge every handled delivery, e.g. on shutdown, defaults to False.
+        """
+        if self._ack_timeout is not None:
+            self._connection.remove_timeout(self._ack_timeout)
+            self._ack_timeout = None
+
+        last_tag = None
+        while self._delivered and self._delivered[0] in self._handled:
+            last_tag = self._delivered.popleft()
+            self._handled.discard(last_tag)
+
+        if last_tag is not None:
+            self.logger.debug('Acknowledging messages up to: %s', last_tag)
+            self._channel.basic_ack(last_tag, multiple=True)
+
+        if final:
+            for tag in sorted(self._handled):
+                self._delivered.remove(tag)
+                self._channel.basic_ack(tag)
+            self._handled.clear()
 
     def close_connection(self):
         """
-        Closes the connection to RabbitMQ
+        Closes the connection to RabbitMQ, or returns the channel to the connection pool it was leased from
 
         Returns:
             bool: True if successful
         """
+        if self._channel is None:
+            return True
+
+        if self._coalescing_acks and self._connection.is_open:
+            self.flush_acks(final=True)
 
-        self.logger.info('Closing connection: {}'.format(self._connection))
+        if self._connection_pool is not None:
+            self.logger.info('Releasing channel to the connection pool: %s', self._channel)
+            self._connection_pool.release(self._connection, self._channel, reusable=self._channel_reusable)
+            return True
+
+        self.logger.info('Closing connection: %s', self._connection)
         self._connection.close()
 
         return True
@@ -248,6 +997,208 @@ class CottontailBase(object):
         """
         self.logger.info('Exchange declared')
 
+    def _log_message(self, event, routing_key, body):
+        """
+        Log a message event at DEBUG, sampled and truncated, without formatting anything when DEBUG is disabled.
+        """
+        utils.log_message(self.logger, event, routing_key, body,
+                          sample_rate=self.log_sample_rate, body_limit=self.log_body_limit)
+
+    def _record_publish(self, topic, content, message):
+        """
+        Log a published message and count it when metrics are enabled, for 'publish' and publish batches alike.
+        """
+        self._log_message('publish', topic, content)
+        if self.metrics is not None:
+            self.metrics.counter('cottontail_published_total', exchange=self.exchange_name).inc()
+            self.metrics.counter('cottontail_published_bytes_total', exchange=self.exchange_name).inc(len(message))
+
+    def _on_ack_timeout(self):
+        """
+        Invoked by the connection when coalesced acknowledgements have waited 'ack_interval' milliseconds.
+        """
+        self._ack_timeout = None
+        self.flush_acks()
+
+    def _handle_delivery(self, channel, basic_deliver, properties, body):
+        """
+        Consumer callback registered with pika, decoding each delivery and dispatching it to '_on_message',
+        and recording the delivery and the time spent handling it when metrics are enabled.
+        """
+        if self.metrics is None:
+            return self._dispatch_delivery(channel, basic_deliver, properties, body)
+
+        exchange = basic_deliver.exchange
+        self.metrics.counter('cottontail_delivered_total', exchange=exchange).inc()
+        if basic_deliver.redelivered:
+            self.metrics.counter('cottontail_redelivered_total', exchange=exchange).inc()
+
+        started = time.time()
+        try:
+            return self._dispatch_delivery(channel, basic_deliver, properties, body)
+        except Exception:
+            self.metrics.counter('cottontail_handler_errors_total', exchange=exchange).inc()
+            raise
+        finally:
+            self.metrics.histogram('cottontail_handler_seconds', exchange=exchange).observe(time.time() - started)
+
+    def _dispatch_delivery(self, channel, basic_deliver, properties, body):
+        """
+        Dispatch a delivery to '_on_message', or to the current batch when 'batch_size' is set.
+
+        When acknowledgements are coalesced, deliveries are tracked so that a 'multiple' ack never
+        covers one still being handled. A delivery whose handler raises is retried if the client has
+        a retry policy. Otherwise the error is re-raised, after rejecting and requeueing the delivery
+        when acknowledgements are coalesced, once the acks before it are sent.
+        """
+        if self.batch_size:
+            return self._collect_delivery(basic_deliver, properties, self._decode_body(properties, body))
+
+        tracked = self._coalescing_acks and basic_deliver.consumer_tag not in self._no_ack_consumers
+        if tracked:
+            self._delivered.append(basic_deliver.delivery_tag)
+        try:
+            self._on_message(channel, basic_deliver, properties, self._decode_body(properties, body))
+        except Exception as e:
+            if self._retry_delivery(basic_deliver, properties, body, e):
+                return
+            if tracked:
+                self._requeue_failed_delivery(basic_deliver.delivery_tag)
+            raise
+
+    def _retry_delivery(self, basic_deliver, properties, body, error):
+        """
+        Republish a delivery whose handler raised to the delay queue of its attempt, or park it on the
+        dead letter queue once it has failed 'max_attempts' times, then acknowledge it. Handlers that
+        fail must not have acknowledged the delivery.
+
+        Returns:
+            bool: True if the delivery was retried or parked, False if its queue is not retried
+        """
+        queue = self._retry_queues.get(basic_deliver.consumer_tag) if self.retry is not None else None
+        if queue is None:
+            return False
+
+        target, properties = self.retry.route(queue, properties, error)
+        if target is None:
+            self.logger.warn("Dropping message %s from '%s' after %s failed attempts: %r",
+                             basic_deliver.delivery_tag, queue, self.retry.max_attempts, error)
+        else:
+            self.logger.warn("Handling message %s from '%s' failed, moving it to '%s': %r",
+                             basic_deliver.delivery_tag, queue, target, error)
+            self._channel.basic_publish(exchange='', routing_key=target, body=body, properties=properties)
+
+        if self.metrics is not None:
+            dead = target is None or properties.expiration is None
+            self.metrics.counter('cottontail_dead_lettered_total' if dead else 'cottontail_retried_total',
+                                 queue=queue).inc()
+
+        if basic_deliver.consumer_tag not in self._no_ack_consumers:
+            self.acknowledge(basic_deliver.delivery_tag)
+        return True
+
+    def _collect_delivery(self, basic_deliver, properties, body):
+        """
+        Add a delivery to the current batch, handing the batch to '_on_batch' once it holds 'batch_size'
+        deliveries, or 'batch_interval' milliseconds after its first delivery.
+        """
+        self._batch.append(Message(basic_deliver.routing_key, basic_deliver.delivery_tag, properties, body))
+        if basic_deliver.consumer_tag in self._no_ack_consumers:
+            self._batch_no_ack.add(basic_deliver.delivery_tag)
+
+        if len(self._batch) >= self.batch_size:
+            self._dispatch_batch()
+        elif self.batch_interval and self._batch_timeout is None:
+            self._batch_timeout = self._connection.add_timeout(self.batch_interval / 1000.0, self._on_batch_timeout)
+
+    def _dispatch_batch(self):
+        """
+        Hand the current batch to '_on_batch', then acknowledge it with one 'multiple' ack, after
+        rejecting and requeueing the messages that failed. If '_on_batch' raises, the whole batch is
+        requeued and the error re-raised.
+        """
+        if self._batch_timeout is not None:
+            self._connection.remove_timeout(self._batch_timeout)
+            self._batch_timeout = None
+
+        messages, self._batch = self._batch, []
+        no_ack, self._batch_no_ack = self._batch_no_ack, set()
+        tags = [message.delivery_tag for message in messages if message.delivery_tag not in no_ack]
+
+        try:
+            failed = self._on_batch(messages)
+        except Exception:
+            if tags:
+                self._channel.basic_nack(tags[-1], multiple=True, requeue=True)
+                self._record_settled(0, len(tags))
+            raise
+
+        failed_tags = set(message.delivery_tag for message in failed or ()) - no_ack
+        if not tags:
+            return
+        if len(failed_tags) == len(tags):
+            self.logger.debug('Requeueing a batch of %s messages up to: %s', len(tags), tags[-1])
+            self._channel.basic_nack(tags[-1], multiple=True, requeue=True)
+            self._record_settled(0, len(tags))
+            return
+
+        for tag in sorted(failed_tags):
+            self._channel.basic_nack(tag, requeue=True)
+
+        last_tag = max(tag for tag in tags if tag not in failed_tags)
+        self.logger.debug('Acknowledging a batch of %s messages up to: %s', len(tags) - len(failed_tags), last_tag)
+        self._channel.basic_ack(last_tag, multiple=True)
+        self._record_settled(len(tags) - len(failed_tags), len(failed_tags))
+
+    def _record_settled(self, acked, requeued):
+        """
+        Count the messages of a batch that were acknowledged and requeued, when metrics are enabled.
+        """
+        if self.metrics is None:
+            return
+        if acked:
+            self.metrics.counter('cottontail_acked_total').inc(acked)
+        if requeued:
+            self.metrics.counter('cottontail_requeued_total').inc(requeued)
+
+    def _on_batch_timeout(self):
+        """
+        Invoked by the connection when a partial batch has waited 'batch_interval' milliseconds.
+        """
+        self._batch_timeout = None
+        if self._batch:
+            self._dispatch_batch()
+
+    def _on_batch(self, messages):
+        """
+        Default callback for a batch of deliveries when 'batch_size' is set. Override this to handle
+        messages in bulk. Every message not returned as failed is acknowledged.
+
+        Args:
+            messages (list): The delivered Message tuples of routing_key, delivery_tag, properties and body,
+                in delivery order, with each body decoded if it has a registered content_type.
+
+        Returns:
+            list: The messages that failed and should be requeued, or None if all succeeded
+        """
+        for message in messages:
+            self._log_message('deliver', message.routing_key, message.body)
+
+    def _requeue_failed_delivery(self, delivery_tag):
+        """
+        Send the coalesced acks before a delivery whose handler failed, then reject and requeue it,
+        so that no later 'multiple' ack can cover it. Acks are flushed while the delivery is still
+        pending, as deliveries after it may already have been handled.
+        """
+        if delivery_tag in self._handled or delivery_tag not in self._delivered:
+            return
+
+        self.flush_acks()
+        self._delivered.remove(delivery_tag)
+        self._channel.basic_reject(delivery_tag, requeue=True)
+        if self.metrics is not None:
+            self.metrics.counter('cottontail_requeued_total').inc()
+
     def _on_message(self, channel, basic_deliver, properties, body):
         """
         Default callback for message delivery, used to handle messages and
@@ -257,9 +1208,9 @@ class CottontailBase(object):
             channel (pika.channel.Channel): The Channel object
             basic_deliver (pika.Spec.Basic.Deliver): The basic_deliver object, carrying the exchange, routing_key, delivery tag, and a redelivered flag
             properties (pika.Spec.BasicProperties): An instance of BasicProperties with the message properties
-            body (basestring): The message that was delivered.
+            body (object): The message that was delivered, decoded if it has a registered content_type.
         """
-        self.logger.info("Handling message {}:{}".format(basic_deliver.routing_key, body))
+        self._log_message('deliver', basic_deliver.routing_key, body)
         self.acknowledge(basic_deliver.delivery_tag)
 
     # Future Callbacks, dependent on non-blocking Connection Adapters
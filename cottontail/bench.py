@@ -0,0 +1,467 @@
+"""
+Throughput and latency benchmarks for the Cottontail messaging patterns.
+
+Producers publish messages carrying their send time in the 'bench-sent-us' header,
+consumers record the latency of each one on arrival, and the run reports publish and
+delivery rates, latency percentiles and the CPU time and peak RSS of each process::
+
+    python -m cottontail.bench --pattern queue --messages 100000 --size 256 --consumers 4 \\
+        --prefetch 100 --ack batch --ack-batch-size 50
+
+Runs use RabbitMQ on --host and --port unless --broker memory, or COTTONTAIL_BROKER=memory,
+selects the in-process broker. Producers and consumers run as threads of one process, or
+each in its own process with --processes, which needs RabbitMQ.
+
+For RPC, producers are RPCClients making one call at a time to echoing RPCServers, and
+latency is the round-trip time of each call.
+"""
+import argparse
+import multiprocessing
+import os
+import Queue
+import resource
+import threading
+import time
+
+import pika
+
+import connection
+import memory
+from base import CottontailBase
+from pubsub import Publisher, Subscriber
+from queue import QueueServer, QueueWorker
+from rpc import RPCClient, RPCServer
+from topic import TopicPublisher, TopicSubscriber
+
+PATTERN_PUBSUB = u'pubsub'
+PATTERN_TOPIC = u'topic'
+PATTERN_QUEUE = u'queue'
+PATTERN_RPC = u'rpc'
+PATTERNS = (PATTERN_PUBSUB, PATTERN_TOPIC, PATTERN_QUEUE, PATTERN_RPC)
+
+ACK_NONE = u'none'
+ACK_EACH = u'each'
+ACK_BATCH = u'batch'
+ACK_MODES = (ACK_NONE, ACK_EACH, ACK_BATCH)
+
+BROKER_MEMORY = u'memory'
+BROKER_RABBITMQ = u'rabbitmq'
+
+EXCHANGE_NAME = 'cottontail_bench'
+QUEUE_NAME = 'cottontail_bench'
+TOPIC_KEYS = 16
+
+HEADER_SENT = 'bench-sent-us'
+HEADER_STOP = 'bench-stop'
+
+PERCENTILES = (0.5, 0.99, 0.999)
+
+
+def _now_us():
+    return long(time.time() * 1000000)
+
+
+def _usage():
+    """
+    Returns:
+        tuple: CPU seconds used by this process, and its peak resident set size in kilobytes on Linux
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+
+def percentile(values, fraction):
+    """
+    Args:
+        values (list): Sorted values
+        fraction (float): The percentile to find, between 0 and 1
+
+    Returns:
+        The nearest-rank percentile of 'values', or None if there are none
+    """
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+class _TimestampedPublisher(object):
+    """
+    Publisher mixin adding the send time, or a stop marker, to the headers of every message.
+    """
+    _stopping = False
+
+    def _prepare_message(self, topic, content, headers=None, priority=None, expiration=None):
+        body, properties = super(_TimestampedPublisher, self)._prepare_message(topic, content, headers, priority,
+                                                                               expiration)
+        properties.headers = dict(headers or {})
+        if self._stopping:
+            properties.headers[HEADER_STOP] = True
+        else:
+            properties.headers[HEADER_SENT] = _now_us()
+        return body, properties
+
+    def publish_stop(self, topic, count=1):
+        """
+        Publish 'count' stop markers, each ending one consumer's run
+        """
+        self._stopping = True
+        for _ in xrange(count):
+            self.publish(topic, '')
+
+
+class _MeasuredConsumer(object):
+    """
+    Consumer mixin recording the latency of every message from the time in its headers, and
+    cancelling its consumers on a stop marker.
+    """
+    manual_ack = True
+
+    def _start_measuring(self):
+        self.latencies = []
+        self.last_received = None
+
+    def _on_message(self, channel, basic_deliver, properties, body):
+        headers = properties.headers or {}
+        if self.manual_ack:
+            self.acknowledge(basic_deliver.delivery_tag)
+
+        if HEADER_STOP in headers:
+            channel.stop_consuming()
+            return
+
+        self.latencies.append(_now_us() - headers[HEADER_SENT])
+        self.last_received = time.time()
+
+
+class _BoundQueueWorker(QueueWorker):
+    """
+    A QueueWorker whose queue is bound to its exchange, so QueueServers on that exchange reach it.
+    """
+
+    def _bind_to_queue(self, queue, topic):
+        CottontailBase._bind_to_queue(self, queue, topic)
+
+
+class _EchoRPCServer(RPCServer):
+    """
+    An RPCServer replying to each request with its body, stopping on a stop marker.
+    """
+
+    def _on_message(self, channel, basic_deliver, properties, body):
+        if HEADER_STOP in (properties.headers or {}):
+            self.acknowledge(basic_deliver.delivery_tag)
+            channel.stop_consuming()
+            return
+        super(_EchoRPCServer, self)._on_message(channel, basic_deliver, properties, body)
+
+    def _process_message(self, body):
+        return [body], {}
+
+    def _execute_call(self, body):
+        return body
+
+
+class _EchoRPCClient(RPCClient):
+
+    def _compose_message(self, *fn_args, **fn_kwargs):
+        return fn_args[0]
+
+    def publish_stop(self, function, count=1):
+        for _ in xrange(count):
+            self._channel.basic_publish(
+                exchange='',
+                routing_key=function,
+                body='',
+                properties=pika.BasicProperties(headers={HEADER_STOP: True}),
+            )
+
+
+_PRODUCERS = {
+    PATTERN_PUBSUB: type('BenchPublisher', (_TimestampedPublisher, Publisher), {}),
+    PATTERN_TOPIC: type('BenchTopicPublisher', (_TimestampedPublisher, TopicPublisher), {}),
+    PATTERN_QUEUE: type('BenchQueueServer', (_TimestampedPublisher, QueueServer), {}),
+    PATTERN_RPC: _EchoRPCClient,
+}
+
+_CONSUMERS = {
+    PATTERN_PUBSUB: type('BenchSubscriber', (_MeasuredConsumer, Subscriber), {}),
+    PATTERN_TOPIC: type('BenchTopicSubscriber', (_MeasuredConsumer, TopicSubscriber), {}),
+    PATTERN_QUEUE: type('BenchQueueWorker', (_MeasuredConsumer, _BoundQueueWorker), {}),
+    PATTERN_RPC: _EchoRPCServer,
+}
+
+
+def _client_options(config):
+    return {'hostname': config.host, 'port': config.port}
+
+
+def _create_producer(config):
+    if config.pattern == PATTERN_RPC:
+        return _EchoRPCClient(**_client_options(config))
+    return _PRODUCERS[config.pattern](EXCHANGE_NAME, **_client_options(config))
+
+
+def _create_consumer(config):
+    options = _client_options(config)
+    if config.ack == ACK_BATCH:
+        options.update(ack_batch_size=config.ack_batch_size, ack_interval=config.ack_interval)
+
+    if config.pattern == PATTERN_RPC:
+        return _EchoRPCServer(prefetch_count=config.prefetch, **options)
+    if config.pattern == PATTERN_QUEUE:
+        return _CONSUMERS[config.pattern](exchange_name=EXCHANGE_NAME, prefetch_count=config.prefetch, **options)
+
+    consumer = _CONSUMERS[config.pattern](EXCHANGE_NAME, **options)
+    consumer._channel.basic_qos(prefetch_count=config.prefetch)
+    return consumer
+
+
+def _topic(config, n):
+    if config.pattern == PATTERN_TOPIC:
+        return 'bench.{}'.format(n % TOPIC_KEYS)
+    return QUEUE_NAME
+
+
+def _produce(config, index, results):
+    """
+    Publish, or call, 'config.messages' times, then report the elapsed time and any round-trip latencies
+    """
+    client = _create_producer(config)
+    body = 'x' * config.size
+    latencies = []
+
+    start = time.time()
+    if config.pattern == PATTERN_RPC:
+        for _ in xrange(config.messages):
+            sent = _now_us()
+            client.call(QUEUE_NAME, body)
+            latencies.append(_now_us() - sent)
+    else:
+        for n in xrange(config.messages):
+            client.publish(_topic(config, n), body)
+    elapsed = time.time() - start
+
+    client.close_connection()
+    results.put(('producer', index, {
+        'messages': config.messages,
+        'elapsed': elapsed,
+        'latencies': latencies,
+        'usage': _usage(),
+    }))
+
+
+def _consume(config, index, results):
+    """
+    Subscribe, report readiness, then consume until a stop marker arrives and report what was received
+    """
+    client = _create_consumer(config)
+    acknowledge = config.ack != ACK_NONE
+
+    # Deliveries of a no_ack consumer must not be acknowledged
+    client.manual_ack = acknowledge
+    if config.pattern == PATTERN_RPC:
+        client.subscribe(QUEUE_NAME)
+    elif config.pattern == PATTERN_QUEUE:
+        client.subscribe(QUEUE_NAME, acknowledge=acknowledge)
+    else:
+        client.subscribe(topic='bench.#', acknowledge=acknowledge, exclusive=True)
+
+    if config.pattern != PATTERN_RPC:
+        client._start_measuring()
+    results.put(('ready', index, None))
+
+    client.listen()
+    client.close_connection()
+
+    results.put(('consumer', index, {
+        'latencies': getattr(client, 'latencies', []),
+        'last_received': getattr(client, 'last_received', None),
+        'usage': _usage(),
+    }))
+
+
+def _start(config, target, args):
+    if config.processes:
+        worker = multiprocessing.Process(target=target, args=args)
+    else:
+        worker = threading.Thread(target=target, args=args)
+        worker.daemon = True
+    worker.start()
+    return worker
+
+
+def _collect(results, kind, count, workers):
+    """
+    Wait for 'count' reports of 'kind' from the workers
+
+    Raises:
+        RuntimeError: If a worker exits without reporting
+    """
+    reports = {}
+    while len(reports) < count:
+        try:
+            report_kind, index, report = results.get(timeout=1)
+        except Queue.Empty:
+            if not all(worker.is_alive() for worker in workers):
+                raise RuntimeError("A benchmark {} exited without reporting".format(kind))
+            continue
+        if report_kind == kind:
+            reports[index] = report
+    return [reports[index] for index in sorted(reports)]
+
+
+def _stop_consumers(config):
+    """
+    Publish one stop marker per consumer of a work queue or RPC queue, or one for every subscriber of an exchange
+    """
+    client = _create_producer(config)
+    if config.pattern in (PATTERN_QUEUE, PATTERN_RPC):
+        client.publish_stop(QUEUE_NAME, count=config.consumers)
+    else:
+        client.publish_stop(_topic(config, 0))
+    client.close_connection()
+
+
+def _delete_queue(config):
+    """
+    Delete the queue shared by the consumers of a work queue or RPC benchmark, so runs do not leave it on the broker
+    """
+    if config.pattern in (PATTERN_QUEUE, PATTERN_RPC):
+        client = _create_producer(config)
+        client.delete_queue(QUEUE_NAME)
+        client.close_connection()
+
+
+def run(config):
+    """
+    Run a benchmark
+
+    Args:
+        config (argparse.Namespace): The options parsed by 'main'
+
+    Returns:
+        dict: The publish and delivery rates, latency percentiles in milliseconds, and per process usage
+    """
+    if config.broker == BROKER_MEMORY:
+        memory.default_broker.install()
+    elif config.broker == BROKER_RABBITMQ:
+        connection.set_connection_factory(None)
+
+    results = multiprocessing.Queue() if config.processes else Queue.Queue()
+    usage_before = _usage()
+
+    consumers = [_start(config, _consume, (config, index, results)) for index in xrange(config.consumers)]
+    _collect(results, 'ready', config.consumers, consumers)
+
+    start = time.time()
+    producers = [_start(config, _produce, (config, index, results)) for index in xrange(config.producers)]
+    produced = _collect(results, 'producer', config.producers, producers)
+    published_elapsed = time.time() - start
+
+    _stop_consumers(config)
+    consumed = _collect(results, 'consumer', config.consumers, consumers)
+
+    for worker in producers + consumers:
+        worker.join()
+    _delete_queue(config)
+
+    if config.pattern == PATTERN_RPC:
+        latencies = sorted(latency for report in produced for latency in report['latencies'])
+        delivered_elapsed = published_elapsed
+    else:
+        latencies = sorted(latency for report in consumed for latency in report['latencies'])
+        last_received = max([report['last_received'] for report in consumed if report['last_received']] or [start])
+        delivered_elapsed = last_received - start
+
+    published = sum(report['messages'] for report in produced)
+    if config.processes:
+        usage = [('producer {}'.format(index), report['usage']) for index, report in enumerate(produced)]
+        usage += [('consumer {}'.format(index), report['usage']) for index, report in enumerate(consumed)]
+    else:
+        cpu, rss = _usage()
+        usage = [('benchmark', (cpu - usage_before[0], rss))]
+
+    return {
+        'published': published,
+        'published_per_second': published / published_elapsed if published_elapsed else None,
+        'delivered': len(latencies),
+        'delivered_per_second': len(latencies) / delivered_elapsed if delivered_elapsed > 0 else None,
+        'latency_ms': dict((fraction, _milliseconds(percentile(latencies, fraction))) for fraction in PERCENTILES),
+        'max_latency_ms': _milliseconds(latencies[-1] if latencies else None),
+        'usage': usage,
+    }
+
+
+def _milliseconds(microseconds):
+    return microseconds / 1000.0 if microseconds is not None else None
+
+
+def report(config, results):
+    """
+    Format the results of 'run' for the terminal
+
+    Returns:
+        str: The report
+    """
+    lines = [
+        "pattern={} messages={}x{} size={} consumers={} prefetch={} ack={}".format(
+            config.pattern, config.producers, config.messages, config.size, config.consumers,
+            config.prefetch, config.ack),
+        "published    {:>10} msgs  {:>12.1f} msgs/sec".format(results['published'],
+                                                             results['published_per_second'] or 0),
+        "delivered    {:>10} msgs  {:>12.1f} msgs/sec".format(results['delivered'],
+                                                             results['delivered_per_second'] or 0),
+        "latency (ms) p50 {}  p99 {}  p999 {}  max {}".format(
+            *[_format_ms(results['latency_ms'][fraction]) for fraction in PERCENTILES] +
+            [_format_ms(results['max_latency_ms'])]
+        ),
+    ]
+    for name, (cpu, rss) in results['usage']:
+        lines.append("{:<12} cpu {:.2f}s  max rss {} KB".format(name, cpu, rss))
+    return '\n'.join(lines)
+
+
+def _format_ms(value):
+    return '-' if value is None else '{:.3f}'.format(value)
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m cottontail.bench', description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--pattern', choices=PATTERNS, default=PATTERN_QUEUE)
+    parser.add_argument('--broker', choices=(BROKER_MEMORY, BROKER_RABBITMQ), default=None,
+                        help="Broker to run against, defaults to RabbitMQ unless COTTONTAIL_BROKER=memory is set")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5672)
+    parser.add_argument('--messages', type=int, default=10000, help="Messages published by each producer")
+    parser.add_argument('--size', type=int, default=256, help="Body size in bytes")
+    parser.add_argument('--producers', type=int, default=1)
+    parser.add_argument('--consumers', type=int, default=1)
+    parser.add_argument('--prefetch', type=int, default=100, help="Prefetch count of each consumer, 0 for no limit")
+    parser.add_argument('--ack', choices=ACK_MODES, default=ACK_EACH)
+    parser.add_argument('--ack-batch-size', type=int, default=100, help="Acknowledgements per 'multiple' ack")
+    parser.add_argument('--ack-interval', type=int, default=None, help="Milliseconds before a partial batch is acked")
+    parser.add_argument('--processes', action='store_true', help="Run each producer and consumer in its own process")
+    config = parser.parse_args(argv)
+
+    in_memory = config.broker == BROKER_MEMORY or (
+        config.broker is None and os.environ.get(connection.BROKER_ENVIRONMENT_VARIABLE) == BROKER_MEMORY)
+    if config.processes and in_memory:
+        parser.error("--processes needs RabbitMQ, the in-process broker is not shared between processes")
+    if config.pattern == PATTERN_RPC and config.ack == ACK_NONE:
+        parser.error("RPC servers always acknowledge requests")
+    if config.ack == ACK_BATCH and 0 < config.prefetch < config.ack_batch_size and not config.ack_interval:
+        parser.error("--prefetch below --ack-batch-size stalls consumers unless --ack-interval is set")
+    return config
+
+
+def main(argv=None):
+    """
+    Run a benchmark from the command line and print its report
+    """
+    config = _parse_args(argv)
+    print report(config, run(config))
+
+
+if __name__ == '__main__':
+    main()
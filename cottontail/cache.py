@@ -0,0 +1,153 @@
+"""
+Caching the results of idempotent RPC functions.
+
+RPCClient and RPCServer take a ResultCache as 'cache'. A client answers repeated calls with the
+same encoded arguments from its cache without a round trip through the broker, and a server
+replies to repeated requests without calling '_execute_call' again. Only functions with a TTL
+are cached, so caching stays opt-in per function::
+
+    cache = ResultCache(max_size=10000, ttls={'fib': 3600, 'lookup': 30})
+    client = cottontail.RPCClient(cache=cache)
+"""
+import collections
+import threading
+import time
+
+DEFAULT_MAX_SIZE = 1024
+
+
+def freeze(value):
+    """
+    Convert decoded call arguments into a hashable value that is equal only for arguments of equal
+    types and values, turning lists into tuples and dicts and sets into sorted tuples. Each value
+    is tagged with its type, so that True, 1 and 1.0, or a dict and a tuple of its items, differ.
+
+    Args:
+        value (object): The arguments
+
+    Returns:
+        object: The hashable equivalent
+
+    Raises:
+        TypeError: If the arguments contain an unhashable value of another type
+    """
+    kind = type(value).__name__
+    if isinstance(value, dict):
+        return kind, tuple(sorted((freeze(key), freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return kind, tuple(freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return kind, tuple(sorted(freeze(item) for item in value))
+    hash(value)
+    return kind, value
+
+
+class ResultCache(object):
+    """
+    A thread-safe, size-bounded cache of function results, evicting the least recently used
+    result once full and expiring results after the TTL of their function.
+
+    Args:
+        max_size (int, optional): Most results held, defaults to 1024.
+        ttl (float, optional): Seconds results of functions without their own TTL are cached for,
+            defaults to None to cache only the functions in 'ttls'.
+        ttls (dict, optional): Seconds results are cached for by function name, defaults to None.
+
+    Attributes:
+        max_size (int): Most results held.
+        ttl (float): Seconds results of functions without their own TTL are cached for, or None.
+        ttls (dict): Seconds results are cached for by function name.
+        hits (int): Lookups answered from the cache.
+        misses (int): Lookups of cacheable functions not answered from the cache.
+        evictions (int): Results dropped to stay within 'max_size'.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=None, ttls=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def ttl_for(self, function):
+        """
+        Args:
+            function (str): The name of a function
+
+        Returns:
+            float: Seconds the function's results are cached for, or None if they are not cached
+        """
+        return self.ttls.get(function, self.ttl) or None
+
+    def get(self, function, key):
+        """
+        Look up the result of a call
+
+        Args:
+            function (str): The name of the function
+            key (object): The hashable arguments of the call
+
+        Returns:
+            tuple: True and the result if it is cached, otherwise False and None
+        """
+        if self.ttl_for(function) is None:
+            return False, None
+
+        with self._lock:
+            entry = self._results.pop((function, key), None)
+            if entry is None or entry[0] <= time.time():
+                self.misses += 1
+                return False, None
+
+            # Reinsert to mark the result as the most recently used
+            self._results[(function, key)] = entry
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, function, key, result):
+        """
+        Cache the result of a call if its function has a TTL
+
+        Args:
+            function (str): The name of the function
+            key (object): The hashable arguments of the call
+            result (object): The result
+        """
+        ttl = self.ttl_for(function)
+        if ttl is None:
+            return
+
+        with self._lock:
+            self._results.pop((function, key), None)
+            self._results[(function, key)] = (time.time() + ttl, result)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, function=None):
+        """
+        Drop cached results
+
+        Args:
+            function (str, optional): The function whose results to drop, defaults to None for all of them.
+        """
+        with self._lock:
+            if function is None:
+                self._results.clear()
+                return
+            for cached in [cached for cached in self._results if cached[0] == function]:
+                del self._results[cached]
+
+    def stats(self):
+        """
+        Returns:
+            dict: The hit, miss and eviction counters and the number of cached results
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._results)}
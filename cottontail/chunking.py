@@ -0,0 +1,399 @@
+"""
+Streaming large messages as sequences of chunk messages, and reassembling them.
+
+'CottontailBase.publish_stream' splits a file or iterator into chunks of a fixed size, each
+published as its own message carrying the stream id, the chunk's sequence number and the chunk
+size in its headers, with the number of chunks on the last one. Consumers mix in StreamConsumer
+to have the chunks written to a spooled temporary file at their offsets as they arrive, in any
+order, and receive the reassembled body in '_on_stream'::
+
+    class ArtifactWorker(StreamConsumer, cottontail.QueueWorker):
+        def _on_stream(self, basic_deliver, properties, stream):
+            for chunk in stream:
+                archive.write(chunk)
+
+    worker = ArtifactWorker(prefetch_count=0)
+    worker.subscribe('artifacts')
+
+Memory stays bounded on both sides: the publisher holds one chunk at a time, and each transfer
+is held in memory only up to 'spool_size' bytes before it rolls over to disk. Chunks are
+acknowledged together once '_on_stream' has handled their message, so an interrupted transfer
+is redelivered in full, and transfers without a new chunk for 'stream_timeout' seconds are
+discarded. Every chunk of a message must reach the same consumer, so stream consumers consume
+their queues exclusively, and their prefetch must leave room for the chunks of a whole message.
+"""
+import tempfile
+import time
+import uuid
+
+from serialization import to_bytes
+
+STREAM_ID_HEADER = 'cottontail-stream-id'
+CHUNK_INDEX_HEADER = 'cottontail-chunk'
+CHUNK_SIZE_HEADER = 'cottontail-chunk-size'
+CHUNK_COUNT_HEADER = 'cottontail-chunks'
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_SPOOL_SIZE = 8 * 1024 * 1024
+DEFAULT_STREAM_TIMEOUT = 300
+
+
+def new_stream_id():
+    return uuid.uuid4().hex
+
+
+def is_chunk(properties):
+    """
+    Args:
+        properties (pika.spec.BasicProperties): The properties of a message
+
+    Returns:
+        bool: True if the message is a chunk of a streamed message
+    """
+    return bool(properties.headers) and STREAM_ID_HEADER in properties.headers
+
+
+def iter_chunks(source, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Split a file or an iterator of byte strings into chunks of 'chunk_size' bytes, the last
+    of which may be shorter. Only one chunk is held at a time.
+
+    Args:
+        source (file or iterable): A file-like object, read from its current position, or an iterable of byte strings
+        chunk_size (int, optional): Size in bytes of each chunk, defaults to 1 MB.
+
+    Returns:
+        generator: The chunks as byte strings, at least one even for an empty source
+    """
+    if hasattr(source, 'read'):
+        pieces = iter(lambda: source.read(chunk_size), '')
+    else:
+        pieces = (to_bytes(piece) for piece in source)
+
+    pending = []
+    pending_size = 0
+    sent = False
+    for piece in pieces:
+        offset = 0
+        while offset < len(piece):
+            taken = piece[offset:offset + chunk_size - pending_size]
+            offset += len(taken)
+            pending.append(taken)
+            pending_size += len(taken)
+            if pending_size == chunk_size:
+                yield ''.join(pending)
+                sent = True
+                pending = []
+                pending_size = 0
+
+    if pending or not sent:
+        yield ''.join(pending)
+
+
+def chunk_headers(stream_id, index, chunk_size, count=None):
+    """
+    Build the headers of one chunk of a streamed message
+
+    Args:
+        stream_id (str): The id shared by the chunks of the message
+        index (int): The sequence number of the chunk, from 0
+        chunk_size (int): Size in bytes of every chunk but the last
+        count (int, optional): The number of chunks, set on the last one, defaults to None.
+
+    Returns:
+        dict: The headers
+    """
+    headers = {STREAM_ID_HEADER: stream_id, CHUNK_INDEX_HEADER: index, CHUNK_SIZE_HEADER: chunk_size}
+    if count is not None:
+        headers[CHUNK_COUNT_HEADER] = count
+    return headers
+
+
+class Stream(object):
+    """
+    A message reassembled from its chunks, backed by a spooled temporary file positioned at its start.
+    Iterating over it reads the body one chunk at a time.
+
+    Attributes:
+        stream_id (str): The id shared by the chunks of the message.
+        size (int): Size of the body in bytes.
+        file (tempfile.SpooledTemporaryFile): The body.
+        delivery_tags (list): Delivery tags of the chunks received, to acknowledge once the message is handled.
+    """
+
+    def __init__(self, stream_id, spool_size):
+        self.stream_id = stream_id
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.delivery_tags = []
+
+        self._chunk_size = None
+        self._count = None
+        self._received = set()
+        self._updated = time.time()
+
+    def __iter__(self):
+        return iter(lambda: self.file.read(self._chunk_size), '')
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def complete(self):
+        return self._count is not None and len(self._received) == self._count
+
+    def _write(self, headers, body, delivery_tag=None):
+        """
+        Write a chunk at its offset in the body, ignoring chunks already received.
+        """
+        index = headers[CHUNK_INDEX_HEADER]
+        self._updated = time.time()
+        if delivery_tag is not None:
+            self.delivery_tags.append(delivery_tag)
+        if index in self._received:
+            return
+
+        self._chunk_size = headers[CHUNK_SIZE_HEADER]
+        if CHUNK_COUNT_HEADER in headers:
+            self._count = headers[CHUNK_COUNT_HEADER]
+
+        self.file.seek(index * self._chunk_size)
+        self.file.write(to_bytes(body))
+        self.size = max(self.size, index * self._chunk_size + len(body))
+        self._received.add(index)
+
+
+class Reassembler(object):
+    """
+    Reassemble streamed messages from their chunks, which may arrive in any order and interleaved
+    with the chunks of other streams.
+
+    Args:
+        timeout (float, optional): Seconds without a new chunk after which a transfer is discarded, defaults to 300.
+        spool_size (int, optional): Bytes of each transfer held in memory before it is spooled to disk,
+            defaults to 8 MB.
+
+    Attributes:
+        timeout (float): Seconds without a new chunk after which a transfer is discarded.
+        spool_size (int): Bytes of each transfer held in memory before it is spooled to disk.
+    """
+
+    def __init__(self, timeout=DEFAULT_STREAM_TIMEOUT, spool_size=DEFAULT_SPOOL_SIZE):
+        self.timeout = timeout
+        self.spool_size = spool_size
+        self._streams = {}
+
+    def __len__(self):
+        return len(self._streams)
+
+    def add(self, headers, body, delivery_tag=None):
+        """
+        Add a chunk to its transfer
+
+        Args:
+            headers (dict): The headers of the chunk message
+            body (str): The body of the chunk message
+            delivery_tag (int, optional): The delivery tag of the chunk message, if it is to be acknowledged,
+                defaults to None.
+
+        Returns:
+            Stream: The reassembled message if this chunk completed it, positioned at its start, otherwise None
+        """
+        stream_id = headers[STREAM_ID_HEADER]
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            stream = self._streams[stream_id] = Stream(stream_id, self.spool_size)
+
+        stream._write(headers, body, delivery_tag)
+        if not stream.complete:
+            return None
+
+        del self._streams[stream_id]
+        stream.file.seek(0)
+        return stream
+
+    def expire(self):
+        """
+        Discard the transfers that have had no new chunk for 'timeout' seconds
+
+        Returns:
+            list: The discarded streams, closed
+        """
+        deadline = time.time() - self.timeout
+        expired = [stream_id for stream_id, stream in self._streams.items() if stream._updated <= deadline]
+        streams = [self._streams.pop(stream_id) for stream_id in expired]
+        for stream in streams:
+            stream.close()
+        return streams
+
+    def next_expiry(self):
+        """
+        Returns:
+            float: The time the transfer that has waited longest for a chunk expires at, or None if there is none
+        """
+        if not self._streams:
+            return None
+        return min(stream._updated for stream in self._streams.values()) + self.timeout
+
+    def clear(self):
+        """
+        Discard every transfer
+        """
+        for stream in self._streams.values():
+            stream.close()
+        self._streams.clear()
+
+    def oldest_delivery_tag(self):
+        """
+        Returns:
+            int: The lowest delivery tag of the chunks of incomplete transfers, or None if there is none
+        """
+        tags = [min(stream.delivery_tags) for stream in self._streams.values() if stream.delivery_tags]
+        return min(tags) if tags else None
+
+
+class StreamConsumer(object):
+    """
+    Mixin for consumer classes, reassembling streamed messages and handing each to '_on_stream'.
+    Other messages are handled by '_on_message' as usual.
+
+    The chunks of a message stay unacknowledged until '_on_stream' returns, then are acknowledged
+    together, with a single 'multiple' ack unless that would cover a chunk of another transfer. If
+    '_on_stream' raises, the other chunks are rejected and requeued, and the chunk that completed
+    the message fails as any delivery whose handler raises does. Transfers are discarded once they
+    have had no new chunk for 'stream_timeout' seconds, checked by a timeout on the connection while
+    any is pending, and their chunks are rejected without requeueing. A reconnection discards every
+    transfer, as the broker redelivers its chunks.
+
+    Every chunk of a message must reach the same consumer, so queues are consumed exclusively and a
+    second consumer is refused. The prefetch_count of the channel must be 0, or at least the chunk
+    count of the largest message, or transfers stall once the prefetch is used up.
+
+    Attributes:
+        stream_timeout (float): Seconds without a new chunk after which a transfer is discarded, default 300.
+        stream_spool_size (int): Bytes of each transfer held in memory before it is spooled to disk, default 8 MB.
+    """
+    stream_timeout = DEFAULT_STREAM_TIMEOUT
+    stream_spool_size = DEFAULT_SPOOL_SIZE
+    exclusive_consumer = True
+    _reassembler = None
+    _expiry_timeout = None
+
+    def _on_message(self, channel, basic_deliver, properties, body):
+        """
+        Spool a chunk, then hand the message to '_on_stream' once all its chunks have arrived and
+        acknowledge them.
+        """
+        if not is_chunk(properties):
+            return super(StreamConsumer, self)._on_message(channel, basic_deliver, properties, body)
+
+        if self._reassembler is None:
+            self._reassembler = Reassembler(self.stream_timeout, self.stream_spool_size)
+
+        self._expire_streams()
+
+        acknowledged = basic_deliver.consumer_tag not in self._no_ack_consumers
+        stream = self._reassembler.add(properties.headers, body, basic_deliver.delivery_tag if acknowledged else None)
+        if stream is None:
+            self._schedule_expiry()
+            return
+
+        try:
+            self._on_stream(basic_deliver, properties, stream)
+        except Exception:
+            self._reject_chunks([tag for tag in stream.delivery_tags if tag != basic_deliver.delivery_tag],
+                                requeue=True)
+            raise
+        finally:
+            stream.close()
+
+        self._ack_chunks(stream.delivery_tags)
+
+    def _expire_streams(self):
+        """
+        Discard the transfers that have had no new chunk for 'stream_timeout' seconds, rejecting their chunks
+        """
+        for expired in self._reassembler.expire():
+            self.logger.warn("Discarded the incomplete streamed message: %s", expired.stream_id)
+            self._reject_chunks(expired.delivery_tags, requeue=False)
+
+    def _schedule_expiry(self):
+        """
+        Expire the pending transfers when the oldest of them times out, unless a timeout is already pending
+        """
+        expires_at = self._reassembler.next_expiry()
+        if self._expiry_timeout is None and expires_at is not None:
+            self._expiry_timeout = self._connection.add_timeout(max(expires_at - time.time(), 0),
+                                                                self._on_expiry_timeout)
+
+    def _on_expiry_timeout(self):
+        """
+        Invoked by the connection when the oldest pending transfer times out.
+        """
+        self._expiry_timeout = None
+        self._expire_streams()
+        self._schedule_expiry()
+
+    def _ack_chunks(self, tags):
+        """
+        Acknowledge the chunks of a handled message
+        """
+        if not tags:
+            return
+
+        if self._coalescing_acks:
+            for tag in tags:
+                self.acknowledge(tag)
+            return
+
+        # A 'multiple' ack covers every earlier delivery, including the chunks of other transfers
+        last_tag = max(tags)
+        oldest_tag = self._reassembler.oldest_delivery_tag()
+        if oldest_tag is not None and oldest_tag < last_tag:
+            for tag in sorted(tags):
+                self.acknowledge(tag)
+            return
+
+        self.logger.debug('Acknowledging %s chunks up to: %s', len(tags), last_tag)
+        self._channel.basic_ack(last_tag, multiple=True)
+        if self.metrics is not None:
+            self.metrics.counter('cottontail_acked_total').inc(len(tags))
+
+    def _reject_chunks(self, tags, requeue):
+        """
+        Reject the chunks of a message, after sending the coalesced acks before them so that no
+        'multiple' ack can cover them
+        """
+        if not tags:
+            return
+
+        if self._coalescing_acks:
+            self.flush_acks()
+        for tag in sorted(tags):
+            if tag in self._delivered:
+                self._delivered.remove(tag)
+            self._channel.basic_reject(tag, requeue=requeue)
+
+        if requeue and self.metrics is not None:
+            self.metrics.counter('cottontail_requeued_total').inc(len(tags))
+
+    def _replay_topology(self):
+        if self._reassembler is not None:
+            self._reassembler.clear()
+        # Timeouts do not outlive their connection
+        self._expiry_timeout = None
+        return super(StreamConsumer, self)._replay_topology()
+
+    def _on_stream(self, basic_deliver, properties, stream):
+        """
+        Default callback for a reassembled streamed message. Override this to handle the message.
+
+        Args:
+            basic_deliver (pika.Spec.Basic.Deliver): The basic_deliver object of the last chunk to arrive
+            properties (pika.Spec.BasicProperties): The properties of the last chunk to arrive
+            stream (Stream): The message, iterable in chunks or readable as a file, closed once this returns
+        """
+        self.logger.debug('Received streamed message %s of %s bytes', stream.stream_id, stream.size)
@@ -0,0 +1,31 @@
+"""
+The 'cottontail' command, running one of its subcommands::
+
+    cottontail worker queue_test --exchange queue --max-workers 8
+    cottontail bench --pattern queue --consumers 4
+"""
+import sys
+
+from cottontail import bench, worker
+
+COMMANDS = {
+    'bench': bench.main,
+    'worker': worker.main,
+}
+
+
+def main(argv=None):
+    """
+    Run a subcommand from the command line
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if not argv or argv[0] not in COMMANDS:
+        sys.exit("usage: cottontail {{{}}} ...".format(','.join(sorted(COMMANDS))))
+
+    COMMANDS[argv[0]](argv[1:])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Compressors for message bodies, identified by the AMQP 'content_encoding' property.
+
+Publishers with a compressor compress bodies at or above their compression threshold and
+set 'content_encoding' on the message. Consumers inflate any message whose
+'content_encoding' has a registered compressor, so compressed and uncompressed publishers
+can share an exchange.
+"""
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+import errors
+
+DEFAULT_THRESHOLD = 1024
+
+
+class Compressor(object):
+    """
+    Base class for message body compressors.
+
+    Attributes:
+        encoding (str): The name set as the 'content_encoding' of compressed messages.
+    """
+    encoding = None
+
+    def compress(self, body):
+        """
+        Args:
+            body (str): The message body to compress
+
+        Returns:
+            str: The compressed body
+        """
+        raise NotImplementedError
+
+    def decompress(self, body):
+        """
+        Args:
+            body (str): The compressed message body
+
+        Returns:
+            str: The original body
+        """
+        raise NotImplementedError
+
+
+class ZlibCompressor(Compressor):
+    """
+    Compresses with zlib, a fast general purpose choice.
+
+    Args:
+        level (int, optional): Compression level from 1 (fastest) to 9 (smallest), defaults to 6.
+    """
+    encoding = 'deflate'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, body):
+        return zlib.compress(body, self.level)
+
+    def decompress(self, body):
+        return zlib.decompress(body)
+
+
+class LzmaCompressor(Compressor):
+    """
+    Compresses with LZMA, smaller than zlib but slower. Requires the 'lzma' module,
+    or the 'backports.lzma' package on Python 2.
+
+    Args:
+        preset (int, optional): Compression preset from 0 (fastest) to 9 (smallest), defaults to 6.
+
+    Raises:
+        CottontailError: If no lzma module is available.
+    """
+    encoding = 'xz'
+
+    def __init__(self, preset=6):
+        if lzma is None:
+            raise errors.CottontailError("The 'lzma' module is required for the xz compressor", errors.INVALID)
+        self.preset = preset
+
+    def compress(self, body):
+        return lzma.compress(body, preset=self.preset)
+
+    def decompress(self, body):
+        return lzma.decompress(body)
+
+
+_compressors = {}
+
+
+def register(compressor):
+    """
+    Register a compressor for messages of its content_encoding
+
+    Args:
+        compressor (Compressor): The compressor to register, replacing any registered for the same encoding
+    """
+    _compressors[compressor.encoding] = compressor
+
+
+def get_compressor(encoding):
+    """
+    Args:
+        encoding (str): The content_encoding of a message
+
+    Returns:
+        Compressor: The registered compressor, or None if there is none for 'encoding'
+    """
+    return _compressors.get(encoding)
+
+
+def resolve_compressor(compressor):
+    """
+    Args:
+        compressor (Compressor or str): A compressor, or the encoding of a registered compressor
+
+    Returns:
+        Compressor: The compressor to use, or None if 'compressor' is None
+
+    Raises:
+        CottontailError: If no compressor is registered for the given encoding
+    """
+    if compressor is None or isinstance(compressor, Compressor):
+        return compressor
+
+    registered = get_compressor(compressor)
+    if registered is None:
+        raise errors.CottontailError("No compressor is registered for encoding '{}'".format(compressor), errors.INVALID)
+    return registered
+
+
+register(ZlibCompressor())
+if lzma is not None:
+    register(LzmaCompressor())
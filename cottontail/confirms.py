@@ -0,0 +1,141 @@
+from pika import spec
+from pika.adapters.blocking_connection import BlockingChannel
+from pika.channel import Channel
+
+DEFAULT_WINDOW = 1000
+
+
+class PublishBatch(object):
+    """
+    A context manager for publishing a batch of messages with publisher confirms.
+
+    Messages are published on a dedicated channel in confirm mode. Up to 'window'
+    messages may be unconfirmed at once, so the broker round-trip is pipelined
+    rather than paid for each message.
+
+    Example::
+
+        with client.batch(window=500) as batch:
+            for n in xrange(10000):
+                batch.publish('test', str(n))
+        failed = [n for n, acked in enumerate(batch.results) if not acked]
+
+    Args:
+        client (CottontailBase): The client whose connection and exchange are used for publishing.
+        window (int, optional): Maximum number of unconfirmed messages in flight, defaults to 1000.
+
+    Attributes:
+        window (int): Maximum number of unconfirmed messages in flight.
+        results (list): One entry per published message, in publish order. True if the broker
+            acked the message, False if it was nacked, and None if no confirm has arrived yet.
+    """
+
+    def __init__(self, client, window=DEFAULT_WINDOW):
+        if window < 1:
+            raise ValueError("The confirm window must be at least 1.")
+
+        self.client = client
+        self.window = window
+        self.results = []
+
+        self._channel = None
+        self._delivery_tag = 0
+        self._unconfirmed = {}
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.close()
+
+    def open(self):
+        """
+        Open a channel on the client's connection and put it into confirm mode.
+        """
+        self._channel = self.client._connection.channel()
+
+        # BlockingChannel.confirm_delivery makes every basic_publish wait for its own
+        # confirm, so register through the asynchronous Channel implementation instead.
+        if isinstance(self._channel, BlockingChannel):
+            Channel.confirm_delivery(self._channel, self._on_delivery_confirmation)
+        else:
+            self._channel.confirm_delivery(self._on_delivery_confirmation)
+
+    def publish(self, topic, content, headers=None, priority=None, expiration=None):
+        """
+        Publish a message without waiting for its confirm, blocking only while the window is full.
+
+        Args:
+            topic (str): The topic of the message, to be read by subscribers of that topic.
+            content (str): The contents of the message to be sent
+            headers (dict, optional): Application headers of the message, defaults to None.
+            priority (int, optional): Priority of the message, defaults to None.
+            expiration (int, optional): Milliseconds after which the message expires, defaults to None.
+
+        Returns:
+            int: The index of this message in 'results'
+        """
+        body, properties = self.client._prepare_message(topic, content, headers, priority, expiration)
+
+        while len(self._unconfirmed) >= self.window:
+            self.client._connection.process_data_events()
+
+        self._channel.basic_publish(
+            exchange=self.client.exchange_name,
+            routing_key=topic,
+            body=body,
+            properties=properties,
+        )
+        self.client._record_publish(topic, content, body)
+
+        index = len(self.results)
+        self.results.append(None)
+        self._delivery_tag += 1
+        self._unconfirmed[self._delivery_tag] = index
+
+        return index
+
+    def flush(self):
+        """
+        Block until every published message has been acked or nacked by the broker.
+
+        Returns:
+            list: The per-message results
+        """
+        while self._unconfirmed:
+            self.client._connection.process_data_events()
+
+        return self.results
+
+    def close(self):
+        """
+        Close the confirm channel. Messages still unconfirmed keep a result of None.
+        """
+        if self._channel is not None and self._channel.is_open:
+            self._channel.close()
+        self._channel = None
+
+    def _on_delivery_confirmation(self, method_frame):
+        """
+        Invoked by pika when RabbitMQ sends a Basic.Ack or Basic.Nack for published messages.
+
+        Args:
+            method_frame (pika.frame.Method): The Basic.Ack or Basic.Nack frame
+        """
+        acked = isinstance(method_frame.method, spec.Basic.Ack)
+        delivery_tag = method_frame.method.delivery_tag
+
+        if method_frame.method.multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+
+        for tag in tags:
+            index = self._unconfirmed.pop(tag, None)
+            if index is not None:
+                self.results[index] = acked
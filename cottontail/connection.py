@@ -0,0 +1,158 @@
+"""
+Opening the connections clients and connection pools use.
+
+By default a connection is a pika.BlockingConnection to RabbitMQ, or for the asyncio clients
+in 'aio' an aio.AsyncioConnection. Setting the COTTONTAIL_BROKER environment variable to
+'memory', or installing a memory.MemoryBroker, connects every client to an in-process broker
+instead, so clients and examples run unchanged without a RabbitMQ server::
+
+    COTTONTAIL_BROKER=memory python -m cottontail.examples.queue.server
+
+Exchanges and named, non-exclusive queues that clients declare are remembered for the rest of
+the process, by broker, so later clients skip declaring them again. Declarations are forgotten
+when a client reconnects, when a queue is deleted through a client, and when the connection
+factory changes. Exclusive queues and bindings are remembered by connection instead, for as long
+as the connection exists, so clients sharing a pooled connection declare them once between them.
+"""
+import os
+import weakref
+
+import pika
+
+BROKER_ENVIRONMENT_VARIABLE = 'COTTONTAIL_BROKER'
+BROKER_MEMORY = u'memory'
+
+_connection_factory = None
+_async_connection_factory = None
+
+# (broker, declaration) pairs of what this process has declared
+_declared = set()
+
+# The declarations made on each open connection
+_declared_on = weakref.WeakKeyDictionary()
+
+
+def set_connection_factory(factory, async_factory=None):
+    """
+    Set how connections are opened
+
+    Args:
+        factory (callable): Called with pika.ConnectionParameters to open a connection,
+            or None to restore the default.
+        async_factory (callable, optional): Called with the arguments of 'connect_async' to open a connection
+            driven by an event loop, defaults to None for the default.
+    """
+    global _connection_factory, _async_connection_factory
+    _connection_factory = factory
+    _async_connection_factory = async_factory
+    forget_declared()
+
+
+def connect(parameters):
+    """
+    Open a blocking connection
+
+    Args:
+        parameters (pika.ConnectionParameters): Parameters of the connection to open
+
+    Returns:
+        pika.BlockingConnection: The connection, or a memory.MemoryConnection to the in-process broker
+    """
+    if _connection_factory is not None:
+        return _connection_factory(parameters)
+
+    if os.environ.get(BROKER_ENVIRONMENT_VARIABLE) == BROKER_MEMORY:
+        import memory
+        return memory.default_broker.connect(parameters)
+
+    return pika.BlockingConnection(parameters)
+
+
+def connect_async(parameters, loop, on_open_callback=None, on_open_error_callback=None, on_close_callback=None):
+    """
+    Open a connection driven by an asyncio event loop, reporting its opening and closing through callbacks
+
+    Args:
+        parameters (pika.ConnectionParameters): Parameters of the connection to open
+        loop (asyncio.AbstractEventLoop): The event loop to run the connection on
+        on_open_callback (callable, optional): Called with the connection once it is open
+        on_open_error_callback (callable, optional): Called with the connection and error if it can't be opened
+        on_close_callback (callable, optional): Called with the connection, reply code and reply text on close
+
+    Returns:
+        aio.AsyncioConnection: The connection, or a memory.AsyncMemoryConnection to the in-process broker
+    """
+    if _async_connection_factory is not None:
+        return _async_connection_factory(parameters, loop, on_open_callback, on_open_error_callback,
+                                         on_close_callback)
+
+    if os.environ.get(BROKER_ENVIRONMENT_VARIABLE) == BROKER_MEMORY:
+        import memory
+        return memory.default_broker.connect_async(parameters, loop, on_open_callback, on_open_error_callback,
+                                                   on_close_callback)
+
+    import aio
+    return aio.AsyncioConnection(parameters, on_open_callback, on_open_error_callback, on_close_callback, loop)
+
+
+def _broker(parameters):
+    return parameters.host, parameters.port, parameters.virtual_host
+
+
+def is_declared(parameters, declaration):
+    """
+    Args:
+        parameters (pika.ConnectionParameters): Parameters of the broker
+        declaration (tuple): The kind of object, its name, and the arguments it was declared with,
+            e.g. ('exchange', 'events', 'topic')
+
+    Returns:
+        bool: True if this process already declared the object on the broker
+    """
+    return (_broker(parameters), declaration) in _declared
+
+
+def remember_declared(parameters, declaration):
+    """
+    Remember that an object was declared on a broker, so it is not declared again
+
+    Args:
+        parameters (pika.ConnectionParameters): Parameters of the broker
+        declaration (tuple): The kind of object, its name, and the arguments it was declared with
+    """
+    _declared.add((_broker(parameters), declaration))
+
+
+def declared_on(connection):
+    """
+    Args:
+        connection (pika.BlockingConnection): An open connection
+
+    Returns:
+        set: The declarations made on the connection, which clients using it add to and remove from
+    """
+    declared = _declared_on.get(connection)
+    if declared is None:
+        declared = _declared_on[connection] = set()
+    return declared
+
+
+def forget_declared(parameters=None, kind=None, name=None):
+    """
+    Forget declarations, so the objects are declared again when next used
+
+    Args:
+        parameters (pika.ConnectionParameters, optional): Parameters of the broker, defaults to None for every broker.
+        kind (str, optional): The kind of objects to forget, e.g. 'queue', defaults to None for every kind.
+        name (str, optional): The name of the object to forget, defaults to None for every name.
+    """
+    broker = _broker(parameters) if parameters is not None else None
+    for declared in list(_declared):
+        declared_broker, declaration = declared
+        if broker is not None and declared_broker != broker:
+            continue
+        if kind is not None and declaration[0] != kind:
+            continue
+        if name is not None and declaration[1] != name:
+            continue
+        _declared.discard(declared)
@@ -38,6 +38,8 @@ class CottontailError(CottontailBaseError):
 
 UNKNOWN = 0
 INVALID = 1
+TIMEOUT = 2
+UNAVAILABLE = 3
 
 __all__ = [
      u'CottontailBaseError',
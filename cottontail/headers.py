@@ -0,0 +1,140 @@
+import errors
+from base import CottontailBase, EXCHANGE_HEADERS
+
+MATCH_ALL = u'all'
+MATCH_ANY = u'any'
+MATCH_TYPES = {MATCH_ALL, MATCH_ANY}
+
+
+def compile_filter(spec, match=MATCH_ALL):
+    """
+    Compile a header filter into a predicate on the headers of a message, for routing a headers
+    exchange cannot express. Each value of 'spec' is a callable testing the header value, a set,
+    list or tuple of accepted values, or a value the header must equal. A header missing from a
+    message fails its test.
+
+    Example::
+
+        accept = compile_filter({'region': ('eu', 'us'), 'size': lambda size: size > 1024})
+
+    Args:
+        spec (dict or callable): The tests by header name, or a predicate, which is returned unchanged
+        match (str, optional): Whether 'all' or 'any' of the tests must pass, defaults to 'all'.
+
+    Returns:
+        callable: Called with a dict of headers, returning True if the message is accepted
+
+    Raises:
+        CottontailError: If 'match' is not 'all' or 'any'
+    """
+    if callable(spec):
+        return spec
+    if match not in MATCH_TYPES:
+        raise errors.CottontailError("Invalid header match: '{}'".format(match), errors.INVALID)
+
+    tests = tuple((name, _compile_test(expected)) for name, expected in spec.items())
+    combine = any if match == MATCH_ANY else all
+
+    def predicate(headers):
+        return combine(name in headers and test(headers[name]) for name, test in tests)
+    return predicate
+
+
+def _compile_test(expected):
+    """
+    Compile the expected value of one header into a test of the header's value.
+    """
+    if callable(expected):
+        return expected
+    if isinstance(expected, (set, frozenset, list, tuple)):
+        return frozenset(expected).__contains__
+    return lambda value: value == expected
+
+
+class HeadersBase(CottontailBase):
+    """
+    A service base class for implementing messaging patterns routed by message headers using the RabbitMQ library.
+    """
+    exchange_type = EXCHANGE_HEADERS
+
+
+class HeadersPublisher(HeadersBase):
+    """
+    A server class for publishing messages routed by their headers::
+
+        publisher = cottontail.HeadersPublisher('events')
+        publisher.publish('order', 'created', headers={'region': 'eu', 'kind': 'order'})
+
+    Overwritten methods:
+        _bind_to_queue: Not necessary for a headers publisher, only a subscriber
+    """
+
+    def _bind_to_queue(self, queue, topic, arguments=None):
+        pass
+
+
+class HeadersSubscriber(HeadersBase):
+    """
+    A worker class for consuming messages whose headers match a binding.
+
+    The broker only matches header values for equality, so a 'header_filter' can further test
+    the headers of each delivery on the client. Deliveries it rejects are acknowledged without
+    being handled::
+
+        subscriber = cottontail.HeadersSubscriber('events', header_filter={'size': lambda size: size > 1024})
+        subscriber.subscribe(headers={'region': 'eu', 'kind': 'order'}, match=cottontail.MATCH_ALL)
+        subscriber.listen()
+
+    Args:
+        header_filter (dict or callable, optional): Filter compiled by 'compile_filter', or a predicate on the
+            headers of a message, defaults to None.
+
+    Attributes:
+        header_filter (callable): Predicate on the headers of a delivery, which is handled only if it returns True, or None.
+    """
+    header_filter = None
+
+    def __init__(self, exchange_name='', header_filter=None, **kw):
+        if header_filter is not None:
+            self.header_filter = compile_filter(header_filter)
+        super(HeadersSubscriber, self).__init__(exchange_name, **kw)
+
+    def subscribe(self, queue_name=None, headers=None, match=MATCH_ALL, acknowledge=True, exclusive=False):
+        """
+        Subscribe to the messages whose headers match
+
+        Args:
+            queue_name (basestring, optional): The name of the queue to subscribe to, defaults to None.
+            headers (dict, optional): The header values to match messages by, defaults to None to match every message.
+            match (str, optional): Whether 'all' or 'any' of the headers must match, defaults to 'all'.
+            acknowledge (bool, optional): Whether to send an 'ack' message back to the producer upon message receipt, default is True.
+            exclusive (bool, optional): Declare the queue as exclusive to this connection, default is False.
+
+        Returns:
+            basestring: The name of the queue
+
+        Raises:
+            CottontailError: If 'match' is not 'all' or 'any'
+        """
+        if match not in MATCH_TYPES:
+            raise errors.CottontailError("Invalid header match: '{}'".format(match), errors.INVALID)
+
+        queue = self.declare_queue(queue_name, exclusive=exclusive)
+
+        arguments = dict(headers or {})
+        arguments['x-match'] = match
+        self._bind_to_queue(queue, None, arguments)
+
+        return self._consume(queue, acknowledge)
+
+    def _handle_delivery(self, channel, basic_deliver, properties, body):
+        """
+        Acknowledge and drop a delivery rejected by the header filter, before its body is decoded.
+        """
+        if self.header_filter is not None and not self.header_filter(properties.headers or {}):
+            self.logger.debug('Filtered out message: %s', basic_deliver.delivery_tag)
+            if basic_deliver.consumer_tag not in self._no_ack_consumers:
+                self._channel.basic_ack(basic_deliver.delivery_tag)
+            return
+
+        return super(HeadersSubscriber, self)._handle_delivery(channel, basic_deliver, properties, body)
@@ -0,0 +1,1271 @@
+"""
+An in-process message broker, for running clients without a RabbitMQ server.
+
+MemoryBroker implements the parts of AMQP 0-9-1 that Cottontail uses: direct, topic,
+fanout and headers exchanges, the default exchange, queue declaration, binding and
+deletion, exclusive and auto-delete queues, prefetch, acknowledgements, rejection and
+requeueing, publisher confirms, per-queue and per-message TTLs with dead-lettering of
+expired and rejected messages, priority queues and queue length limits, which nack
+publishes beyond the limit when 'x-overflow' is 'reject-publish'. Properties such
+as reply_to and correlation_id are delivered as published, so RPC works as it does
+against RabbitMQ.
+
+MemoryConnection and MemoryChannel mirror the pika.BlockingConnection and
+BlockingChannel methods clients call, so every client runs against the broker unchanged::
+
+    broker = memory.MemoryBroker()
+    broker.install()
+
+    worker = cottontail.QueueWorker('work')
+    worker.subscribe('jobs')
+
+or, without changing any code, run with COTTONTAIL_BROKER=memory to connect to
+'default_broker'. AsyncMemoryConnection and AsyncMemoryChannel mirror the callback methods
+of pika's asynchronous adapters instead, for the asyncio clients in 'aio'.
+
+Deliveries are handed to consumer callbacks by 'process_data_events' on the thread that
+owns the consuming connection, as with pika, or by the event loop of an asynchronous one.
+A producer and a consumer that both block must run on separate threads. 'stop', 'start'
+and 'restart' simulate broker outages. Unlike RabbitMQ, declaring the default exchange ('')
+is accepted and ignored, and prefetch_size is not enforced. As with RabbitMQ, messages only
+expire once they reach the head of their queue, checked whenever a connection processes its
+events.
+"""
+import collections
+import copy
+import itertools
+import threading
+import time
+import uuid
+import weakref
+
+from pika import exceptions, frame, spec
+
+import connection
+from base import EXCHANGE_DIRECT, EXCHANGE_TOPIC, EXCHANGE_FANOUT, EXCHANGE_HEADERS
+
+# Longest time in seconds 'process_data_events' waits for a delivery when there is nothing to do
+POLL_INTERVAL = 0.01
+
+
+class _ChannelError(Exception):
+    """
+    A protocol error that closes the channel it occurred on, as a channel exception from RabbitMQ would.
+    """
+
+    def __init__(self, reply_code, reply_text):
+        super(_ChannelError, self).__init__(reply_code, reply_text)
+        self.reply_code = reply_code
+        self.reply_text = reply_text
+
+
+def _topic_matches(pattern, words):
+    """
+    Match the words of a routing key against the words of a topic binding, where '*'
+    matches exactly one word and '#' matches zero or more words.
+    """
+    if not pattern:
+        return not words
+
+    head = pattern[0]
+    if head == '#':
+        return any(_topic_matches(pattern[1:], words[index:]) for index in xrange(len(words) + 1))
+    if not words:
+        return False
+    return (head == '*' or head == words[0]) and _topic_matches(pattern[1:], words[1:])
+
+
+def _headers_match(arguments, headers):
+    """
+    Match message headers against the arguments of a headers binding. With 'x-match' set to
+    'any' one header must match, otherwise all of them must. Arguments starting with 'x-' are
+    not matched.
+    """
+    headers = headers or {}
+    matches = (key in headers and headers[key] == value
+               for key, value in arguments.items() if not key.startswith('x-'))
+    if arguments.get('x-match') == 'any':
+        return any(matches)
+    return all(matches)
+
+
+class _Binding(object):
+    __slots__ = ('queue', 'routing_key', 'arguments', 'words')
+
+    def __init__(self, queue, routing_key, arguments):
+        self.queue = queue
+        self.routing_key = routing_key
+        self.arguments = arguments
+        self.words = routing_key.split('.')
+
+
+class _Exchange(object):
+
+    def __init__(self, name, exchange_type, durable, auto_delete, arguments):
+        self.name = name
+        self.exchange_type = exchange_type
+        self.durable = durable
+        self.auto_delete = auto_delete
+        self.arguments = arguments
+        self.bindings = []
+
+    def route(self, routing_key, properties):
+        """
+        Returns:
+            list: The names of the queues a message with 'routing_key' and 'properties' is routed to
+        """
+        if self.exchange_type == EXCHANGE_FANOUT:
+            matched = self.bindings
+        elif self.exchange_type == EXCHANGE_DIRECT:
+            matched = [binding for binding in self.bindings if binding.routing_key == routing_key]
+        elif self.exchange_type == EXCHANGE_TOPIC:
+            words = routing_key.split('.')
+            matched = [binding for binding in self.bindings if _topic_matches(binding.words, words)]
+        else:
+            headers = properties.headers if properties is not None else None
+            matched = [binding for binding in self.bindings if _headers_match(binding.arguments, headers)]
+
+        # A message is delivered to a queue once, however many of its bindings match
+        queues = []
+        for binding in matched:
+            if binding.queue not in queues:
+                queues.append(binding.queue)
+        return queues
+
+
+class _Queue(object):
+
+    def __init__(self, name, durable, owner, auto_delete, arguments):
+        self.name = name
+        self.durable = durable
+        self.owner = owner
+        self.auto_delete = auto_delete
+        self.arguments = arguments
+        self.messages = collections.deque()
+        self.consumers = collections.deque()
+        self.exclusive_consumer = False
+
+    def expires(self, properties):
+        """
+        Returns:
+            float: The time a message with 'properties' published now expires at, or None if it does not
+        """
+        ttls = [self.arguments.get('x-message-ttl')]
+        if properties is not None and properties.expiration is not None:
+            ttls.append(int(properties.expiration))
+        ttls = [ttl for ttl in ttls if ttl is not None]
+        return time.time() + min(ttls) / 1000.0 if ttls else None
+
+    def priority(self, properties):
+        """
+        Returns:
+            int: The priority a message with 'properties' is queued with, 0 unless this is a priority queue
+        """
+        max_priority = self.arguments.get('x-max-priority')
+        if not max_priority or properties is None or not properties.priority:
+            return 0
+        return min(properties.priority, max_priority)
+
+    def push(self, message):
+        """
+        Queue a message behind every message of the same or a higher priority
+        """
+        messages = self.messages
+        position = len(messages)
+        while position and messages[position - 1].priority < message.priority:
+            position -= 1
+
+        # deque has no insert before Python 3.5
+        messages.rotate(len(messages) - position)
+        messages.append(message)
+        messages.rotate(position - len(messages) + 1)
+
+
+class _Message(object):
+    __slots__ = ('exchange', 'routing_key', 'properties', 'body', 'redelivered', 'expires', 'priority')
+
+    def __init__(self, exchange, routing_key, properties, body, expires=None, priority=0):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.properties = properties
+        self.body = body
+        self.redelivered = False
+        self.expires = expires
+        self.priority = priority
+
+
+class _Consumer(object):
+    __slots__ = ('tag', 'channel', 'queue', 'callback', 'no_ack', 'prefetch_count', 'unacked')
+
+    def __init__(self, tag, channel, queue, callback, no_ack, prefetch_count):
+        self.tag = tag
+        self.channel = channel
+        self.queue = queue
+        self.callback = callback
+        self.no_ack = no_ack
+        self.prefetch_count = prefetch_count
+        self.unacked = 0
+
+    def can_receive(self):
+        if self.no_ack:
+            return True
+        if self.prefetch_count and self.unacked >= self.prefetch_count:
+            return False
+        channel_limit = self.channel._global_prefetch_count
+        return not channel_limit or len(self.channel._unacked) < channel_limit
+
+
+class MemoryBroker(object):
+    """
+    An in-process message broker shared by the connections opened on it.
+
+    Every broker operation holds one lock, so connections may be used from different threads,
+    each connection from one thread at a time as with pika.
+
+    Example::
+
+        broker = memory.MemoryBroker()
+        broker.install()
+        ...
+        broker.uninstall()
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._exchanges = {}
+        self._queues = {}
+        self._connections = weakref.WeakSet()
+        self._running = True
+
+    def connect(self, parameters=None):
+        """
+        Open a connection to this broker
+
+        Args:
+            parameters (pika.ConnectionParameters, optional): Accepted for compatibility with pika and otherwise unused.
+
+        Returns:
+            MemoryConnection: The open connection
+
+        Raises:
+            pika.exceptions.AMQPConnectionError: If the broker is stopped
+        """
+        with self._lock:
+            if not self._running:
+                raise exceptions.AMQPConnectionError("The memory broker is stopped")
+            opened = MemoryConnection(self, parameters)
+            self._connections.add(opened)
+            return opened
+
+    def connect_async(self, parameters, loop, on_open_callback=None, on_open_error_callback=None,
+                      on_close_callback=None):
+        """
+        Open a connection to this broker driven by an asyncio event loop, as connection.connect_async does
+
+        Returns:
+            AsyncMemoryConnection: The connection, open once 'on_open_callback' is called, or None if the
+                broker is stopped, which is reported to 'on_open_error_callback'
+        """
+        with self._lock:
+            if not self._running:
+                if on_open_error_callback is not None:
+                    loop.call_soon(on_open_error_callback, None, "The memory broker is stopped")
+                return None
+            opened = AsyncMemoryConnection(self, parameters, loop, on_open_callback, on_close_callback)
+            self._connections.add(opened)
+            return opened
+
+    def stop(self):
+        """
+        Simulate the broker going down. Every connection is dropped and new ones are refused until
+        'start' is called. Only durable exchanges and queues, and persistent messages on durable
+        queues, survive.
+        """
+        connection.forget_declared()
+        with self._lock:
+            self._running = False
+            for dropped in list(self._connections):
+                if dropped.is_open:
+                    dropped._drop()
+
+            for queue in self._queues.values():
+                if not queue.durable:
+                    self._remove_queue(queue)
+                else:
+                    queue.messages = collections.deque(
+                        message for message in queue.messages
+                        if message.properties is not None and message.properties.delivery_mode == 2
+                    )
+            self._exchanges = dict((name, exchange) for name, exchange in self._exchanges.items() if exchange.durable)
+
+    def start(self):
+        """
+        Accept connections again after 'stop'
+        """
+        with self._lock:
+            self._running = True
+
+    def restart(self):
+        """
+        Simulate a broker restart, dropping every connection as 'stop' does
+        """
+        self.stop()
+        self.start()
+
+    def install(self):
+        """
+        Connect every client created from now on to this broker rather than to RabbitMQ
+        """
+        connection.set_connection_factory(self.connect, self.connect_async)
+
+    def uninstall(self):
+        """
+        Connect clients created from now on to RabbitMQ again
+        """
+        connection.set_connection_factory(None)
+
+    def reset(self):
+        """
+        Delete every exchange and queue, e.g. between tests. Open connections should be closed first.
+        """
+        connection.forget_declared()
+        with self._lock:
+            self._exchanges.clear()
+            self._queues.clear()
+
+    def message_count(self, queue):
+        """
+        Args:
+            queue (str): The name of a queue
+
+        Returns:
+            int: The number of messages ready for delivery on the queue, not counting unacknowledged ones
+
+        Raises:
+            KeyError: If there is no queue named 'queue'
+        """
+        with self._lock:
+            self._expire(self._queues[queue])
+            return len(self._queues[queue].messages)
+
+    ################################################
+    # Protocol methods, called holding the lock   #
+    ################################################
+
+    def _declare_exchange(self, name, exchange_type, passive, durable, auto_delete, arguments):
+        if not name:
+            return
+
+        exchange = self._exchanges.get(name)
+        if exchange is None:
+            if passive:
+                raise _ChannelError(spec.NOT_FOUND, "NOT_FOUND - no exchange '{}'".format(name))
+            if exchange_type not in (EXCHANGE_DIRECT, EXCHANGE_TOPIC, EXCHANGE_FANOUT, EXCHANGE_HEADERS):
+                raise _ChannelError(spec.COMMAND_INVALID, "COMMAND_INVALID - unknown exchange type '{}'".format(
+                    exchange_type))
+            self._exchanges[name] = _Exchange(name, exchange_type, durable, auto_delete, arguments)
+        elif not passive and exchange.exchange_type != exchange_type:
+            raise _ChannelError(spec.PRECONDITION_FAILED, "PRECONDITION_FAILED - inequivalent arg 'type' "
+                                "for exchange '{}': received '{}' but current is '{}'".format(
+                                    name, exchange_type, exchange.exchange_type))
+
+    def _delete_exchange(self, name, if_unused):
+        exchange = self._exchange(name)
+        if if_unused and exchange.bindings:
+            raise _ChannelError(spec.PRECONDITION_FAILED, "PRECONDITION_FAILED - exchange '{}' in use".format(name))
+        del self._exchanges[name]
+
+    def _exchange(self, name):
+        if not name:
+            raise _ChannelError(spec.ACCESS_REFUSED, "ACCESS_REFUSED - operation not permitted on the default exchange")
+        exchange = self._exchanges.get(name)
+        if exchange is None:
+            raise _ChannelError(spec.NOT_FOUND, "NOT_FOUND - no exchange '{}'".format(name))
+        return exchange
+
+    def _declare_queue(self, owner, name, passive, durable, exclusive, auto_delete, arguments):
+        if not name:
+            if passive:
+                raise _ChannelError(spec.NOT_FOUND, "NOT_FOUND - no queue ''")
+            name = 'amq.gen-{}'.format(uuid.uuid4().hex)
+
+        queue = self._queues.get(name)
+        if queue is None:
+            if passive:
+                raise _ChannelError(spec.NOT_FOUND, "NOT_FOUND - no queue '{}'".format(name))
+            queue = _Queue(name, durable, owner if exclusive else None, auto_delete, arguments)
+            self._queues[name] = queue
+        else:
+            self._check_owner(queue, owner)
+            if not passive and queue.arguments != arguments:
+                raise _ChannelError(spec.PRECONDITION_FAILED, "PRECONDITION_FAILED - inequivalent arguments "
+                                    "for queue '{}': received {} but current is {}".format(
+                                        name, arguments, queue.arguments))
+
+        return queue
+
+    def _delete_queue(self, owner, name, if_unused, if_empty):
+        queue = self._queues.get(name)
+        if queue is None:
+            return 0
+        self._check_owner(queue, owner)
+        if if_unused and queue.consumers:
+            raise _ChannelError(spec.PRECONDITION_FAILED, "PRECONDITION_FAILED - queue '{}' in use".format(name))
+        if if_empty and queue.messages:
+            raise _ChannelError(spec.PRECONDITION_FAILED, "PRECONDITION_FAILED - queue '{}' not empty".format(name))
+
+        self._remove_queue(queue)
+        return len(queue.messages)
+
+    def _remove_queue(self, queue):
+        del self._queues[queue.name]
+        for exchange in self._exchanges.values():
+            exchange.bindings = [binding for binding in exchange.bindings if binding.queue != queue.name]
+
+        for consumer in list(queue.consumers):
+            consumer.channel._consumers.pop(consumer.tag, None)
+        queue.consumers.clear()
+
+    def _queue(self, owner, name):
+        queue = self._queues.get(name)
+        if queue is None:
+            raise _ChannelError(spec.NOT_FOUND, "NOT_FOUND - no queue '{}'".format(name))
+        self._check_owner(queue, owner)
+        return queue
+
+    def _check_owner(self, queue, owner):
+        if queue.owner is not None and queue.owner is not owner:
+            raise _ChannelError(spec.RESOURCE_LOCKED, "RESOURCE_LOCKED - cannot obtain exclusive access to "
+                                "locked queue '{}'".format(queue.name))
+
+    def _bind(self, owner, queue, exchange, routing_key, arguments):
+        queue = self._queue(owner, queue)
+        exchange = self._exchange(exchange)
+        for binding in exchange.bindings:
+            if binding.queue == queue.name and binding.routing_key == routing_key and binding.arguments == arguments:
+                return
+        exchange.bindings.append(_Binding(queue.name, routing_key, arguments))
+
+    def _unbind(self, owner, queue, exchange, routing_key, arguments):
+        queue = self._queue(owner, queue)
+        exchange = self._exchange(exchange)
+        exchange.bindings = [
+            binding for binding in exchange.bindings
+            if not (binding.queue == queue.name and binding.routing_key == routing_key
+                    and binding.arguments == arguments)
+        ]
+
+    def _publish(self, exchange, routing_key, body, properties):
+        """
+        Returns:
+            bool: False if a full queue with 'x-overflow' set to 'reject-publish' refused the message
+        """
+        if exchange:
+            queues = self._exchange(exchange).route(routing_key, properties)
+        else:
+            # The default exchange routes to the queue named by the routing key
+            queues = [routing_key] if routing_key in self._queues else []
+
+        accepted = True
+        for name in queues:
+            queue = self._queues[name]
+            max_length = queue.arguments.get('x-max-length')
+            if (max_length is not None and len(queue.messages) >= max_length and
+                    queue.arguments.get('x-overflow') == 'reject-publish'):
+                accepted = False
+                continue
+
+            queue.push(_Message(exchange, routing_key, properties, body, queue.expires(properties),
+                                queue.priority(properties)))
+
+            # Beyond its length limit a queue drops the messages at its head
+            while max_length is not None and len(queue.messages) > max_length:
+                self._dead_letter(queue, queue.messages.popleft(), 'maxlen')
+            self._dispatch(queue)
+        return accepted
+
+    def _expire(self, queue=None):
+        """
+        Dead-letter the expired messages at the head of a queue, or of every queue
+        """
+        now = time.time()
+        for queue in [queue] if queue is not None else self._queues.values():
+            while queue.messages and queue.messages[0].expires is not None and queue.messages[0].expires <= now:
+                self._dead_letter(queue, queue.messages.popleft(), 'expired')
+
+    def _dead_letter(self, queue, message, reason):
+        """
+        Republish a message that expired or was rejected to its queue's dead letter exchange, if it
+        has one, recording the event in the message's 'x-death' header as RabbitMQ does
+        """
+        exchange = queue.arguments.get('x-dead-letter-exchange')
+        if exchange is None:
+            return
+
+        properties = copy.copy(message.properties) if message.properties is not None else spec.BasicProperties()
+        headers = dict(properties.headers or {})
+        deaths = list(headers.get('x-death') or [])
+        for death in deaths:
+            if death.get('queue') == queue.name and death.get('reason') == reason:
+                deaths.remove(death)
+                death = dict(death, count=death.get('count', 1) + 1)
+                break
+        else:
+            death = {'queue': queue.name, 'reason': reason, 'count': 1, 'exchange': message.exchange,
+                     'routing-keys': [message.routing_key]}
+        if properties.expiration is not None:
+            death['original-expiration'] = properties.expiration
+        death['time'] = int(time.time())
+        headers['x-death'] = [death] + deaths
+        properties.headers = headers
+        # The expiration would otherwise expire the message again wherever it is dead-lettered to
+        properties.expiration = None
+
+        routing_key = queue.arguments.get('x-dead-letter-routing-key', message.routing_key)
+        try:
+            self._publish(exchange, routing_key, message.body, properties)
+        except _ChannelError:
+            # Messages dead-lettered to an exchange that does not exist are dropped
+            pass
+
+    def _consume(self, consumer, exclusive):
+        queue = consumer.queue
+        if queue.exclusive_consumer or (exclusive and queue.consumers):
+            raise _ChannelError(spec.ACCESS_REFUSED, "ACCESS_REFUSED - queue '{}' in exclusive use".format(
+                queue.name))
+
+        queue.exclusive_consumer = exclusive
+        queue.consumers.append(consumer)
+        self._dispatch(queue)
+
+    def _cancel(self, consumer):
+        queue = consumer.queue
+        if consumer in queue.consumers:
+            queue.consumers.remove(consumer)
+            queue.exclusive_consumer = False
+            if queue.auto_delete and not queue.consumers and self._queues.get(queue.name) is queue:
+                self._remove_queue(queue)
+
+    def _get(self, channel, queue, no_ack):
+        queue = self._queue(channel.connection, queue)
+        self._expire(queue)
+        if not queue.messages:
+            return None
+
+        message = queue.messages.popleft()
+        delivery_tag = channel._next_delivery_tag(None, queue, message, no_ack)
+        return delivery_tag, message, len(queue.messages)
+
+    def _settle(self, channel, delivery_tag, multiple, ack, requeue):
+        """
+        Acknowledge, or reject and optionally requeue, deliveries unacknowledged on a channel
+        """
+        unacked = channel._unacked
+        if (delivery_tag or not multiple) and delivery_tag not in unacked:
+            raise _ChannelError(spec.PRECONDITION_FAILED, "PRECONDITION_FAILED - unknown delivery tag {}".format(
+                delivery_tag))
+
+        if multiple:
+            tags = [tag for tag in unacked if not delivery_tag or tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+
+        self._release(channel, tags, requeue=requeue and not ack, dead_letter=not ack and not requeue)
+
+    def _release(self, channel, tags, requeue, dead_letter=False):
+        """
+        Remove deliveries from a channel's unacknowledged deliveries, requeueing them at the head of
+        their queues if 'requeue' is set, or dead-lettering them if 'dead_letter' is set, then deliver
+        whatever their consumers now have room for.
+        """
+        queues = []
+        requeued = []
+        for tag in tags:
+            queue, message, consumer = channel._unacked.pop(tag)
+            if consumer is not None:
+                consumer.unacked -= 1
+            if requeue and self._queues.get(queue.name) is queue:
+                message.redelivered = True
+                requeued.append((queue, message))
+            elif dead_letter:
+                self._dead_letter(queue, message, 'rejected')
+            if queue not in queues:
+                queues.append(queue)
+
+        for queue, message in reversed(requeued):
+            queue.messages.appendleft(message)
+
+        for consumer in channel._consumers.values():
+            if consumer.queue not in queues:
+                queues.append(consumer.queue)
+        for queue in queues:
+            self._dispatch(queue)
+
+    def _dispatch(self, queue):
+        """
+        Deliver a queue's messages round-robin to its consumers while any of them has room under its prefetch limit
+        """
+        consumers = queue.consumers
+        self._expire(queue)
+        while queue.messages and consumers:
+            for _ in xrange(len(consumers)):
+                consumer = consumers[0]
+                consumers.rotate(-1)
+                if consumer.can_receive():
+                    break
+            else:
+                return
+
+            consumer.channel._deliver(consumer, queue, queue.messages.popleft())
+            self._expire(queue)
+
+    def _close_channel(self, channel):
+        for consumer in channel._consumers.values():
+            self._cancel(consumer)
+        channel._consumers.clear()
+        self._release(channel, list(channel._unacked), requeue=True)
+
+    def _close_connection(self, owner):
+        for queue in [queue for queue in self._queues.values() if queue.owner is owner]:
+            self._remove_queue(queue)
+
+
+class MemoryConnection(object):
+    """
+    A connection to a MemoryBroker, with the methods of pika.BlockingConnection that clients use.
+
+    Args:
+        broker (MemoryBroker): The broker to connect to
+        parameters (pika.ConnectionParameters, optional): The parameters the connection was opened with.
+    """
+    publisher_confirms = True
+    basic_nack = True
+
+    def __init__(self, broker, parameters=None):
+        self.broker = broker
+        self.parameters = parameters
+
+        self._open = True
+        self._channels = {}
+        self._channel_numbers = itertools.count(1)
+        self._timeouts = {}
+        self._timeout_ids = itertools.count(1)
+
+        # Callbacks to run on the thread processing this connection's events, and a flag to wake it
+        self._events = collections.deque()
+        self._wakeup = threading.Event()
+
+    def __repr__(self):
+        return '<MemoryConnection open={}>'.format(self._open)
+
+    @property
+    def is_open(self):
+        return self._open
+
+    @property
+    def is_closed(self):
+        return not self._open
+
+    @property
+    def is_closing(self):
+        return False
+
+    def channel(self, channel_number=None):
+        """
+        Open a channel
+
+        Args:
+            channel_number (int, optional): The number of the channel, defaults to the next unused number.
+
+        Returns:
+            MemoryChannel: The open channel
+        """
+        if not self._open:
+            raise exceptions.ConnectionClosed()
+
+        channel_number = channel_number or next(self._channel_numbers)
+        self._channels[channel_number] = MemoryChannel(self, channel_number)
+        return self._channels[channel_number]
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        """
+        Close every channel, requeueing their unacknowledged deliveries, delete the connection's
+        exclusive queues and close the connection
+        """
+        if not self._open:
+            return
+
+        with self.broker._lock:
+            for channel in self._channels.values():
+                if channel.is_open:
+                    channel._close()
+            self._channels.clear()
+            self.broker._close_connection(self)
+            self._open = False
+
+        self._events.clear()
+
+    def _drop(self):
+        """
+        Lose the connection as a network failure would. The broker releases the connection's channels
+        and exclusive queues, and the client's next call on the connection raises ConnectionClosed.
+        """
+        with self.broker._lock:
+            for channel in self._channels.values():
+                if channel.is_open:
+                    consumers = channel._consumers.copy()
+                    channel._close()
+                    # The client still believes it is consuming until its next call fails
+                    channel._consumers = consumers
+            self.broker._close_connection(self)
+            self._open = False
+
+        self._events.clear()
+
+    def process_data_events(self):
+        """
+        Run consumer and confirm callbacks for events that have arrived, waiting up to POLL_INTERVAL
+        seconds for one if there are none, then run any timeouts that are due.
+        """
+        if not self._open:
+            raise exceptions.ConnectionClosed()
+
+        self._wakeup.clear()
+        if not self._events:
+            self._wakeup.wait(self._poll_timeout())
+
+        with self.broker._lock:
+            self.broker._expire()
+
+        # Only run events that arrived before this call, so that a busy consumer cannot starve the timeouts
+        for _ in xrange(len(self._events)):
+            callback, args = self._events.popleft()
+            callback(*args)
+
+        self._process_timeouts()
+
+    def add_timeout(self, deadline, callback_method):
+        """
+        Call 'callback_method' from 'process_data_events' once 'deadline' seconds have passed
+
+        Returns:
+            int: The id of the timeout, for 'remove_timeout'
+        """
+        timeout_id = next(self._timeout_ids)
+        self._timeouts[timeout_id] = (time.time() + deadline, callback_method)
+        return timeout_id
+
+    def remove_timeout(self, timeout_id):
+        self._timeouts.pop(timeout_id, None)
+
+    def sleep(self, duration):
+        """
+        Process events for 'duration' seconds
+        """
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            self.process_data_events()
+
+    def _post(self, callback, *args):
+        """
+        Queue a callback to run on the thread processing this connection's events. May be called from any thread.
+        """
+        self._events.append((callback, args))
+        self._wakeup.set()
+
+    def _poll_timeout(self):
+        if not self._timeouts:
+            return POLL_INTERVAL
+        next_deadline = min(deadline for deadline, _ in self._timeouts.values())
+        return max(0, min(POLL_INTERVAL, next_deadline - time.time()))
+
+    def _process_timeouts(self):
+        now = time.time()
+        for timeout_id, (deadline, callback) in self._timeouts.items():
+            if deadline <= now and self._timeouts.pop(timeout_id, None) is not None:
+                callback()
+
+
+class MemoryChannel(object):
+    """
+    A channel on a MemoryConnection, with the methods of pika's BlockingChannel that clients use.
+
+    A protocol error, such as publishing to an exchange that does not exist, closes the channel
+    and raises pika.exceptions.ChannelClosed with RabbitMQ's reply code and text.
+
+    Args:
+        connection (MemoryConnection): The connection the channel is opened on
+        channel_number (int): The number of the channel
+    """
+
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.channel_number = channel_number
+
+        self._broker = connection.broker
+        self._open = True
+        self._consumers = {}
+        self._unacked = collections.OrderedDict()
+        self._delivery_tag = 0
+        self._prefetch_count = 0
+        self._global_prefetch_count = 0
+        self._confirming = False
+        self._confirm_callback = None
+        self._publish_tag = 0
+
+    def __repr__(self):
+        return '<MemoryChannel number={} open={}>'.format(self.channel_number, self._open)
+
+    @property
+    def is_open(self):
+        return self._open
+
+    @property
+    def is_closed(self):
+        return not self._open
+
+    def _call(self, method, *args):
+        """
+        Run a broker method holding the broker lock, closing this channel if it raises a protocol error
+
+        Raises:
+            pika.exceptions.ChannelClosed: If the channel is closed or the broker raised a protocol error
+        """
+        if not self.connection.is_open:
+            raise exceptions.ConnectionClosed()
+        if not self._open:
+            raise exceptions.ChannelClosed()
+
+        with self._broker._lock:
+            try:
+                return method(*args)
+            except _ChannelError as e:
+                self._close()
+                raise exceptions.ChannelClosed(e.reply_code, e.reply_text)
+
+    def _method(self, method):
+        return frame.Method(self.channel_number, method)
+
+    def _send_method(self, method_frame, content=None, wait=False):
+        """
+        Send a method without waiting for its reply, as clients pipelining their declarations do with
+        BlockingChannel. Exchange and queue declarations and bindings are supported.
+
+        Raises:
+            NotImplementedError: For any other method
+        """
+        if isinstance(method_frame, spec.Exchange.Declare):
+            self.exchange_declare(method_frame.exchange, method_frame.type, method_frame.passive,
+                                  method_frame.durable, method_frame.auto_delete, method_frame.internal, True,
+                                  method_frame.arguments)
+        elif isinstance(method_frame, spec.Queue.Declare):
+            self.queue_declare(method_frame.queue, method_frame.passive, method_frame.durable,
+                               method_frame.exclusive, method_frame.auto_delete, True, method_frame.arguments)
+        elif isinstance(method_frame, spec.Queue.Bind):
+            self.queue_bind(method_frame.queue, method_frame.exchange, method_frame.routing_key, True,
+                            method_frame.arguments)
+        else:
+            raise NotImplementedError("'{}' cannot be sent to a MemoryBroker directly".format(method_frame.NAME))
+
+    ################
+    # Exchanges    #
+    ################
+
+    def exchange_declare(self, exchange=None, exchange_type='direct', passive=False, durable=False,
+                         auto_delete=False, internal=False, nowait=False, arguments=None, type=None):
+        exchange_type = type or exchange_type
+        self._call(self._broker._declare_exchange, exchange, exchange_type, passive, durable, auto_delete,
+                   arguments or {})
+        return None if nowait else self._method(spec.Exchange.DeclareOk())
+
+    def exchange_delete(self, exchange=None, if_unused=False, nowait=False):
+        self._call(self._broker._delete_exchange, exchange, if_unused)
+        return None if nowait else self._method(spec.Exchange.DeleteOk())
+
+    ################
+    # Queues       #
+    ################
+
+    def queue_declare(self, queue='', passive=False, durable=False, exclusive=False, auto_delete=False,
+                      nowait=False, arguments=None):
+        declared = self._call(self._broker._declare_queue, self.connection, queue, passive, durable, exclusive,
+                              auto_delete, arguments or {})
+        if nowait:
+            return None
+        return self._method(spec.Queue.DeclareOk(declared.name, len(declared.messages), len(declared.consumers)))
+
+    def queue_delete(self, queue='', if_unused=False, if_empty=False, nowait=False):
+        message_count = self._call(self._broker._delete_queue, self.connection, queue, if_unused, if_empty)
+        return None if nowait else self._method(spec.Queue.DeleteOk(message_count))
+
+    def queue_purge(self, queue='', nowait=False):
+        def purge():
+            messages = self._broker._queue(self.connection, queue).messages
+            message_count = len(messages)
+            messages.clear()
+            return message_count
+
+        message_count = self._call(purge)
+        return None if nowait else self._method(spec.Queue.PurgeOk(message_count))
+
+    def queue_bind(self, queue, exchange, routing_key=None, nowait=False, arguments=None):
+        if routing_key is None:
+            routing_key = queue
+        self._call(self._broker._bind, self.connection, queue, exchange, routing_key, arguments or {})
+        return None if nowait else self._method(spec.Queue.BindOk())
+
+    def queue_unbind(self, queue='', exchange=None, routing_key=None, arguments=None):
+        if routing_key is None:
+            routing_key = queue
+        self._call(self._broker._unbind, self.connection, queue, exchange, routing_key, arguments or {})
+        return self._method(spec.Queue.UnbindOk())
+
+    ################
+    # Publishing   #
+    ################
+
+    def confirm_delivery(self, callback=None, nowait=False):
+        """
+        Put the channel into confirm mode. The broker confirms every message once it has been routed,
+        calling 'callback' with a Basic.Ack frame from 'process_data_events', or a Basic.Nack frame
+        if a full queue refused it.
+
+        Args:
+            callback (callable, optional): Called with the Basic.Ack or Basic.Nack frame of each published message
+        """
+        self._confirming = True
+        self._confirm_callback = callback
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False, immediate=False):
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+
+        accepted = self._call(self._broker._publish, exchange, routing_key, body, properties)
+
+        if self._confirming:
+            self._publish_tag += 1
+            if self._confirm_callback is not None:
+                confirm = spec.Basic.Ack if accepted else spec.Basic.Nack
+                self.connection._post(self._confirm_callback, self._method(confirm(self._publish_tag)))
+        return True
+
+    ################
+    # Consuming    #
+    ################
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, all_channels=False):
+        """
+        Limit the unacknowledged deliveries of consumers created from now on to 'prefetch_count',
+        or of the whole channel when 'all_channels' is set. 'prefetch_size' is not enforced.
+        """
+        if all_channels:
+            self._global_prefetch_count = prefetch_count
+        else:
+            self._prefetch_count = prefetch_count
+        return self._method(spec.Basic.QosOk())
+
+    def basic_consume(self, consumer_callback, queue='', no_ack=False, exclusive=False, consumer_tag=None,
+                      arguments=None):
+        consumer_tag = consumer_tag or 'ctag{}.{}'.format(self.channel_number, uuid.uuid4().hex)
+        if consumer_tag in self._consumers:
+            raise exceptions.DuplicateConsumerTag(consumer_tag)
+
+        def consume():
+            consumer = _Consumer(consumer_tag, self, self._broker._queue(self.connection, queue),
+                                 consumer_callback, no_ack, self._prefetch_count)
+            self._consumers[consumer_tag] = consumer
+            self._broker._consume(consumer, exclusive)
+
+        try:
+            self._call(consume)
+        except exceptions.ChannelClosed:
+            self._consumers.pop(consumer_tag, None)
+            raise
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag='', nowait=False):
+        consumer = self._consumers.pop(consumer_tag, None)
+        if consumer is not None:
+            self._call(self._broker._cancel, consumer)
+
+    def basic_get(self, queue=None, no_ack=False):
+        """
+        Returns:
+            tuple: The Basic.GetOk method, properties and body of the next message on 'queue',
+                or (None, None, None) if it is empty
+        """
+        got = self._call(self._broker._get, self, queue, no_ack)
+        if got is None:
+            return None, None, None
+
+        delivery_tag, message, message_count = got
+        method = spec.Basic.GetOk(delivery_tag, message.redelivered, message.exchange, message.routing_key,
+                                  message_count)
+        return method, message.properties, message.body
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._call(self._broker._settle, self, delivery_tag, multiple, True, False)
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        self._call(self._broker._settle, self, delivery_tag or 0, multiple, False, requeue)
+
+    def basic_reject(self, delivery_tag=None, requeue=True):
+        self._call(self._broker._settle, self, delivery_tag or 0, False, False, requeue)
+
+    def basic_recover(self, requeue=False):
+        """
+        Requeue every unacknowledged delivery on the channel
+        """
+        self._call(lambda: self._broker._release(self, list(self._unacked), requeue=True))
+
+    def start_consuming(self):
+        """
+        Process events on the connection until every consumer on this channel has been cancelled
+        """
+        while self._consumers:
+            self.connection.process_data_events()
+
+    def stop_consuming(self, consumer_tag=None):
+        if consumer_tag:
+            self.basic_cancel(consumer_tag)
+        else:
+            for consumer_tag in self._consumers.keys():
+                self.basic_cancel(consumer_tag)
+
+    def close(self, reply_code=0, reply_text='Normal Shutdown'):
+        """
+        Close the channel, cancelling its consumers and requeueing its unacknowledged deliveries
+
+        Raises:
+            pika.exceptions.ChannelClosed: If the channel is already closed
+        """
+        if not self._open:
+            raise exceptions.ChannelClosed()
+
+        with self._broker._lock:
+            self._close()
+
+    def _close(self):
+        self._broker._close_channel(self)
+        self._open = False
+        self.connection._channels.pop(self.channel_number, None)
+
+    ##########################################
+    # Deliveries, called holding the lock    #
+    ##########################################
+
+    def _next_delivery_tag(self, consumer, queue, message, no_ack):
+        self._delivery_tag += 1
+        if not no_ack:
+            self._unacked[self._delivery_tag] = (queue, message, consumer)
+            if consumer is not None:
+                consumer.unacked += 1
+        return self._delivery_tag
+
+    def _deliver(self, consumer, queue, message):
+        delivery_tag = self._next_delivery_tag(consumer, queue, message, consumer.no_ack)
+        method = spec.Basic.Deliver(consumer.tag, delivery_tag, message.redelivered, message.exchange,
+                                    message.routing_key)
+        self.connection._post(self._on_deliver, consumer, method, message.properties, message.body)
+
+    def _on_deliver(self, consumer, method, properties, body):
+        """
+        Hand a delivery to its consumer's callback, on the thread processing the connection's events.
+        A delivery that arrives after its consumer was cancelled is requeued.
+        """
+        if not self._open:
+            return
+
+        if self._consumers.get(consumer.tag) is not consumer:
+            with self._broker._lock:
+                if method.delivery_tag in self._unacked:
+                    self._broker._release(self, [method.delivery_tag], requeue=True)
+            return
+
+        consumer.callback(self, method, properties, body)
+
+
+class AsyncMemoryConnection(MemoryConnection):
+    """
+    A connection to a MemoryBroker driven by an asyncio event loop, with the methods of pika's asynchronous
+    connection adapters that the clients in 'aio' use. Callbacks run on the event loop as events arrive,
+    instead of from 'process_data_events'.
+
+    Args:
+        broker (MemoryBroker): The broker to connect to
+        parameters (pika.ConnectionParameters): The parameters the connection was opened with
+        loop (asyncio.AbstractEventLoop): The event loop to run callbacks on
+        on_open_callback (callable, optional): Called with the connection once it is open
+        on_close_callback (callable, optional): Called with the connection, reply code and reply text on close
+    """
+
+    def __init__(self, broker, parameters, loop, on_open_callback=None, on_close_callback=None):
+        super(AsyncMemoryConnection, self).__init__(broker, parameters)
+        self.loop = loop
+        self._on_close_callback = on_close_callback
+        self._scheduled = False
+        if on_open_callback is not None:
+            self._post(on_open_callback, self)
+
+    def channel(self, on_open_callback, channel_number=None):
+        """
+        Open a channel
+
+        Args:
+            on_open_callback (callable): Called with the channel once it is open
+            channel_number (int, optional): The number of the channel, defaults to the next unused number.
+        """
+        if not self._open:
+            raise exceptions.ConnectionClosed()
+
+        channel_number = channel_number or next(self._channel_numbers)
+        opened = self._channels[channel_number] = AsyncMemoryChannel(self, channel_number)
+        self._post(on_open_callback, opened)
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        if not self._open:
+            return
+
+        channels = self._channels.values()
+        super(AsyncMemoryConnection, self).close(reply_code, reply_text)
+        self._closed(channels, reply_code, reply_text)
+
+    def _drop(self):
+        channels = self._channels.values()
+        super(AsyncMemoryConnection, self)._drop()
+        self._closed(channels, spec.CONNECTION_FORCED, 'CONNECTION_FORCED - broker forced connection closure')
+
+    def _closed(self, channels, reply_code, reply_text):
+        """
+        Call the close callbacks of the connection and of the channels that were open on it
+        """
+        for channel in channels:
+            channel._closed(reply_code, reply_text)
+        if self._on_close_callback is not None:
+            self.loop.call_soon_threadsafe(self._on_close_callback, self, reply_code, reply_text)
+
+    def process_data_events(self):
+        raise NotImplementedError("Run the event loop to process the events of an AsyncMemoryConnection")
+
+    def add_timeout(self, deadline, callback_method):
+        return self.loop.call_later(deadline, callback_method)
+
+    def remove_timeout(self, timeout_id):
+        timeout_id.cancel()
+
+    def _post(self, callback, *args):
+        """
+        Queue a callback to run on the event loop. May be called from any thread.
+        """
+        self._events.append((callback, args))
+        if not self._scheduled:
+            self._scheduled = True
+            self.loop.call_soon_threadsafe(self._run_events)
+
+    def _run_events(self):
+        self._scheduled = False
+        if not self._open:
+            return
+
+        with self.broker._lock:
+            self.broker._expire()
+
+        for _ in xrange(len(self._events)):
+            callback, args = self._events.popleft()
+            callback(*args)
+
+
+class AsyncMemoryChannel(MemoryChannel):
+    """
+    A channel on an AsyncMemoryConnection, with the methods of pika's asynchronous Channel that the clients
+    in 'aio' use. Replies are handed to callbacks on the event loop, and a protocol error closes the channel,
+    calling its close callbacks with RabbitMQ's reply code and text.
+    """
+
+    def __init__(self, connection, channel_number):
+        super(AsyncMemoryChannel, self).__init__(connection, channel_number)
+        self._on_close_callbacks = []
+
+    def add_on_close_callback(self, callback):
+        """
+        Args:
+            callback (callable): Called with the channel, reply code and reply text once the channel closes
+        """
+        self._on_close_callbacks.append(callback)
+
+    def _call(self, method, *args):
+        """
+        Run a broker method as MemoryChannel does, calling the close callbacks if it closes the channel
+
+        Raises:
+            pika.exceptions.ChannelClosed: If the channel is closed or the broker raised a protocol error
+        """
+        was_open = self._open
+        try:
+            return super(AsyncMemoryChannel, self)._call(method, *args)
+        except exceptions.ChannelClosed as e:
+            if was_open:
+                self._closed(*e.args)
+            raise
+
+    def _reply(self, callback, method, *args, **kwargs):
+        """
+        Run a method of the blocking channel and hand its reply frame to 'callback' on the event loop. A protocol
+        error is reported to the close callbacks rather than raised.
+
+        Raises:
+            pika.exceptions.ChannelClosed: If the channel is already closed
+        """
+        if not self._open:
+            raise exceptions.ChannelClosed()
+
+        try:
+            reply = method(*args, **kwargs)
+        except exceptions.ChannelClosed:
+            return
+        if callback is not None:
+            self.connection._post(callback, reply)
+
+    def _closed(self, reply_code=200, reply_text='Normal Shutdown'):
+        for callback in self._on_close_callbacks:
+            self.connection.loop.call_soon_threadsafe(callback, self, reply_code, reply_text)
+        self._on_close_callbacks = []
+
+    def exchange_declare(self, callback=None, exchange=None, exchange_type='direct', passive=False, durable=False,
+                         auto_delete=False, internal=False, nowait=False, arguments=None, type=None):
+        self._reply(callback, super(AsyncMemoryChannel, self).exchange_declare, exchange, exchange_type, passive,
+                    durable, auto_delete, internal, nowait, arguments, type)
+
+    def queue_declare(self, callback, queue='', passive=False, durable=False, exclusive=False, auto_delete=False,
+                      nowait=False, arguments=None):
+        self._reply(callback, super(AsyncMemoryChannel, self).queue_declare, queue, passive, durable, exclusive,
+                    auto_delete, nowait, arguments)
+
+    def queue_delete(self, callback=None, queue='', if_unused=False, if_empty=False, nowait=False):
+        self._reply(callback, super(AsyncMemoryChannel, self).queue_delete, queue, if_unused, if_empty, nowait)
+
+    def queue_bind(self, callback, queue, exchange, routing_key=None, nowait=False, arguments=None):
+        self._reply(callback, super(AsyncMemoryChannel, self).queue_bind, queue, exchange, routing_key, nowait,
+                    arguments)
+
+    def basic_qos(self, callback=None, prefetch_size=0, prefetch_count=0, all_channels=False):
+        self._reply(callback, super(AsyncMemoryChannel, self).basic_qos, prefetch_size, prefetch_count,
+                    all_channels)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False, immediate=False):
+        self._reply(None, super(AsyncMemoryChannel, self).basic_publish, exchange, routing_key, body, properties,
+                    mandatory, immediate)
+
+    def basic_cancel(self, callback=None, consumer_tag='', nowait=False):
+        self._reply(callback, lambda: super(AsyncMemoryChannel, self).basic_cancel(consumer_tag) or
+                    self._method(spec.Basic.CancelOk(consumer_tag)))
+
+    def close(self, reply_code=0, reply_text='Normal Shutdown'):
+        super(AsyncMemoryChannel, self).close(reply_code, reply_text)
+        self._closed(reply_code, reply_text)
+
+    def start_consuming(self):
+        raise NotImplementedError("Run the event loop to consume from an AsyncMemoryChannel")
+
+
+default_broker = MemoryBroker()
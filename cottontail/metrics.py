@@ -0,0 +1,390 @@
+"""
+Counters and latency histograms of the messages clients publish, deliver, acknowledge and call.
+
+Metrics are disabled by default, costing each instrumented operation a single attribute check.
+'enable' turns them on for every client and returns the registry they are recorded in, which
+can be read as a snapshot, served in the Prometheus text exposition format, or pushed to statsd::
+
+    registry = metrics.enable()
+    metrics.MetricsServer(registry, port=9102).start()
+    metrics.StatsdExporter(registry, host='localhost', port=8125).start()
+
+Clients record:
+
+    cottontail_published_total, cottontail_published_bytes_total (by exchange)
+    cottontail_delivered_total, cottontail_redelivered_total, cottontail_handler_errors_total (by exchange)
+    cottontail_handler_seconds (by exchange)
+    cottontail_acked_total, cottontail_requeued_total
+    cottontail_retried_total, cottontail_dead_lettered_total (by queue)
+    cottontail_rpc_calls_total, cottontail_rpc_errors_total, cottontail_rpc_seconds (by function)
+
+Histograms keep HDR-style log-linear buckets, with 32 linear buckets for each power of two of
+microseconds, so any latency is recorded to within about 3% in constant time and memory.
+"""
+import BaseHTTPServer
+import collections
+import socket
+import threading
+
+import utils
+
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+DEFAULT_HTTP_PORT = 9102
+DEFAULT_STATSD_PORT = 8125
+DEFAULT_STATSD_INTERVAL = 10.0
+DEFAULT_STATSD_PREFIX = 'cottontail'
+
+# Linear buckets for each power of two, as a power of two
+SUB_BUCKET_BITS = 5
+
+# Largest statsd datagram, to stay within a typical MTU
+STATSD_PACKET_SIZE = 1432
+
+EXPOSITION_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter(object):
+    """
+    A monotonically increasing count.
+
+    Attributes:
+        value (int): The count.
+    """
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+    """
+    A distribution of durations in HDR-style log-linear buckets of microseconds.
+
+    Attributes:
+        count (int): Number of durations recorded.
+        sum (float): Total of the durations recorded, in seconds.
+    """
+    kind = 'summary'
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0
+        self._counts = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        """
+        Record a duration
+
+        Args:
+            seconds (float): The duration in seconds
+        """
+        value = max(int(seconds * 1000000), 0)
+        shift = max(value.bit_length() - SUB_BUCKET_BITS - 1, 0)
+        bucket = value >> shift << shift
+
+        with self._lock:
+            self._counts[bucket] += 1
+            self.count += 1
+            self.sum += seconds
+            self.max = max(self.max, value)
+
+    def quantile(self, quantile):
+        """
+        Args:
+            quantile (float): The quantile, between 0 and 1
+
+        Returns:
+            float: The duration in seconds that 'quantile' of the recorded durations do not exceed, or None if empty
+        """
+        with self._lock:
+            counts = sorted(self._counts.items())
+            count = self.count
+
+        if not count:
+            return None
+
+        rank = max(quantile * count, 1)
+        seen = 0
+        for bucket, bucket_count in counts:
+            seen += bucket_count
+            if seen >= rank:
+                # Report the highest value the bucket holds
+                shift = max(bucket.bit_length() - SUB_BUCKET_BITS - 1, 0)
+                return min(bucket + (1 << shift) - 1, self.max) / 1000000.0
+
+    def snapshot(self, quantiles=DEFAULT_QUANTILES):
+        values = dict((quantile, self.quantile(quantile)) for quantile in quantiles)
+        return {'count': self.count, 'sum': self.sum, 'max': self.max / 1000000.0, 'quantiles': values}
+
+
+class MetricsRegistry(object):
+    """
+    The counters and histograms recorded by clients, by name and labels.
+    """
+
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def counter(self, name, **labels):
+        """
+        Args:
+            name (str): The name of the counter
+            **labels: The labels distinguishing this counter from others of the same name
+
+        Returns:
+            Counter: The counter, created if it does not exist yet
+        """
+        return self._get(Counter, name, labels)
+
+    def histogram(self, name, **labels):
+        """
+        Args:
+            name (str): The name of the histogram
+            **labels: The labels distinguishing this histogram from others of the same name
+
+        Returns:
+            Histogram: The histogram, created if it does not exist yet
+        """
+        return self._get(Histogram, name, labels)
+
+    def _get(self, kind, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = kind()
+        return metric
+
+    def metrics(self):
+        """
+        Returns:
+            list: (name, labels, metric) tuples of every metric, where labels is a tuple of (label, value) pairs
+        """
+        with self._lock:
+            return [(name, labels, metric) for (name, labels), metric in self._metrics.items()]
+
+    def snapshot(self):
+        """
+        Read every metric at once
+
+        Returns:
+            dict: Lists of (labels, value) pairs by metric name, where labels is a dict and the value of a
+                histogram is a dict of its count, sum, max and quantiles
+        """
+        snapshot = collections.defaultdict(list)
+        for name, labels, metric in self.metrics():
+            snapshot[name].append((dict(labels), metric.snapshot()))
+        return dict(snapshot)
+
+    def exposition(self):
+        """
+        Render every metric in the Prometheus text exposition format, histograms as summaries
+
+        Returns:
+            str: The exposition
+        """
+        lines = []
+        typed = set()
+        # Samples of the same name are grouped together
+        for name, labels, metric in sorted(self.metrics(), key=lambda entry: entry[0]):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} {}'.format(name, metric.kind))
+
+            if metric.kind == 'counter':
+                lines.append('{}{} {}'.format(name, _format_labels(labels), metric.value))
+                continue
+
+            for quantile in DEFAULT_QUANTILES:
+                value = metric.quantile(quantile)
+                lines.append('{}{} {}'.format(
+                    name, _format_labels(labels + (('quantile', quantile),)), 'NaN' if value is None else repr(value)))
+            lines.append('{}_sum{} {!r}'.format(name, _format_labels(labels), metric.sum))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), metric.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for label, value in labels
+    ) + '}'
+
+
+def enable(registry=None):
+    """
+    Record the metrics of every client
+
+    Args:
+        registry (MetricsRegistry, optional): The registry to record in, defaults to None for a new one.
+
+    Returns:
+        MetricsRegistry: The registry metrics are recorded in
+    """
+    from base import CottontailBase
+    CottontailBase.metrics = registry if registry is not None else MetricsRegistry()
+    return CottontailBase.metrics
+
+
+def disable():
+    """
+    Stop recording metrics
+    """
+    from base import CottontailBase
+    CottontailBase.metrics = None
+
+
+class _ExpositionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.registry.exposition()
+        self.send_response(200)
+        self.send_header('Content-Type', EXPOSITION_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        utils.logger.debug('Metrics request: ' + format, *args)
+
+
+class MetricsServer(object):
+    """
+    Serve the metrics of a registry over HTTP in the Prometheus text exposition format, from a daemon thread.
+
+    Args:
+        registry (MetricsRegistry): The registry to serve
+        port (int, optional): Port to listen on, defaults to 9102.
+        host (str, optional): Address to listen on, defaults to '127.0.0.1' for local scrapers only.
+    """
+
+    def __init__(self, registry, port=DEFAULT_HTTP_PORT, host='127.0.0.1'):
+        class Handler(_ExpositionHandler):
+            pass
+        Handler.registry = registry
+
+        self._server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='cottontail-metrics')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class StatsdExporter(object):
+    """
+    Push the metrics of a registry to statsd over UDP every 'interval' seconds, from a daemon thread.
+    Counters are sent as the increase since the last push, histograms as gauges of their quantiles.
+
+    Args:
+        registry (MetricsRegistry): The registry to push
+        host (str, optional): The statsd host, defaults to 'localhost'.
+        port (int, optional): The statsd port, defaults to 8125.
+        interval (float, optional): Seconds between pushes, defaults to 10.
+        prefix (str, optional): Prefix of every metric name, defaults to 'cottontail'.
+    """
+
+    def __init__(self, registry, host='localhost', port=DEFAULT_STATSD_PORT, interval=DEFAULT_STATSD_INTERVAL,
+                 prefix=DEFAULT_STATSD_PREFIX):
+        self.registry = registry
+        self.address = (host, port)
+        self.interval = interval
+        self.prefix = prefix
+
+        self._sent = {}
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='cottontail-statsd')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self.push()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.push()
+
+    def lines(self):
+        """
+        Returns:
+            list: The statsd lines of the metrics' changes since the last push
+        """
+        lines = []
+        for name, labels, metric in self.registry.metrics():
+            name = '.'.join([self.prefix, name.replace('cottontail_', '', 1)] +
+                            [str(value).replace('.', '_') or 'default' for _, value in labels])
+            if metric.kind == 'counter':
+                value = metric.value
+                delta = value - self._sent.get(name, 0)
+                self._sent[name] = value
+                if delta:
+                    lines.append('{}:{}|c'.format(name, delta))
+                continue
+
+            count = metric.count
+            delta = count - self._sent.get(name, 0)
+            self._sent[name] = count
+            if not delta:
+                continue
+            lines.append('{}.count:{}|c'.format(name, delta))
+            for quantile in DEFAULT_QUANTILES:
+                value = metric.quantile(quantile)
+                lines.append('{}.p{}:{:.3f}|g'.format(name, str(quantile * 100).rstrip('0').rstrip('.').replace('.', ''),
+                                                      value * 1000))
+        return lines
+
+    def push(self):
+        """
+        Send the metrics' changes since the last push, in as few datagrams as fit
+        """
+        packet = []
+        size = 0
+        for line in self.lines():
+            if packet and size + len(line) + 1 > STATSD_PACKET_SIZE:
+                self._send('\n'.join(packet))
+                packet, size = [], 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            self._send('\n'.join(packet))
+
+    def _send(self, datagram):
+        try:
+            self._socket.sendto(datagram, self.address)
+        except socket.error as e:
+            utils.logger.debug('Could not send metrics to statsd: %s', e)
@@ -0,0 +1,181 @@
+import select
+import socket
+import threading
+import time
+
+import utils
+from connection import connect
+
+DEFAULT_MAX_CHANNELS = 64
+DEFAULT_HEALTH_CHECK_INTERVAL = 30.0
+
+
+class ConnectionPool(object):
+    """
+    A pool of RabbitMQ connections shared by Cottontail clients.
+
+    Clients created with a pool lease a channel on a pooled connection instead of opening a
+    connection of their own, so creating a client costs a channel open, or nothing when an
+    idle publishing channel can be reused. Connections are keyed by host, port, virtual host
+    and credentials, and a new connection is opened once every connection for a key has
+    'max_channels' channels leased or idle.
+
+    pika connections are not thread safe, so each thread gets its own connections, which are
+    closed on the next lease once the thread has exited. Leasing never processes the events of a
+    connection, which would run the consumer callbacks of other clients on it. It checks that the
+    connection is open, and at most every 'health_check_interval' seconds peeks at its socket
+    without reading from it, so a connection the broker has dropped is replaced before it is used.
+
+    Example::
+
+        client = cottontail.Publisher('pubsub_test', connection_pool=cottontail.pool.default_pool)
+
+    Args:
+        max_channels (int, optional): Channels to lease out per connection, defaults to 64.
+        health_check_interval (float, optional): Seconds between checks of the socket of a connection when
+            leasing from it, defaults to 30.
+        logger (module, optional): The logging module to use with this pool, default is 'utils.logger'.
+
+    Attributes:
+        max_channels (int): Channels to lease out per connection.
+        health_check_interval (float): Seconds between checks of the socket of a connection when leasing from it.
+    """
+
+    def __init__(self, max_channels=DEFAULT_MAX_CHANNELS, health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL,
+                 logger=utils.logger):
+        self.max_channels = max_channels
+        self.health_check_interval = health_check_interval
+        self.logger = logger
+
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._leased = {}
+        self._idle = {}
+        self._checked = {}
+
+    def lease(self, parameters):
+        """
+        Lease a channel on a pooled connection, opening or replacing connections as needed
+
+        Args:
+            parameters (pika.ConnectionParameters): Parameters of the connection to lease from
+
+        Returns:
+            tuple: The connection and the leased channel on it
+        """
+        key = self._key(parameters)
+
+        with self._lock:
+            self._reap_threads()
+            connections = self._connections.setdefault(key, [])
+            for connection in list(connections):
+                if not connection.is_open or not self._is_alive(connection):
+                    self.logger.warn("Replacing closed pooled connection: %s", connection)
+                    self._discard(key, connection)
+
+            for connection in connections:
+                idle = self._idle[connection]
+                while idle:
+                    channel = idle.pop()
+                    if channel.is_open:
+                        self._leased[connection] += 1
+                        return connection, channel
+                if self._leased[connection] + len(idle) < self.max_channels:
+                    break
+            else:
+                self.logger.info("Opening pooled connection on %s:%s", parameters.host, parameters.port)
+                connection = connect(parameters)
+                connections.append(connection)
+                self._leased[connection] = 0
+                self._idle[connection] = []
+                self._checked[connection] = time.time()
+
+            self._leased[connection] += 1
+
+        return connection, connection.channel()
+
+    def release(self, connection, channel, reusable=False):
+        """
+        Return a leased channel to the pool
+
+        Args:
+            connection (pika.BlockingConnection): The connection the channel was leased from
+            channel (pika.channel.Channel): The leased channel
+            reusable (bool, optional): Keep the channel open for the next lease, defaults to False.
+                Only channels without consumers or QoS settings should be reused.
+        """
+        with self._lock:
+            if connection not in self._leased:
+                return
+
+            self._leased[connection] -= 1
+            if reusable and channel.is_open:
+                self._idle[connection].append(channel)
+            elif channel.is_open:
+                channel.close()
+
+    def close(self):
+        """
+        Close every pooled connection
+        """
+        with self._lock:
+            for key, connections in self._connections.items():
+                for connection in list(connections):
+                    if connection.is_open:
+                        connection.close()
+                    self._discard(key, connection)
+
+    def _is_alive(self, connection):
+        """
+        Check the socket of a connection last checked 'health_check_interval' seconds ago or more, by
+        peeking at it, so that nothing is read and no events are dispatched
+
+        Returns:
+            bool: False if the broker has closed the socket
+        """
+        now = time.time()
+        if now - self._checked[connection] < self.health_check_interval:
+            return True
+        self._checked[connection] = now
+
+        sock = getattr(connection, 'socket', None)
+        if sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            # A socket the peer has closed is readable, with nothing to read
+            return not readable or sock.recv(1, socket.MSG_PEEK) != ''
+        except (select.error, socket.error, ValueError):
+            return False
+
+    def _reap_threads(self):
+        """
+        Close the connections of threads that have exited, which nothing else can use
+        """
+        for key in [key for key in self._connections if not key[0].is_alive()]:
+            for connection in list(self._connections[key]):
+                if connection.is_open:
+                    connection.close()
+                self._discard(key, connection)
+            del self._connections[key]
+
+    def _key(self, parameters):
+        credentials = parameters.credentials
+        # The thread rather than its ident, which a new thread may reuse
+        return (
+            threading.current_thread(),
+            parameters.host,
+            parameters.port,
+            parameters.virtual_host,
+            getattr(credentials, 'username', None),
+            getattr(credentials, 'password', None),
+        )
+
+    def _discard(self, key, connection):
+        self._connections[key].remove(connection)
+        del self._leased[connection]
+        del self._idle[connection]
+        del self._checked[connection]
+
+
+default_pool = ConnectionPool()
@@ -17,8 +17,42 @@ class QueueServer(QueueBase):
     """
     A server class for publishing messages to a queue.
 
+    Messages are published with a default priority and expiration, which 'publish' and 'batch' can
+    override per message, so that urgent jobs jump ahead on queues declared with a 'max_priority' and
+    stale jobs expire at the broker rather than reaching a worker::
+
+        server = cottontail.QueueServer(exchange_name='queue', expiration=60000)
+        server.publish('jobs', 'resize', priority=9)
+
+    Overwritten methods:
+        __init__:
+        _prepare_message: Apply the default priority and expiration
+
+    Args:
+        priority (int, optional): Priority of published messages, defaults to None.
+        expiration (int, optional): Milliseconds after which published messages expire, defaults to None.
+
+    Attributes:
+        priority (int): Priority of published messages, or None.
+        expiration (int): Milliseconds after which published messages expire, or None.
     """
-    pass
+    priority = None
+    expiration = None
+
+    def __init__(self, exchange_name='', priority=None, expiration=None, **kw):
+        self.priority = priority
+        self.expiration = expiration
+
+        super(QueueServer, self).__init__(exchange_name, **kw)
+
+    def _prepare_message(self, topic, content, headers=None, priority=None, expiration=None):
+        return super(QueueServer, self)._prepare_message(
+            topic,
+            content,
+            headers,
+            self.priority if priority is None else priority,
+            self.expiration if expiration is None else expiration,
+        )
 
 
 class QueueWorker(QueueBase):
@@ -26,19 +60,82 @@ class QueueWorker(QueueBase):
     A worker class for consuming messages in a queue.
 
     Overwritten methods:
-        _create_channel: Alter prefetch_count
+        __init__:
+        _create_channel: Alter prefetch_count and prefetch_size
+        _declare_subscribed_queue: Declare the queue with the worker's queue arguments
+
+    With 'batch_size' set, deliveries are handed to '_on_batch' in batches, for handlers that
+    amortize bulk I/O across messages. The prefetch count is raised to 'batch_size' if it is
+    lower, so that a batch can fill.
+
+    Example::
+
+        class BulkWorker(cottontail.QueueWorker):
+            def _on_batch(self, messages):
+                return insert_rows([message.body for message in messages])  # the messages that failed
+
+        worker = BulkWorker(exchange_name='queue', batch_size=500, batch_interval=50)
+
+    The queue a worker subscribes to is declared with its queue arguments, e.g. as a priority
+    queue whose stale messages expire::
+
+        worker = cottontail.QueueWorker(exchange_name='queue', max_priority=10, message_ttl=60000)
+        worker.subscribe('jobs')
+
+    Args:
+        prefetch_count (int, optional): Number of unacknowledged messages the worker may hold, defaults to 1.
+        prefetch_size (int, optional): Octets of unacknowledged messages the worker may hold, defaults to 0 for no limit.
+        max_priority (int, optional): Highest message priority the subscribed queue orders messages by, defaults to None.
+        message_ttl (int, optional): Milliseconds after which messages on the subscribed queue expire, defaults to None.
+        max_length (int, optional): Most messages the subscribed queue holds, defaults to None for no limit.
+        lazy_queue (bool, optional): Keep the subscribed queue's messages on disk rather than in memory, default is False.
+
+    Attributes:
+        prefetch_count (int): Number of unacknowledged messages the worker may hold.
+        prefetch_size (int): Octets of unacknowledged messages the worker may hold.
+        max_priority (int): Highest message priority the subscribed queue orders messages by, or None.
+        message_ttl (int): Milliseconds after which messages on the subscribed queue expire, or None.
+        max_length (int): Most messages the subscribed queue holds, or None.
+        lazy_queue (bool): Whether the subscribed queue keeps its messages on disk.
     """
+    max_priority = None
+    message_ttl = None
+    max_length = None
+    lazy_queue = False
+
+    def __init__(self, exchange_name='', prefetch_count=1, prefetch_size=0, max_priority=None, message_ttl=None,
+                 max_length=None, lazy_queue=False, **kw):
+        self.prefetch_count = max(prefetch_count, kw.get('batch_size') or 0)
+        self.prefetch_size = prefetch_size
+        self.max_priority = max_priority
+        self.message_ttl = message_ttl
+        self.max_length = max_length
+        self.lazy_queue = lazy_queue
+
+        super(QueueWorker, self).__init__(exchange_name, **kw)
+
+    def _declare_subscribed_queue(self, name, exclusive):
+        return self.declare_queue(
+            name,
+            exclusive=exclusive,
+            max_priority=self.max_priority,
+            message_ttl=self.message_ttl,
+            max_length=self.max_length,
+            lazy_queue=self.lazy_queue,
+        )
 
     def _create_channel(self):
         """
         Instantiate a new channel on the RabbitMQ connection with a specification
-        that the worker not receive more than a single message at a time. This should
-        ensure fair dispatching of messages with respect to worker load.
+        that the worker not receive more than 'prefetch_count' messages at a time. The
+        default of a single message should ensure fair dispatching of messages with
+        respect to worker load; raise it for small, fast messages.
 
         Returns:
             (pika.channel.Channel): The created Channel object
         """
 
         self._channel = super(QueueWorker, self)._create_channel()
-        self._channel.basic_qos(prefetch_count=1)
-        return self._channel
\ No newline at end of file
+        self._channel.basic_qos(prefetch_size=self.prefetch_size, prefetch_count=self.prefetch_count)
+        self._channel_reusable = False
+        return self._channel
@@ -0,0 +1,143 @@
+"""
+Retrying failed deliveries with exponential backoff, and parking poison messages in a dead letter queue.
+
+Clients take a RetryPolicy as 'retry'. Every queue they consume then gets a delay queue per
+backoff tier and a dead letter queue. A delivery whose handler raises is acknowledged and
+republished to the delay queue of its attempt, with the delay as its per-message TTL. When the
+TTL runs out the broker dead-letters the message back to the consumed queue through the default
+exchange. Once a message has failed 'max_attempts' times it is parked on the dead letter queue
+instead, with the last error in its headers, for inspection or replay::
+
+    worker = cottontail.QueueWorker('work', retry=RetryPolicy(delays=(1, 10, 60), max_attempts=5))
+    worker.subscribe('jobs')
+
+Failures of 'jobs' wait 1, 10 and then 60 seconds in 'jobs.retry.1000', 'jobs.retry.10000' and
+'jobs.retry.60000', and the fifth failure parks the message on 'jobs.dead'. Failing messages
+no longer loop straight back to the worker.
+"""
+import copy
+
+import pika
+
+ATTEMPTS_HEADER = 'cottontail-attempts'
+ERROR_HEADER = 'cottontail-error'
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_INITIAL_DELAY = 1.0
+DEFAULT_MULTIPLIER = 4.0
+DEFAULT_TIERS = 4
+
+# Longest error description kept in the headers of a failed message
+ERROR_LIMIT = 1024
+
+
+def exponential_delays(initial=DEFAULT_INITIAL_DELAY, multiplier=DEFAULT_MULTIPLIER, tiers=DEFAULT_TIERS):
+    """
+    Args:
+        initial (float, optional): Seconds before the first retry, defaults to 1.
+        multiplier (float, optional): Factor each tier's delay grows by, defaults to 4.
+        tiers (int, optional): Number of tiers, defaults to 4.
+
+    Returns:
+        tuple: The delay in seconds of each tier, e.g. (1, 4, 16, 64)
+    """
+    return tuple(initial * multiplier ** tier for tier in xrange(tiers))
+
+
+def attempts_of(properties):
+    """
+    Count the times a message has failed, from its attempt header, or if it has none from the
+    'x-death' header the broker adds each time it dead-letters the message
+
+    Args:
+        properties (pika.spec.BasicProperties): The properties of a delivered message
+
+    Returns:
+        int: The number of failed attempts
+    """
+    headers = properties.headers if properties is not None and properties.headers else {}
+    if ATTEMPTS_HEADER in headers:
+        return int(headers[ATTEMPTS_HEADER])
+    return sum(int(death.get('count', 1)) for death in headers.get('x-death') or [])
+
+
+class RetryPolicy(object):
+    """
+    How failed deliveries are retried.
+
+    Args:
+        delays (tuple, optional): Seconds to wait before each retry, the last repeating for later ones,
+            defaults to None for 1, 4, 16 and 64 seconds.
+        max_attempts (int, optional): Failures after which a message is parked on the dead letter queue, defaults to 5.
+        dead_letter (bool, optional): Park poison messages on the dead letter queue rather than dropping them,
+            default is True.
+
+    Attributes:
+        delays (tuple): Seconds to wait before each retry.
+        max_attempts (int): Failures after which a message is parked on the dead letter queue.
+        dead_letter (bool): Whether poison messages are parked rather than dropped.
+    """
+
+    def __init__(self, delays=None, max_attempts=DEFAULT_MAX_ATTEMPTS, dead_letter=True):
+        self.delays = tuple(delays) if delays else exponential_delays()
+        self.max_attempts = max_attempts
+        self.dead_letter = dead_letter
+
+    def delay_for(self, attempts):
+        """
+        Args:
+            attempts (int): The number of failed attempts so far, from 1
+
+        Returns:
+            float: Seconds to wait before the next attempt
+        """
+        return self.delays[min(attempts, len(self.delays)) - 1]
+
+    def delay_queue(self, queue, delay):
+        """
+        Returns:
+            str: The name of the delay queue holding messages of 'queue' for 'delay' seconds
+        """
+        return '{}.retry.{}'.format(queue, int(delay * 1000))
+
+    def dead_letter_queue(self, queue):
+        """
+        Returns:
+            str: The name of the queue poison messages of 'queue' are parked on
+        """
+        return '{}.dead'.format(queue)
+
+    def delay_queues(self, queue):
+        """
+        Returns:
+            list: (name, arguments) of the delay queue of each tier, which dead-letter expired messages back to 'queue'
+        """
+        arguments = {'x-dead-letter-exchange': '', 'x-dead-letter-routing-key': queue}
+        return [(self.delay_queue(queue, delay), dict(arguments)) for delay in sorted(set(self.delays))]
+
+    def route(self, queue, properties, error):
+        """
+        Decide where a failed delivery goes next
+
+        Args:
+            queue (str): The queue the message was delivered from
+            properties (pika.spec.BasicProperties): The properties of the message
+            error (Exception): The error its handler raised
+
+        Returns:
+            tuple: The name of the queue to republish the message to, or None to drop it, and its new properties
+        """
+        attempts = attempts_of(properties) + 1
+
+        properties = copy.copy(properties) if properties is not None else pika.BasicProperties()
+        properties.headers = dict(properties.headers or {})
+        properties.headers[ATTEMPTS_HEADER] = attempts
+        properties.headers[ERROR_HEADER] = repr(error)[:ERROR_LIMIT]
+
+        if attempts >= self.max_attempts:
+            properties.expiration = None
+            return self.dead_letter_queue(queue) if self.dead_letter else None, properties
+
+        delay = self.delay_for(attempts)
+        properties.expiration = str(int(delay * 1000))
+        return self.delay_queue(queue, delay), properties
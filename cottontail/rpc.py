@@ -1,6 +1,51 @@
+import collections
+import multiprocessing
+import threading
+import time
 import uuid
+from multiprocessing.pool import Pool, ThreadPool
 import pika
-from base import CottontailBase, EXCHANGE_FANOUT
+import errors
+from base import CottontailBase, EXCHANGE_FANOUT, CONNECTION_ERRORS
+from serialization import get_codec
+from cache import freeze
+
+EXECUTOR_THREAD = u'thread'
+EXECUTOR_PROCESS = u'process'
+EXECUTOR_TYPES = {EXECUTOR_THREAD, EXECUTOR_PROCESS}
+
+# Seconds between checks for calls completed by an executor pool
+COMPLETION_INTERVAL = 0.005
+
+# The server a process pool worker executes calls on, inherited when the pool forks
+_worker_server = None
+
+
+def _init_worker(server):
+    """
+    Set the server a process pool worker executes calls on. The server, with its connection, reaches
+    the worker by fork, so process executors need a platform that forks, and workers must not use
+    the connection.
+    """
+    global _worker_server
+    _worker_server = server
+
+
+def _execute_in_worker(args, kwargs):
+    return _execute_safely(_worker_server._execute_call, args, kwargs)
+
+
+def _execute_safely(function, args, kwargs):
+    """
+    Run an RPC function in a pool, returning its result and error rather than raising
+
+    Returns:
+        tuple: The response and None on success, or None and the exception on failure
+    """
+    try:
+        return function(*args, **kwargs), None
+    except Exception as e:
+        return None, e
 
 
 class RPCBase(CottontailBase):
@@ -18,18 +63,66 @@ class RPCServer(RPCBase):
     """
     A server class for handling RPC requests.
 
+    By default each call is executed inline on the connection's thread, one at a time.
+    With an executor, calls are dispatched to a pool of threads or processes and up to
+    'workers' calls run at once. Replies and acknowledgements are still sent from the
+    connection's thread as calls complete. A call that raises in the pool is retried if the
+    server has a retry policy, as inline calls are, and otherwise rejected and requeued.
+
+    A process executor forks its workers on the first call to 'listen', so '_execute_call' must
+    take and return picklable values. The workers inherit the server and its connection, which
+    they must not use, so process executors are only supported where multiprocessing forks, as
+    it always does on POSIX systems under Python 2.
+
     Overwritten methods:
-        _create_channel: Alter prefetch_count
+        __init__:
+        _create_channel: Alter prefetch_count and prefetch_size
         _on_message:
+        _dispatch_delivery: Keep the undecoded body of a request for retrying it if its call fails in the pool
+        listen: Start the executor pool
+        close_connection: Stop the executor pool
+        _replay_topology: Resume replying to calls completed by the pool after a reconnection
 
     Additional methods:
         _process_message:
         _execute_call:
+
+    Args:
+        executor (str, optional): Where to execute calls ('thread' or 'process'), defaults to None to execute inline.
+        workers (int, optional): Size of the executor pool, defaults to the number of CPUs.
+        prefetch_count (int, optional): Number of unacknowledged requests the server may hold,
+            defaults to 1, or to 'workers' with an executor.
+        prefetch_size (int, optional): Octets of unacknowledged requests the server may hold, defaults to 0 for no limit.
+        cache (ResultCache, optional): Cache replying to repeated requests without executing them again, keyed by
+            the function's queue and the request's arguments, defaults to None.
+
+    Attributes:
+        cache (ResultCache): Cache of results by function and arguments, or None.
+
+    Raises:
+        CottontailError: If executor is not in the valid EXECUTOR_TYPES.
     """
+    def __init__(self, exchange_name='', executor=None, workers=None, prefetch_count=None, prefetch_size=0, cache=None,
+                 **kw):
+        if executor is not None and executor not in EXECUTOR_TYPES:
+            raise errors.CottontailError("'{}' is not a valid executor type".format(executor), errors.INVALID)
+
+        self.executor = executor
+        self.workers = workers or multiprocessing.cpu_count()
+        self.prefetch_count = prefetch_count or (self.workers if executor else 1)
+        self.prefetch_size = prefetch_size
+        self.cache = cache
+
+        self._pool = None
+        self._completed = collections.deque()
+        self._delivery_body = None
+
+        super(RPCServer, self).__init__(exchange_name, **kw)
+
     def _create_channel(self):
         """
         Instantiate a new channel on the RabbitMQ connection with a specification
-        that the worker not receive more than a single message at a time. This should
+        that the worker not receive more than 'prefetch_count' messages at a time. This should
         ensure fair dispatching of messages with respect to worker load.
 
         Returns:
@@ -37,82 +130,577 @@ class RPCServer(RPCBase):
         """
 
         self._channel = super(RPCServer, self)._create_channel()
-        self._channel.basic_qos(prefetch_count=1)
+        self._channel.basic_qos(prefetch_size=self.prefetch_size, prefetch_count=self.prefetch_count)
+        self._channel_reusable = False
         return self._channel
 
     def _on_message(self, channel, basic_deliver, properties, body):
         args, kwargs = self._process_message(body)
 
-        self.logger.info("Executing RPC function")
+        # Calls whose arguments cannot be hashed are not cached
+        key = self._result_key(args, kwargs) if self.cache is not None else None
+        if key is not None:
+            found, response = self.cache.get(basic_deliver.routing_key, key)
+            if found:
+                self.logger.debug("Replying with the cached result of the RPC function")
+                self._reply(channel, basic_deliver, properties, body, response)
+                return
+
+        if self._pool is not None:
+            self.logger.debug("Dispatching RPC function to the %s pool", self.executor)
+            request = (channel, basic_deliver, properties, body, self._delivery_body, key)
+            self._pool.apply_async(
+                *self._pool_call(args, kwargs),
+                callback=lambda outcome: self._completed.append(request + (outcome,))
+            )
+            return
+
+        self.logger.debug("Executing RPC function")
         response = self._execute_call(*args, **kwargs)
 
-        self.logger.info("Returning response message")
+        self._reply(channel, basic_deliver, properties, body, response, key)
+
+    def _reply(self, channel, basic_deliver, properties, body, response, key=None):
+        """
+        Publish the reply to a request and acknowledge it
+
+        Args:
+            key (object, optional): The cache key of the call's arguments to cache the response under,
+                defaults to None to not cache it.
+        """
+        if key is not None:
+            self.cache.put(basic_deliver.routing_key, key, response)
+
+        self.logger.debug("Returning response message")
+        reply_body, reply_properties = self._prepare_reply(properties, response)
         channel.basic_publish(
             exchange='',
             routing_key=properties.reply_to,
-            properties=pika.BasicProperties(
-                correlation_id=properties.correlation_id
-            ),
-            body=str(response)
+            properties=reply_properties,
+            body=reply_body
         )
 
         super(RPCServer, self)._on_message(channel, basic_deliver, properties, body)
 
+    def _prepare_reply(self, properties, response):
+        """
+        Build the body and properties of the reply to a request, encoded with the request's codec
+        if it has one, else with the server's codec, else as a string, and compressed if the server
+        has a compressor
+
+        Args:
+            properties (pika.Spec.BasicProperties): The properties of the request
+            response (object): The return value of '_execute_call'
+
+        Returns:
+            tuple: The reply body and its pika.BasicProperties
+        """
+        codec = get_codec(properties.content_type) if properties.content_type else None
+        codec = codec or self.codec
+        if codec is None:
+            body, content_type = str(response), None
+        else:
+            body, content_type = codec.encode(response), codec.content_type
+
+        body, content_encoding = self._compress_body(body)
+        return body, pika.BasicProperties(
+            correlation_id=properties.correlation_id,
+            content_type=content_type,
+            content_encoding=content_encoding,
+        )
+
+    def _result_key(self, args, kwargs):
+        """
+        Returns:
+            object: The arguments of a call as a hashable cache key, or None if they cannot be hashed
+        """
+        try:
+            return freeze((args, kwargs))
+        except TypeError:
+            return None
+
+    def _pool_call(self, args, kwargs):
+        """
+        Returns:
+            tuple: The function and arguments to hand to the pool's apply_async
+        """
+        if self.executor == EXECUTOR_PROCESS:
+            return _execute_in_worker, (args, kwargs)
+        return _execute_safely, (self._execute_call, args, kwargs)
+
+    def _dispatch_delivery(self, channel, basic_deliver, properties, body):
+        # Kept for retrying the request if its call fails in the executor pool
+        self._delivery_body = body
+        try:
+            return super(RPCServer, self)._dispatch_delivery(channel, basic_deliver, properties, body)
+        finally:
+            self._delivery_body = None
+
+    def _on_completion_check(self):
+        """
+        Reply to every call the pool has completed, and retry or requeue those that failed. Runs on the
+        connection's thread.
+        """
+        if self._pool is not None:
+            self._connection.add_timeout(COMPLETION_INTERVAL, self._on_completion_check)
+
+        while self._completed:
+            channel, basic_deliver, properties, body, raw_body, key, (response, error) = self._completed.popleft()
+            if channel is not self._channel:
+                # Received before a reconnection, the broker redelivers the request
+                continue
+            if error is not None:
+                self._on_call_failed(basic_deliver, properties, raw_body, error)
+                continue
+            self._reply(channel, basic_deliver, properties, body, response, key)
+
+    def _on_call_failed(self, basic_deliver, properties, body, error):
+        """
+        Retry a request whose call raised in the executor pool or on an event loop, or reject and
+        requeue it, as '_dispatch_delivery' does when an inline call raises. The error is logged rather
+        than raised, which would stop 'listen' from within the connection's timer.
+
+        Args:
+            basic_deliver (pika.Spec.Basic.Deliver): The delivery of the request
+            properties (pika.Spec.BasicProperties): The properties of the request
+            body (str): The request body as it was received
+            error (Exception): The error '_execute_call' raised
+        """
+        self.logger.error("RPC function failed: %r", error)
+        if self.metrics is not None:
+            self.metrics.counter('cottontail_handler_errors_total', exchange=basic_deliver.exchange).inc()
+
+        if self._retry_delivery(basic_deliver, properties, body, error):
+            return
+        if self._coalescing_acks:
+            self._requeue_failed_delivery(basic_deliver.delivery_tag)
+            return
+
+        self._channel.basic_reject(basic_deliver.delivery_tag, requeue=True)
+        if self.metrics is not None:
+            self.metrics.counter('cottontail_requeued_total').inc()
+
+    def listen(self):
+        """
+        Listen continuously for incoming RPC requests, starting the executor pool if one is configured.
+        """
+        if self.executor and self._pool is None:
+            self.logger.info("Starting a %s pool of %s workers", self.executor, self.workers)
+            if self.executor == EXECUTOR_PROCESS:
+                self._pool = Pool(self.workers, initializer=_init_worker, initargs=(self,))
+            else:
+                self._pool = ThreadPool(self.workers)
+            self._connection.add_timeout(COMPLETION_INTERVAL, self._on_completion_check)
+
+        super(RPCServer, self).listen()
+
+    def _replay_topology(self):
+        renamed = super(RPCServer, self)._replay_topology()
+        if self._pool is not None:
+            self._connection.add_timeout(COMPLETION_INTERVAL, self._on_completion_check)
+        return renamed
+
+    def close_connection(self):
+        """
+        Wait for calls still executing in the pool and reply to them, then close the connection to RabbitMQ
+
+        Returns:
+            bool: True if successful
+        """
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            pool.close()
+            pool.join()
+            try:
+                self._on_completion_check()
+            finally:
+                super(RPCServer, self).close_connection()
+            return True
+
+        return super(RPCServer, self).close_connection()
+
     def _process_message(self, body):
+        """
+        Extract the arguments of a request. Requests encoded with a codec by RPCClient carry them
+        as {'args': [...], 'kwargs': {...}}; override this to parse other request formats.
+
+        Args:
+            body (object): The request body, decoded if it has a registered content_type
+
+        Returns:
+            tuple: The positional and keyword arguments for '_execute_call'
+        """
+        if isinstance(body, dict):
+            return body.get('args', []), body.get('kwargs', {})
         return [], {}
 
     def _execute_call(self, *args, **kwargs):
         pass
 
 
+class RPCFuture(object):
+    """
+    The pending reply to an RPC request submitted with RPCClient.call_async.
+
+    Waiting on a future processes events on the client's connection, so replies to
+    every other outstanding call are collected at the same time.
+
+    Args:
+        client (RPCClient): The client that submitted the request
+        correlation_id (str): The correlation id of the request
+        deadline (float, optional): Time after which the call expires, defaults to None for no expiry.
+    """
+    _call_key = None
+
+    def __init__(self, client, correlation_id, deadline=None):
+        self.correlation_id = correlation_id
+        self.deadline = deadline
+
+        self._client = client
+        self._done = False
+        self._response = None
+        self._error = None
+
+    def done(self):
+        """
+        Returns:
+            bool: True if a reply has arrived or the call has failed
+        """
+        return self._done
+
+    def result(self, timeout=None):
+        """
+        Wait for the reply to this request
+
+        Args:
+            timeout (float, optional): Seconds to wait before giving up, defaults to None to wait indefinitely.
+                The call stays outstanding after a wait times out.
+
+        Returns:
+            basestring: The body of the reply
+
+        Raises:
+            CottontailError: If the call expired or the wait timed out
+        """
+        if not self._client.wait([self], timeout):
+            raise errors.CottontailError(
+                "Timed out waiting for the reply to RPC call {}".format(self.correlation_id),
+                errors.TIMEOUT
+            )
+
+        if self._error is not None:
+            raise self._error
+        return self._response
+
+    def cancel(self):
+        """
+        Stop waiting for the reply to this request. A reply that arrives later is discarded.
+
+        Returns:
+            bool: True if the call was still outstanding
+        """
+        if self._done:
+            return False
+
+        self._client._discard(self)
+        self._set_error(errors.CottontailError("RPC call {} was cancelled".format(self.correlation_id), errors.UNKNOWN))
+        return True
+
+    def _set_response(self, response):
+        self._response = response
+        self._done = True
+
+    def _set_error(self, error):
+        self._error = error
+        self._done = True
+
+
 class RPCClient(RPCBase):
     """
     A client class for submitting RPC requests.
 
+    Any number of requests may be outstanding at once. Each one is tracked by its
+    correlation id until its reply arrives, it expires, or it is cancelled.
+
+    A client may be shared between threads: calls are sent, and replies collected, by one
+    thread at a time. With 'single_flight' set, a call identical to one still in flight, with
+    the same function and encoded arguments, sends no request of its own but shares the
+    RPCFuture of the first, so a burst of identical calls costs the servers a single request.
+    Cancelling a shared future cancels it for every caller.
+
     Overridden methods:
         __init__:
+        _open:
         _bind_to_queue:
         _on_message:
         _declare_exchange:
+        close_connection: Delete the callback queue of a pooled connection
+        _replay_topology: Follow the callback queue to its new name, failing the calls whose replies are lost
 
     Additional methods
         call:
+        call_async:
+        call_many:
+        wait:
         _compose_message
 
+    Args:
+        timeout (float, optional): Seconds after which an unanswered call expires, defaults to None for no expiry.
+        cache (ResultCache, optional): Cache answering repeated calls without a request, keyed by the function and
+            the encoded arguments, defaults to None.
+        single_flight (bool, optional): Share one request between identical calls in flight, default is False.
+
     Attributes:
         callback_queue (string): Name of the callback queue
+        timeout (float): Seconds after which an unanswered call expires
+        cache (ResultCache): Cache of replies by function and encoded arguments, or None.
+        single_flight (bool): Whether identical calls in flight share one request.
     """
-    def __init__(self, **kw):
+    callback_queue = None
+
+    def __init__(self, timeout=None, cache=None, single_flight=False, **kw):
+        self._lock = threading.RLock()
+        self.timeout = timeout
+        self.cache = cache
+        self.single_flight = single_flight
+
+        # Outstanding calls by correlation id, and by function and encoded arguments for single-flight calls
+        self._pending = {}
+        self._in_flight = {}
+
         super(RPCClient, self).__init__(**kw)
 
-        # Automatically subscribe to a callback queue
+    def _open(self):
+        """
+        Connect and automatically subscribe to a callback queue
+        """
+        super(RPCClient, self)._open()
         self.callback_queue = self.subscribe(exclusive=True, acknowledge=False)
 
-        # Initialize response
-        self.response = None
-
     def _on_message(self, channel, basic_deliver, properties, body):
-        self.logger.info("Routing RPC request {}:{}".format(basic_deliver.routing_key, body))
-        if self.correlation_id == properties.correlation_id:
-            self.response = body
+        self._log_message('reply', basic_deliver.routing_key, body)
+        future = self._pending.get(properties.correlation_id)
+        if future is None:
+            self.logger.debug("Discarding reply to unknown or expired RPC call %s", properties.correlation_id)
+            return
+
+        self._discard(future)
+        if self.cache is not None:
+            self.cache.put(future._call_key[0], future._call_key[1], body)
+        future._set_response(body)
 
     def call(self, function, *fn_args, **fn_kwargs):
-        self.response = None
-        self.correlation_id = str(uuid.uuid4())
+        """
+        Submit an RPC request and block until its reply arrives
+
+        Args:
+            function (str): The name of the RPC queue serving the function
+
+        Returns:
+            basestring: The body of the reply
+
+        Raises:
+            CottontailError: If the call expires before its reply arrives
+        """
+        if self.metrics is None:
+            return self.call_async(function, *fn_args, **fn_kwargs).result()
+
+        self.metrics.counter('cottontail_rpc_calls_total', function=function).inc()
+        started = time.time()
+        try:
+            return self.call_async(function, *fn_args, **fn_kwargs).result()
+        except Exception:
+            self.metrics.counter('cottontail_rpc_errors_total', function=function).inc()
+            raise
+        finally:
+            self.metrics.histogram('cottontail_rpc_seconds', function=function).observe(time.time() - started)
+
+    def call_async(self, function, *fn_args, **fn_kwargs):
+        """
+        Submit an RPC request without waiting for its reply
+
+        Args:
+            function (str): The name of the RPC queue serving the function
 
-        body = self._compose_message(*fn_args, **fn_kwargs)
+        Returns:
+            RPCFuture: The pending reply, shared with an identical call in flight if 'single_flight' is set
+        """
+        correlation_id = str(uuid.uuid4())
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+        message = self._compose_message(*fn_args, **fn_kwargs)
+        call_key = (function, message)
+
+        if self.cache is not None:
+            found, response = self.cache.get(function, message)
+            if found:
+                future = RPCFuture(self, correlation_id)
+                future._set_response(response)
+                return future
+
+        with self._lock:
+            if self.single_flight and call_key in self._in_flight:
+                self.logger.debug("Joining the RPC call in flight to %s", function)
+                return self._in_flight[call_key]
+            return self._send_call(function, correlation_id, deadline, call_key)
+
+    def _send_call(self, function, correlation_id, deadline, call_key):
+        """
+        Publish a request and track its future. Called holding the client's lock.
 
+        Returns:
+            RPCFuture: The pending reply
+        """
+        self._ensure_open()
+        body, content_encoding = self._compress_body(call_key[1])
+
+        try:
+            self._publish_request(function, correlation_id, body, content_encoding)
+        except CONNECTION_ERRORS:
+            if not self.reconnect:
+                raise
+            self.logger.warn("Lost the connection while calling %s, reconnecting", function)
+            self._reconnect()
+            self._publish_request(function, correlation_id, body, content_encoding)
+
+        # Replies are only processed while waiting, so the call can be tracked once it is sent
+        future = RPCFuture(self, correlation_id, deadline)
+        future._call_key = call_key
+        self._pending[correlation_id] = future
+        if self.single_flight:
+            self._in_flight[call_key] = future
+        return future
+
+    def _publish_request(self, function, correlation_id, body, content_encoding):
         self._channel.basic_publish(
             exchange='',
             routing_key=function,
             properties=pika.BasicProperties(
                 reply_to=self.callback_queue,
-                correlation_id=self.correlation_id,
+                correlation_id=correlation_id,
+                content_type=self.codec.content_type if self.codec else None,
+                content_encoding=content_encoding,
             ),
             body=body)
-        while self.response is None:
-            self._connection.process_data_events()
-        return self.response
+
+    def call_many(self, calls, timeout=None):
+        """
+        Submit many RPC requests at once and wait for all of their replies
+
+        Args:
+            calls (iterable): (function, fn_args) or (function, fn_args, fn_kwargs) tuples to call.
+            timeout (float, optional): Seconds to wait for all replies, defaults to None to wait indefinitely.
+
+        Returns:
+            list: The body of each reply, in the order of 'calls'
+
+        Raises:
+            CottontailError: If any call expires or the wait times out
+        """
+        futures = []
+        for call in calls:
+            function, fn_args, fn_kwargs = (tuple(call) + ({},))[:3]
+            futures.append(self.call_async(function, *fn_args, **fn_kwargs))
+
+        if not self.wait(futures, timeout):
+            for future in futures:
+                if not future.done():
+                    self._expire(future)
+
+        return [future.result() for future in futures]
+
+    def wait(self, futures, timeout=None):
+        """
+        Process connection events until the given calls are done
+
+        Args:
+            futures (list): The RPCFuture objects to wait for
+            timeout (float, optional): Seconds to wait, defaults to None to wait indefinitely.
+
+        Returns:
+            bool: True if every call is done, False if the timeout elapsed first
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+
+        while not all(future.done() for future in futures):
+            if deadline is not None and time.time() >= deadline:
+                return False
+
+            # Whichever thread holds the lock collects the replies of every waiting thread
+            with self._lock:
+                if all(future.done() for future in futures):
+                    break
+                try:
+                    self._connection.process_data_events()
+                except CONNECTION_ERRORS:
+                    if not self.reconnect:
+                        raise
+                    self.logger.warn("Lost the connection while waiting for RPC replies, reconnecting")
+                    self._reconnect()
+                self._expire_calls()
+
+        return True
+
+    def _expire_calls(self):
+        """
+        Fail outstanding calls whose deadline has passed, so their late replies are discarded.
+        """
+        now = time.time()
+        expired = [future for future in self._pending.values()
+                   if future.deadline is not None and future.deadline <= now]
+
+        for future in expired:
+            self._expire(future)
+
+    def _expire(self, future):
+        self._discard(future)
+        future._set_error(errors.CottontailError(
+            "RPC call {} expired without a reply".format(future.correlation_id),
+            errors.TIMEOUT
+        ))
+
+    def _discard(self, future):
+        """
+        Stop tracking a call, so a later identical call sends a new request.
+        """
+        self._pending.pop(future.correlation_id, None)
+        if self._in_flight.get(future._call_key) is future:
+            del self._in_flight[future._call_key]
+
+    def close_connection(self):
+        """
+        Closes the connection to RabbitMQ. A pooled connection outlives this client, so its exclusive
+        callback queue is deleted first.
+
+        Returns:
+            bool: True if successful
+        """
+        if self._connection_pool is not None and self._channel is not None and self._connection.is_open:
+            self.delete_queue(self.callback_queue)
+
+        return super(RPCClient, self).close_connection()
+
+    def _replay_topology(self):
+        renamed = super(RPCClient, self)._replay_topology()
+        self.callback_queue = renamed.get(self.callback_queue, self.callback_queue)
+
+        # Replies to calls made before the reconnection go to the old callback queue, which is gone
+        pending, self._pending = self._pending, {}
+        self._in_flight = {}
+        for future in pending.values():
+            future._set_error(errors.CottontailError(
+                "The connection was lost before RPC call {} was answered".format(future.correlation_id),
+                errors.UNAVAILABLE
+            ))
+        return renamed
 
     def _compose_message(self, *fn_args, **fn_kwargs):
-        return ''
\ No newline at end of file
+        """
+        Build the body of a request. With a codec, the arguments are encoded as
+        {'args': [...], 'kwargs': {...}}; override this to use another request format.
+
+        Returns:
+            str: The request body
+        """
+        if self.codec is not None:
+            return self.codec.encode({'args': list(fn_args), 'kwargs': fn_kwargs})
+        return ''
@@ -0,0 +1,200 @@
+"""
+Codecs for serializing message content, identified by the AMQP 'content_type' property.
+
+Publishers with a codec encode content with it and set 'content_type' on the message.
+Consumers decode any message whose 'content_type' has a registered codec, so structured
+payloads pass through publish/subscribe and RPC without string formatting.
+
+Pickle is not registered by default, as decoding a pickle can execute arbitrary code.
+Register a PickleCodec only where every publisher is trusted::
+
+    serialization.register(serialization.PickleCodec())
+"""
+import json
+import mmap
+import cPickle as pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import errors
+
+
+class Codec(object):
+    """
+    Base class for message codecs.
+
+    Attributes:
+        content_type (str): The MIME type set as the 'content_type' of encoded messages.
+    """
+    content_type = None
+
+    def encode(self, content):
+        """
+        Args:
+            content (object): The content to encode
+
+        Returns:
+            str: The encoded message body
+        """
+        raise NotImplementedError
+
+    def decode(self, body):
+        """
+        Args:
+            body (str): The message body to decode
+
+        Returns:
+            object: The decoded content
+        """
+        raise NotImplementedError
+
+
+class RawCodec(Codec):
+    """
+    Passes byte strings through unchanged, and publishes other binary content with a single copy.
+    """
+    content_type = 'application/octet-stream'
+
+    def encode(self, content):
+        if not is_binary(content):
+            raise TypeError("Raw message content must be a byte string or binary object.")
+        return to_bytes(content)
+
+    def decode(self, body):
+        return body
+
+
+class JSONCodec(Codec):
+    """
+    Encodes content as compact UTF-8 JSON.
+    """
+    content_type = 'application/json'
+
+    def encode(self, content):
+        return json.dumps(content, separators=(',', ':'))
+
+    def decode(self, body):
+        return json.loads(body)
+
+
+class MsgpackCodec(Codec):
+    """
+    Encodes content as MessagePack, a compact binary format. Requires the 'msgpack' package.
+
+    Raises:
+        CottontailError: If the 'msgpack' package is not installed.
+    """
+    content_type = 'application/x-msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise errors.CottontailError("The 'msgpack' package is required for the msgpack codec", errors.INVALID)
+
+    def encode(self, content):
+        return msgpack.packb(content, use_bin_type=True)
+
+    def decode(self, body):
+        return msgpack.unpackb(body, raw=False)
+
+
+class PickleCodec(Codec):
+    """
+    Encodes content as a pickle. Only for deployments where every publisher is trusted.
+    """
+    content_type = 'application/x-python-pickle'
+
+    def encode(self, content):
+        return pickle.dumps(content, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, body):
+        return pickle.loads(body)
+
+
+_codecs = {}
+
+# Objects published as raw bytes besides byte strings: mutable buffers, views and memory maps
+BINARY_TYPES = (str, bytearray, memoryview, buffer, mmap.mmap)
+
+
+def is_binary(content):
+    """
+    Args:
+        content (object): Message content
+
+    Returns:
+        bool: True if the content is a byte string, bytearray, memoryview, buffer, mmap or file-like object
+    """
+    return isinstance(content, BINARY_TYPES) or hasattr(content, 'read')
+
+
+def to_bytes(content):
+    """
+    Get the bytes of binary content as the byte string pika frames message bodies from, copying
+    them once. Byte strings are returned unchanged, and file-like objects and memory maps are
+    read from their current position.
+
+    Args:
+        content (object): A byte string, bytearray, memoryview, buffer, mmap or file-like object
+
+    Returns:
+        str: The content as a byte string
+    """
+    if isinstance(content, str):
+        return content
+    if isinstance(content, memoryview):
+        return content.tobytes()
+    if isinstance(content, (bytearray, buffer)):
+        return str(content)
+    if isinstance(content, mmap.mmap):
+        return content.read(len(content) - content.tell())
+    return content.read()
+
+
+def register(codec):
+    """
+    Register a codec for encoding and decoding messages of its content_type
+
+    Args:
+        codec (Codec): The codec to register, replacing any registered for the same content_type
+    """
+    _codecs[codec.content_type] = codec
+
+
+def get_codec(content_type):
+    """
+    Args:
+        content_type (str): The content_type of a message
+
+    Returns:
+        Codec: The registered codec, or None if there is none for 'content_type'
+    """
+    return _codecs.get(content_type)
+
+
+def resolve_codec(codec):
+    """
+    Args:
+        codec (Codec or str): A codec, or the content_type of a registered codec
+
+    Returns:
+        Codec: The codec to use, or None if 'codec' is None
+
+    Raises:
+        CottontailError: If no codec is registered for the given content_type
+    """
+    if codec is None or isinstance(codec, Codec):
+        return codec
+
+    registered = get_codec(codec)
+    if registered is None:
+        raise errors.CottontailError("No codec is registered for content type '{}'".format(codec), errors.INVALID)
+    return registered
+
+
+register(RawCodec())
+register(JSONCodec())
+if msgpack is not None:
+    register(MsgpackCodec())
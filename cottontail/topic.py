@@ -1,5 +1,108 @@
+import collections
+
 from base import CottontailBase, EXCHANGE_TOPIC
 
+DEFAULT_CACHE_SIZE = 1024
+
+
+class _TopicNode(object):
+    __slots__ = ('children', 'handlers')
+
+    def __init__(self):
+        self.children = {}
+        self.handlers = []
+
+
+class TopicRouter(object):
+    """
+    An index of handlers by topic pattern, matching routing keys the way a topic exchange does:
+    '*' matches exactly one word and '#' matches zero or more words.
+
+    Patterns are compiled into a trie of their words, so a routing key is matched by walking its
+    words rather than by testing every pattern, and the handlers matched for each routing key are
+    cached.
+
+    Args:
+        cache_size (int, optional): Number of routing keys whose matches are cached, defaults to 1024.
+
+    Attributes:
+        patterns (list): The patterns handlers are registered for, in registration order.
+    """
+
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE):
+        self.patterns = []
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._root = _TopicNode()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, pattern, handler):
+        """
+        Register a handler for the routing keys matching a pattern
+
+        Args:
+            pattern (basestring): The topic pattern, e.g. 'orders.*.created' or 'audit.#'
+            handler (callable): The handler to return for matching routing keys
+        """
+        node = self._root
+        for word in pattern.split('.'):
+            node = node.children.setdefault(word, _TopicNode())
+        node.handlers.append((self._count, handler))
+
+        self._count += 1
+        if pattern not in self.patterns:
+            self.patterns.append(pattern)
+        self._cache.clear()
+
+    def match(self, routing_key):
+        """
+        Find the handlers registered for patterns matching a routing key
+
+        Args:
+            routing_key (basestring): The routing key of a message
+
+        Returns:
+            tuple: The matching handlers in registration order, each only once
+        """
+        handlers = self._cache.get(routing_key)
+        if handlers is not None:
+            return handlers
+
+        found = {}
+        self._collect(self._root, routing_key.split('.'), 0, found)
+
+        handlers = []
+        for order in sorted(found):
+            if found[order] not in handlers:
+                handlers.append(found[order])
+        handlers = tuple(handlers)
+
+        if len(self._cache) >= self._cache_size:
+            self._cache.popitem(last=False)
+        self._cache[routing_key] = handlers
+        return handlers
+
+    def _collect(self, node, words, index, found):
+        """
+        Collect the handlers of the patterns below 'node' that match words[index:] into 'found'.
+        """
+        hash_node = node.children.get('#')
+        if hash_node is not None:
+            for start in xrange(index, len(words) + 1):
+                self._collect(hash_node, words, start, found)
+
+        if index == len(words):
+            found.update(node.handlers)
+            return
+
+        for word in (words[index], '*'):
+            child = node.children.get(word)
+            if child is not None:
+                self._collect(child, words, index + 1, found)
+
 
 class TopicBase(CottontailBase):
     """
@@ -24,5 +127,87 @@ class TopicSubscriber(TopicBase):
     """
     A worker class for consuming messages of a particular topic in a pub/sub pattern.
 
+    Handlers registered with the 'handler' decorator are bound to one queue by 'subscribe', and
+    each delivery is dispatched to the handlers whose patterns match its routing key, then
+    acknowledged. Without handlers, deliveries go to '_on_message'::
+
+        subscriber = cottontail.TopicSubscriber('events')
+
+        @subscriber.handler('orders.*.created')
+        def on_order_created(basic_deliver, properties, body):
+            ...
+
+        @subscriber.handler('audit.#')
+        def on_audit(basic_deliver, properties, body):
+            ...
+
+        subscriber.subscribe()
+        subscriber.listen()
+
+    Args:
+        route_cache_size (int, optional): Number of routing keys whose matching handlers are cached, defaults to 1024.
+
+    Attributes:
+        router (TopicRouter): The handlers registered by topic pattern.
     """
-    pass
\ No newline at end of file
+
+    def __init__(self, exchange_name='', route_cache_size=DEFAULT_CACHE_SIZE, **kw):
+        self.router = TopicRouter(route_cache_size)
+        super(TopicSubscriber, self).__init__(exchange_name, **kw)
+
+    def handler(self, pattern):
+        """
+        Decorator registering a function to handle the messages whose routing keys match a pattern.
+        Patterns registered after 'subscribe' are bound to the subscribed queues straight away.
+
+        Args:
+            pattern (basestring): The topic pattern, where '*' matches one word and '#' zero or more
+
+        Returns:
+            callable: The decorator, which returns the function unchanged
+        """
+        def register(function):
+            self.add_handler(pattern, function)
+            return function
+        return register
+
+    def add_handler(self, pattern, function):
+        """
+        Register a function to handle the messages whose routing keys match a pattern
+
+        Args:
+            pattern (basestring): The topic pattern, where '*' matches one word and '#' zero or more
+            function (callable): Called with the basic_deliver, properties and decoded body of each matching message
+        """
+        bound = pattern in self.router.patterns
+        self.router.add(pattern, function)
+        if not bound:
+            for method, params, consumer_tag in self._topology:
+                if method == 'basic_consume':
+                    super(TopicSubscriber, self)._bind_to_queue(params['queue'], pattern)
+
+    def _bind_to_queue(self, queue, topic):
+        """
+        Bind the queue to 'topic', or when no topic is given and handlers are registered,
+        to the pattern of every handler.
+        """
+        if topic is not None or not self.router:
+            return super(TopicSubscriber, self)._bind_to_queue(queue, topic)
+
+        for pattern in self.router.patterns:
+            super(TopicSubscriber, self)._bind_to_queue(queue, pattern)
+
+    def _on_message(self, channel, basic_deliver, properties, body):
+        """
+        Dispatch a delivery to the handlers matching its routing key, then acknowledge it.
+        """
+        if not self.router:
+            return super(TopicSubscriber, self)._on_message(channel, basic_deliver, properties, body)
+
+        handlers = self.router.match(basic_deliver.routing_key)
+        if not handlers:
+            self.logger.debug('No handler for routing key: %s', basic_deliver.routing_key)
+
+        for handler in handlers:
+            handler(basic_deliver, properties, body)
+        self.acknowledge(basic_deliver.delivery_tag)
@@ -1,4 +1,60 @@
 import logging
+import random
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger("cottontail")
\ No newline at end of file
+# The library never configures logging itself; applications attach handlers and levels
+logger = logging.getLogger("cottontail")
+logger.addHandler(logging.NullHandler())
+
+DEFAULT_BODY_LIMIT = 256
+
+
+class TruncatedBody(object):
+    """
+    A message body that is only formatted, and truncated to 'limit' characters, when a log record is emitted.
+
+    Args:
+        body (object): The message body or decoded content
+        limit (int): Maximum number of characters to render
+    """
+    __slots__ = ('body', 'limit')
+
+    def __init__(self, body, limit):
+        self.body = body
+        self.limit = limit
+
+    def __str__(self):
+        text = self.body if isinstance(self.body, basestring) else repr(self.body)
+        if len(text) <= self.limit:
+            return text
+        return "{}... ({} more)".format(text[:self.limit], len(text) - self.limit)
+
+
+def log_message(logger, event, routing_key, body, level=logging.DEBUG, sample_rate=1.0, body_limit=DEFAULT_BODY_LIMIT):
+    """
+    Log a message event on the publish/consume hot path.
+
+    Nothing is formatted unless 'logger' is enabled for 'level' and the event is sampled. The body is
+    truncated to 'body_limit' characters. The event, routing key and body size are also attached to the
+    record as the 'event', 'routing_key' and 'body_size' attributes for structured formatters.
+
+    Args:
+        logger (logging.Logger): The logger to emit to
+        event (str): The name of the event, e.g. 'publish' or 'deliver'
+        routing_key (str): The routing key of the message
+        body (object): The message body or decoded content
+        level (int, optional): The level to log at, defaults to logging.DEBUG.
+        sample_rate (float, optional): Fraction of events to log, defaults to 1.0 for all of them.
+        body_limit (int, optional): Maximum number of body characters to log, defaults to 256.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+
+    body_size = len(body) if isinstance(body, (basestring, bytearray, memoryview)) else None
+    logger.log(
+        level,
+        "%s routing_key=%s body_size=%s body=%s",
+        event, routing_key, body_size, TruncatedBody(body, body_limit),
+        extra={'event': event, 'routing_key': routing_key, 'body_size': body_size}
+    )
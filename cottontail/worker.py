@@ -0,0 +1,359 @@
+"""
+Run a pool of consumer processes on one queue, restarting crashed workers and scaling the pool
+with the depth of the queue::
+
+    cottontail worker queue_test --exchange queue --min-workers 2 --max-workers 8
+
+Each worker is a process forked with its own connection, running a QueueWorker, or the consumer
+class given as --worker-class 'package.module:Class', subscribed to the queue. Every
+--scale-interval seconds the supervisor reads the number of ready messages and consumers with a
+passive queue_declare. It adds workers until each has at most --target-depth of them. RabbitMQ
+does not report how busy consumers are, so a backlog that keeps growing while every worker is
+subscribed is taken to mean they are all busy, and one more is added. It retires one worker per
+interval once the queue has stayed below the target for --scale-down-after intervals.
+"""
+import argparse
+import importlib
+import math
+import multiprocessing
+import signal
+import sys
+import time
+
+import pika
+from pika import exceptions
+
+import utils
+from base import CONNECTION_ERRORS
+from connection import connect
+
+DEFAULT_WORKER_CLASS = 'cottontail.queue:QueueWorker'
+DEFAULT_TARGET_DEPTH = 100
+DEFAULT_SCALE_INTERVAL = 5.0
+DEFAULT_SCALE_DOWN_AFTER = 3
+DEFAULT_RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 30.0
+
+# Workers that run at least this many seconds before exiting reset the restart backoff
+STABLE_UPTIME = 10.0
+POLL_INTERVAL = 0.5
+SHUTDOWN_TIMEOUT = 10.0
+
+
+def load_class(path):
+    """
+    Import a class from its 'package.module:Class' path
+
+    Args:
+        path (str): The module and name of the class, separated by a colon
+
+    Returns:
+        type: The class
+    """
+    module_name, _, class_name = path.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def _run_worker(worker_class, worker_kwargs, queue_name, topic):
+    """
+    Process target consuming 'queue_name' until the process is terminated.
+    """
+    # Leave interrupts to the supervisor, and treat SIGTERM as a request to finish cleanly
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    worker = worker_class(**worker_kwargs)
+    try:
+        worker.subscribe(queue_name, topic=topic)
+        worker.listen()
+    finally:
+        # A lazy worker has no connection until it first connects
+        if worker._connection is not None and worker._connection.is_open:
+            worker.close_connection()
+
+
+class _WorkerProcess(object):
+    __slots__ = ('process', 'started', 'retiring')
+
+    def __init__(self, process):
+        self.process = process
+        self.started = time.time()
+        self.retiring = False
+
+
+class Supervisor(object):
+    """
+    Fork and supervise a pool of consumer processes on one queue.
+
+    Args:
+        queue_name (str): The name of the queue the workers subscribe to
+        worker_class (type, optional): The consumer class each worker runs, defaults to QueueWorker.
+        worker_kwargs (dict, optional): Keyword arguments the consumer class is created with, defaults to None.
+        topic (str, optional): The topic workers subscribe to the queue with, defaults to None.
+        min_workers (int, optional): Fewest workers to run, defaults to 1.
+        max_workers (int, optional): Most workers to run, defaults to the number of CPUs.
+        target_depth (int, optional): Ready messages per worker above which workers are added, defaults to 100.
+        scale_interval (float, optional): Seconds between reads of the queue depth, defaults to 5.
+        scale_down_after (int, optional): Intervals the queue must stay below the target before a worker is
+            retired, defaults to 3.
+        restart_delay (float, optional): Seconds before a crashed worker is restarted, doubling while workers keep
+            crashing, defaults to 1.
+        logger (module, optional): The logging module to use, default is 'utils.logger'.
+
+    Attributes:
+        workers (list): The running worker processes.
+    """
+
+    def __init__(self, queue_name, worker_class=None, worker_kwargs=None, topic=None, min_workers=1,
+                 max_workers=None, target_depth=DEFAULT_TARGET_DEPTH, scale_interval=DEFAULT_SCALE_INTERVAL,
+                 scale_down_after=DEFAULT_SCALE_DOWN_AFTER, restart_delay=DEFAULT_RESTART_DELAY,
+                 logger=utils.logger):
+        if worker_class is None:
+            worker_class = load_class(DEFAULT_WORKER_CLASS)
+
+        self.queue_name = queue_name
+        self.worker_class = worker_class
+        self.worker_kwargs = dict(worker_kwargs or {})
+        self.topic = topic
+        self.min_workers = min_workers
+        self.max_workers = max(max_workers or multiprocessing.cpu_count(), min_workers)
+        self.target_depth = target_depth
+        self.scale_interval = scale_interval
+        self.scale_down_after = scale_down_after
+        self.restart_delay = restart_delay
+        self.logger = logger
+
+        self._workers = []
+        self._size = 0
+        self._running = False
+        self._crashes = 0
+        self._restart_at = 0
+        self._last_depth = None
+        self._calm_intervals = 0
+        self._connection = None
+        self._channel = None
+
+    @property
+    def workers(self):
+        return [worker.process for worker in self._workers if not worker.retiring]
+
+    def run(self):
+        """
+        Start 'min_workers' workers and supervise them until 'stop' is called or SIGTERM is received
+        """
+        self._running = True
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
+        next_check = time.time() + self.scale_interval
+        self._scale_to(self.min_workers)
+        try:
+            while self._running:
+                self._reap()
+                if time.time() >= next_check:
+                    next_check = time.time() + self.scale_interval
+                    self._autoscale()
+                time.sleep(POLL_INTERVAL)
+        finally:
+            self._shutdown()
+
+    def stop(self):
+        """
+        Stop supervising, which terminates the workers
+        """
+        self._running = False
+
+    def queue_depth(self):
+        """
+        Read the number of ready messages in the queue with a passive queue_declare
+
+        Returns:
+            int: The number of ready messages, or None if the queue cannot be read
+        """
+        stats = self.queue_stats()
+        return None if stats is None else stats[0]
+
+    def queue_stats(self):
+        """
+        Read the number of ready messages and of consumers of the queue with a passive queue_declare
+
+        Returns:
+            tuple: The number of ready messages and of consumers, or None if the queue cannot be read
+        """
+        try:
+            if self._connection is None or not self._connection.is_open:
+                self._connection = connect(pika.ConnectionParameters(
+                    host=self.worker_kwargs.get('hostname', 'localhost'),
+                    port=self.worker_kwargs.get('port', 5672),
+                ))
+                self._channel = None
+            if self._channel is None or not self._channel.is_open:
+                self._channel = self._connection.channel()
+            result = self._channel.queue_declare(queue=self.queue_name, passive=True)
+        except exceptions.ChannelClosed as e:
+            # The queue does not exist (yet), and the failed declaration closed the channel
+            self.logger.debug('Could not read the depth of queue %s: %s', self.queue_name, e)
+            self._channel = None
+            return None
+        except CONNECTION_ERRORS as e:
+            self.logger.warn("Could not read the depth of queue '%s': %s", self.queue_name, e)
+            self._connection = None
+            return None
+        return result.method.message_count, result.method.consumer_count
+
+    def _autoscale(self):
+        """
+        Scale the pool to the depth of the queue
+        """
+        stats = self.queue_stats()
+        if stats is None:
+            return
+
+        depth, consumers = stats
+        current = len(self.workers)
+        desired = int(math.ceil(depth / float(self.target_depth)))
+        if depth and self._last_depth is not None and depth > self._last_depth and consumers >= current:
+            # The broker does not report how busy consumers are, so a backlog growing while every worker
+            # consumes is taken to mean they are all busy. Workers still starting up do not consume yet.
+            desired = max(desired, current + 1)
+        desired = min(max(desired, self.min_workers), self.max_workers)
+        self._last_depth = depth
+
+        if desired > current:
+            self._calm_intervals = 0
+            self.logger.info("Queue '%s' holds %s messages, scaling up from %s workers",
+                             self.queue_name, depth, current)
+            self._scale_to(desired)
+        elif desired < current:
+            self._calm_intervals += 1
+            if self._calm_intervals >= self.scale_down_after:
+                self._calm_intervals = 0
+                self.logger.info("Queue '%s' holds %s messages, scaling down from %s workers",
+                                 self.queue_name, depth, current)
+                self._scale_to(current - 1)
+        else:
+            self._calm_intervals = 0
+
+    def _scale_to(self, count):
+        """
+        Start or retire workers until 'count' are running, within 'min_workers' and 'max_workers'
+        """
+        count = self._size = min(max(count, self.min_workers), self.max_workers)
+        while len(self.workers) < count:
+            self._start_worker()
+
+        running = [worker for worker in self._workers if not worker.retiring]
+        for worker in running[count:]:
+            worker.retiring = True
+            self.logger.info('Retiring worker %s', worker.process.pid)
+            worker.process.terminate()
+
+    def _start_worker(self):
+        process = multiprocessing.Process(
+            target=_run_worker,
+            args=(self.worker_class, self.worker_kwargs, self.queue_name, self.topic),
+        )
+        process.start()
+        self._workers.append(_WorkerProcess(process))
+        self.logger.info('Started worker %s', process.pid)
+
+    def _reap(self):
+        """
+        Collect exited workers, restarting crashed ones after a delay that doubles while they keep crashing
+        """
+        for worker in [worker for worker in self._workers if not worker.process.is_alive()]:
+            worker.process.join()
+            self._workers.remove(worker)
+            if worker.retiring:
+                continue
+
+            self.logger.warn('Worker %s exited with code %s', worker.process.pid, worker.process.exitcode)
+            if time.time() - worker.started >= STABLE_UPTIME:
+                self._crashes = 0
+            self._crashes += 1
+            delay = min(self.restart_delay * 2 ** (self._crashes - 1), MAX_RESTART_DELAY)
+            self._restart_at = max(self._restart_at, time.time() + delay)
+
+        if len(self.workers) < self._size and time.time() >= self._restart_at:
+            self._scale_to(self._size)
+
+    def _shutdown(self):
+        """
+        Terminate the workers and wait for them to finish their deliveries and close their connections
+        """
+        for worker in self._workers:
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+        deadline = time.time() + SHUTDOWN_TIMEOUT
+        for worker in self._workers:
+            worker.process.join(max(deadline - time.time(), 0))
+        self._workers = []
+
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+        self._connection = None
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(prog='cottontail worker', description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('queue', help="Name of the queue to consume")
+    parser.add_argument('--exchange', default='', help="Exchange the queue is bound to")
+    parser.add_argument('--topic', default=None, help="Topic the queue is bound with")
+    parser.add_argument('--worker-class', default=DEFAULT_WORKER_CLASS,
+                        help="Consumer class of each worker as 'package.module:Class'")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5672)
+    parser.add_argument('--prefetch', type=int, default=None, help="Prefetch count of each QueueWorker")
+    parser.add_argument('--max-priority', type=int, default=None, help="Declare the queue as a priority queue")
+    parser.add_argument('--message-ttl', type=int, default=None,
+                        help="Milliseconds after which messages on the queue expire")
+    parser.add_argument('--min-workers', type=int, default=1)
+    parser.add_argument('--max-workers', type=int, default=None, help="Defaults to the number of CPUs")
+    parser.add_argument('--target-depth', type=int, default=DEFAULT_TARGET_DEPTH,
+                        help="Ready messages per worker above which workers are added")
+    parser.add_argument('--scale-interval', type=float, default=DEFAULT_SCALE_INTERVAL,
+                        help="Seconds between reads of the queue depth")
+    parser.add_argument('--scale-down-after', type=int, default=DEFAULT_SCALE_DOWN_AFTER,
+                        help="Intervals below the target before a worker is retired")
+    config = parser.parse_args(argv)
+
+    if config.min_workers < 1:
+        parser.error("--min-workers must be at least 1")
+    if config.max_workers is not None and config.max_workers < config.min_workers:
+        parser.error("--max-workers must be at least --min-workers")
+    return config
+
+
+def main(argv=None):
+    """
+    Run a supervised pool of workers from the command line until interrupted
+    """
+    config = _parse_args(argv)
+
+    worker_kwargs = {'exchange_name': config.exchange, 'hostname': config.host, 'port': config.port}
+    if config.prefetch is not None:
+        worker_kwargs['prefetch_count'] = config.prefetch
+    if config.max_priority is not None:
+        worker_kwargs['max_priority'] = config.max_priority
+    if config.message_ttl is not None:
+        worker_kwargs['message_ttl'] = config.message_ttl
+
+    supervisor = Supervisor(
+        config.queue,
+        worker_class=load_class(config.worker_class),
+        worker_kwargs=worker_kwargs,
+        topic=config.topic,
+        min_workers=config.min_workers,
+        max_workers=config.max_workers,
+        target_depth=config.target_depth,
+        scale_interval=config.scale_interval,
+        scale_down_after=config.scale_down_after,
+    )
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -21,6 +21,16 @@ setup(
     install_requires=[
         'pika==0.9.14',
     ],
+    extras_require={
+        'msgpack': ['msgpack>=0.5.2'],
+        'asyncio:python_version < "3.4"': ['trollius>=2.2'],
+    },
+    entry_points={
+        'console_scripts': [
+            'cottontail = cottontail.cli:main',
+            'cottontail-bench = cottontail.bench:main',
+        ],
+    },
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
         'Intended Audience :: Developers',
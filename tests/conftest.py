@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+
+from cottontail import memory
+
+# Seconds a test waits for the broker before failing
+TIMEOUT = 5
+
+
+@pytest.fixture
+def broker():
+    """
+    A MemoryBroker that every client created during the test connects to
+    """
+    broker = memory.MemoryBroker()
+    broker.install()
+    yield broker
+    broker.uninstall()
+
+
+@pytest.fixture
+def pump():
+    """
+    Process the events of the given clients' connections until a condition holds
+    """
+    def pump(condition, *clients):
+        deadline = time.time() + TIMEOUT
+        while not condition():
+            assert time.time() < deadline, "Timed out waiting for the broker"
+            for client in clients:
+                client._connection.process_data_events()
+            if not clients:
+                time.sleep(memory.POLL_INTERVAL)
+    return pump
+
+
+@pytest.fixture
+def listening():
+    """
+    Run a client's 'listen' on a thread, stopping it and closing the client after the test
+    """
+    running = []
+
+    def listen(client):
+        thread = threading.Thread(target=client.listen)
+        thread.daemon = True
+        thread.start()
+        running.append((client, thread))
+        return thread
+
+    yield listen
+
+    for client, thread in running:
+        if client._connection.is_open:
+            client._connection._post(client._channel.stop_consuming)
+        thread.join(TIMEOUT)
+        if client._connection.is_open:
+            client.close_connection()
@@ -0,0 +1,136 @@
+import pytest
+
+from cottontail import aio
+from cottontail.aio import asyncio
+from cottontail.retry import RetryPolicy
+
+
+@pytest.fixture
+def loop(broker):
+    """
+    An event loop on which clients connect to the test's MemoryBroker
+    """
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def _run(loop, future):
+    return loop.run_until_complete(asyncio.wait_for(future, 5, loop=loop))
+
+
+class _Client(aio.AsyncRPCClient):
+
+    def _compose_message(self, value):
+        return value
+
+
+class _Server(aio.AsyncRPCServer):
+    """
+    Fails each call whose body contains 'fail' the first time it is made, raising or failing its future
+    """
+
+    def __init__(self, **kw):
+        self.executed = []
+        super(_Server, self).__init__(**kw)
+
+    def _process_message(self, body):
+        return [body], {}
+
+    def _execute_call(self, value):
+        self.executed.append(value)
+        if 'fail' in value and self.executed.count(value) == 1:
+            if value == 'fail':
+                raise ValueError(value)
+            future = asyncio.Future(loop=self.loop)
+            future.set_exception(ValueError(value))
+            return future
+        return value.upper()
+
+
+def test_chained_futures_are_flattened(loop):
+    inner = aio._create_future(loop)
+    chained = aio._then(loop, aio._resolved(loop, 1), lambda value: inner)
+    inner.set_result(2)
+
+    assert loop.run_until_complete(chained) == 2
+
+
+def test_message_iterators_stop_once_closed(loop):
+    messages = aio.MessageIterator(loop, 'inbox', 'ctag')
+    waiting = messages.get()
+    messages.put('first')
+    messages.put('second')
+    messages.close()
+
+    assert loop.run_until_complete(waiting) == 'first'
+    assert loop.run_until_complete(messages.get()) == 'second'
+    with pytest.raises(StopIteration):
+        loop.run_until_complete(messages.get())
+
+
+def test_subscriber_receives_published_messages(loop):
+    subscriber = _run(loop, aio.AsyncSubscriber('news', loop=loop).connect())
+    messages = _run(loop, subscriber.subscribe('news.inbox'))
+    publisher = _run(loop, aio.AsyncPublisher('news', loop=loop).connect())
+
+    publisher.publish('sports', 'goal')
+    message = _run(loop, messages.get())
+
+    assert message.body == 'sports:goal'
+    assert subscriber.listen() is subscriber._closed
+    _run(loop, subscriber.close_connection())
+    assert subscriber.listen().result() is True
+
+
+@pytest.mark.parametrize('request_body', ['fail', 'fail later'])
+def test_failed_calls_are_requeued(loop, request_body):
+    server = _run(loop, _Server(exchange_name='calls', loop=loop).connect())
+    _run(loop, server.subscribe('calls'))
+    client = _run(loop, _Client(loop=loop).connect())
+
+    assert _run(loop, client.call('calls', request_body)) == request_body.upper()
+    assert server.executed == [request_body, request_body]
+
+
+def test_failed_calls_are_retried_with_the_retry_policy(loop, broker):
+    server = _Server(exchange_name='calls', loop=loop, retry=RetryPolicy(delays=(0.01,), max_attempts=1))
+    _run(loop, server.connect())
+    _run(loop, server.subscribe('calls'))
+    client = _run(loop, _Client(loop=loop).connect())
+
+    client.call('calls', 'fail')
+    _run(loop, _until(loop, lambda: 'calls.dead' in broker._queues and broker.message_count('calls.dead') == 1))
+    assert server.executed == ['fail']
+
+
+def test_publish_many_holds_messages_beyond_the_window(loop, broker):
+    server = _run(loop, aio.AsyncQueueServer(loop=loop).connect())
+    _run(loop, server.declare_queue('jobs'))
+
+    results = _run(loop, server.publish_many([('jobs', str(n)) for n in range(5)], window=2))
+
+    assert results == [True] * 5
+    assert broker.message_count('jobs') == 5
+
+
+def test_topic_handlers_receive_matching_messages(loop):
+    received = []
+    subscriber = aio.AsyncTopicSubscriber('logs', loop=loop)
+    subscriber.add_handler('app.*', lambda deliver, properties, body: received.append(('app', body)))
+    _run(loop, subscriber.connect())
+    _run(loop, subscriber.subscribe('logs.inbox'))
+    subscriber.add_handler('#.error', lambda deliver, properties, body: received.append(('error', body)))
+    publisher = _run(loop, aio.AsyncTopicPublisher('logs', loop=loop).connect())
+
+    for topic in ('app.start', 'db.disk.error', 'db.start'):
+        publisher.publish(topic, 'x')
+    _run(loop, _until(loop, lambda: len(received) == 2))
+
+    assert received == [('app', 'app.start:x'), ('error', 'db.disk.error:x')]
+
+
+@asyncio.coroutine
+def _until(loop, condition):
+    while not condition():
+        yield asyncio.From(asyncio.sleep(0.01, loop=loop))
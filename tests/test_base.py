@@ -0,0 +1,170 @@
+import pytest
+from pika import exceptions
+from pika.adapters import blocking_connection
+
+from cottontail import base, pool, queue
+
+
+class _Transport(object):
+    """
+    Stands in for the BlockingConnection under a real BlockingChannel, recording the frames sent
+    and failing if the channel waits for a reply that will never come
+    """
+    is_open = True
+
+    def __init__(self):
+        self.sent = []
+
+    def send_method(self, channel_number, method, content=None):
+        self.sent.append(method)
+
+    def process_data_events(self):
+        raise AssertionError("Waited for a reply to {}".format(self.sent[-1].NAME))
+
+
+def _blocking_channel(transport):
+    channel = blocking_connection.BlockingChannel.__new__(blocking_connection.BlockingChannel)
+    channel.connection = transport
+    channel.channel_number = 1
+    channel.wait = False
+    channel._received_response = False
+    return channel
+
+
+class _Collecting(object):
+
+    def __init__(self, *args, **kw):
+        self.received = []
+        super(_Collecting, self).__init__(*args, **kw)
+
+    def _on_message(self, channel, basic_deliver, properties, body):
+        self.received.append(body)
+        super(_Collecting, self)._on_message(channel, basic_deliver, properties, body)
+
+
+class _Collector(_Collecting, base.CottontailBase):
+    pass
+
+
+class _CollectingWorker(_Collecting, queue.QueueWorker):
+    pass
+
+
+def test_pipelined_declarations_do_not_wait_on_a_blocking_channel(broker):
+    transport = _Transport()
+    client = base.CottontailBase('pipelined', lazy=True, pipeline_topology=True)
+    client._channel = _blocking_channel(transport)
+
+    client._declare_exchange('pipelined')
+    client.declare_queue('pipelined.jobs')
+    client._bind_to_queue('pipelined.jobs', 'jobs')
+
+    assert [(method.NAME, method.nowait) for method in transport.sent] == [
+        ('Exchange.Declare', True),
+        ('Queue.Declare', True),
+        ('Queue.Bind', True),
+    ]
+    assert client._unconfirmed == [
+        ('exchange_declare', {'exchange': 'pipelined', 'passive': True}),
+        ('queue_declare', {'queue': 'pipelined.jobs', 'passive': True}),
+    ]
+
+
+def test_pipelined_topology_is_flushed_and_delivers(broker, pump):
+    consumer = _Collector('pipelined', pipeline_topology=True)
+    for name in ('a', 'b', 'c'):
+        consumer.subscribe(name, topic=name)
+    consumer.subscribe('a', topic='a')
+    consumer.flush_topology()
+    assert consumer._unconfirmed == []
+    assert len([method for method, _, _ in consumer._topology if method == 'queue_bind']) == 3
+
+    producer = base.CottontailBase('pipelined')
+    for name in ('a', 'b', 'c'):
+        producer.publish(name, 'hello')
+
+    pump(lambda: len(consumer.received) == 3, consumer)
+    assert sorted(consumer.received) == ['a:hello', 'b:hello', 'c:hello']
+
+
+def test_flush_verifies_every_pipelined_declaration(broker):
+    client = base.CottontailBase('pipelined', pipeline_topology=True)
+    client.declare_queue('pipelined.gone')
+    client.declare_queue('pipelined.kept')
+    base.CottontailBase('pipelined').delete_queue('pipelined.gone')
+
+    with pytest.raises(exceptions.ChannelClosed):
+        client.flush_topology()
+
+
+def test_clients_of_a_pooled_connection_share_declarations(broker):
+    connection_pool = pool.ConnectionPool()
+    first = base.CottontailBase('shared', connection_pool=connection_pool)
+    second = base.CottontailBase('shared', connection_pool=connection_pool)
+    assert first._connection is second._connection
+
+    first.declare_queue('shared.jobs', exclusive=True)
+    first._bind_to_queue('shared.jobs', 'jobs')
+    second.declare_queue('shared.jobs', exclusive=True)
+    second._bind_to_queue('shared.jobs', 'jobs')
+
+    assert second._declared is first._declared
+    assert [method for method, _, _ in second._topology] == ['queue_declare', 'queue_bind']
+
+
+def test_reconnect_restores_pipelined_topology(broker, pump):
+    consumer = _Collector('restored', pipeline_topology=True, reconnect=True)
+    consumer.subscribe('restored.jobs', topic='jobs')
+    consumer.flush_topology()
+
+    broker.restart()
+    consumer._reconnect()
+
+    base.CottontailBase('restored').publish('jobs', 'after')
+    pump(lambda: consumer.received, consumer)
+    assert consumer.received == ['jobs:after']
+
+
+def test_coalesced_acks_cover_handled_deliveries(broker, pump):
+    consumer = _CollectingWorker(prefetch_count=10, ack_batch_size=3)
+    consumer.subscribe('coalesced')
+    producer = queue.QueueServer()
+    for index in xrange(4):
+        producer.publish('coalesced', str(index))
+
+    pump(lambda: len(consumer.received) == 4, consumer)
+    assert len(consumer._channel._unacked) == 1
+
+    consumer.flush_acks(final=True)
+    assert len(consumer._channel._unacked) == 0
+
+
+def test_failed_batch_messages_are_requeued(broker, pump):
+    batches = []
+
+    class BatchWorker(queue.QueueWorker):
+        def _on_batch(self, messages):
+            batches.append([message.body for message in messages])
+            if len(batches) == 1:
+                return messages[:1]
+
+    worker = BatchWorker(batch_size=2, batch_interval=10)
+    worker.subscribe('batched')
+    producer = queue.QueueServer()
+    for body in ('first', 'second'):
+        producer.publish('batched', body)
+
+    pump(lambda: len(batches) == 2, worker)
+    assert batches == [['batched:first', 'batched:second'], ['batched:first']]
+    assert broker.message_count('batched') == 0
+    assert len(worker._channel._unacked) == 0
+
+
+def test_lazy_clients_connect_on_first_use(broker):
+    client = base.CottontailBase('events', lazy=True)
+    assert client._connection is None
+    assert 'events' not in broker._exchanges
+
+    client.publish('created', 'order')
+    assert client._connection.is_open
+    assert 'events' in broker._exchanges
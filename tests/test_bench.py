@@ -0,0 +1,18 @@
+import pytest
+
+from cottontail import bench, memory
+
+
+@pytest.fixture
+def default_broker():
+    yield memory.default_broker
+    memory.default_broker.uninstall()
+    memory.default_broker.reset()
+
+
+@pytest.mark.parametrize('ack', [bench.ACK_NONE, bench.ACK_EACH, bench.ACK_BATCH])
+def test_queue_benchmark_delivers_every_message(default_broker, ack):
+    results = bench.run(bench._parse_args(['--broker', 'memory', '--pattern', 'queue', '--ack', ack,
+                                           '--messages', '50']))
+    assert results['published'] == 50
+    assert results['delivered'] == 50
@@ -0,0 +1,44 @@
+import pytest
+
+from cottontail.cache import ResultCache, freeze
+
+
+def test_frozen_values_of_different_types_differ():
+    assert len(set([freeze(True), freeze(1), freeze(1.0)])) == 3
+    assert freeze({'a': 1}) != freeze((('a', 1),))
+    assert freeze([1, 2]) == freeze([1, 2])
+    assert freeze({'b': [1], 'a': set([2, 3])}) == freeze({'a': set([3, 2]), 'b': [1]})
+
+
+def test_unhashable_values_cannot_be_frozen():
+    with pytest.raises(TypeError):
+        freeze([bytearray('body')])
+
+
+def test_results_are_cached_by_type_and_value():
+    cache = ResultCache(ttl=60)
+    cache.put('f', freeze(([1], {})), 'one')
+
+    assert cache.get('f', freeze(([1], {}))) == (True, 'one')
+    assert cache.get('f', freeze(([True], {}))) == (False, None)
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 1}
+
+
+def test_least_recently_used_results_are_evicted():
+    cache = ResultCache(max_size=2, ttl=60)
+    cache.put('f', 1, 'one')
+    cache.put('f', 2, 'two')
+    cache.get('f', 1)
+    cache.put('f', 3, 'three')
+
+    assert cache.get('f', 2) == (False, None)
+    assert cache.get('f', 1) == (True, 'one')
+    assert cache.evictions == 1
+
+
+def test_only_functions_with_a_ttl_are_cached():
+    cache = ResultCache(ttls={'f': 60})
+    cache.put('g', 1, 'one')
+
+    assert cache.get('g', 1) == (False, None)
+    assert len(cache) == 0
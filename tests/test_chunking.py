@@ -0,0 +1,72 @@
+import pika
+import pytest
+from pika import exceptions
+
+from cottontail import base, chunking, queue
+from cottontail.retry import RetryPolicy
+
+
+class _ArtifactWorker(chunking.StreamConsumer, queue.QueueWorker):
+
+    def __init__(self, *args, **kw):
+        self.streams = []
+        self.failures = 0
+        super(_ArtifactWorker, self).__init__(*args, **kw)
+
+    def _on_stream(self, basic_deliver, properties, stream):
+        if self.failures:
+            self.failures -= 1
+            raise ValueError(stream.stream_id)
+        self.streams.append(stream.read())
+
+
+def _publish_chunk(producer, index, body, count=None):
+    headers = chunking.chunk_headers('stream', index, 2, count)
+    producer._channel.basic_publish('', 'artifacts', body, pika.BasicProperties(headers=headers))
+
+
+def test_chunks_are_acked_once_their_message_is_handled(broker, pump):
+    worker = _ArtifactWorker(prefetch_count=0)
+    worker.subscribe('artifacts')
+    producer = base.CottontailBase('producer')
+
+    _publish_chunk(producer, 1, 'cd')
+    _publish_chunk(producer, 0, 'ab')
+    pump(lambda: len(worker._channel._unacked) == 2 and not broker.message_count('artifacts'), worker)
+    assert worker.streams == []
+
+    _publish_chunk(producer, 2, 'e', count=3)
+    pump(lambda: worker.streams, worker)
+    assert worker.streams == ['abcde']
+    assert len(worker._channel._unacked) == 0
+
+
+def test_incomplete_streams_expire_without_further_chunks(broker, pump):
+    worker = _ArtifactWorker(prefetch_count=0)
+    worker.stream_timeout = 0.05
+    worker.subscribe('artifacts')
+    producer = base.CottontailBase('producer')
+
+    _publish_chunk(producer, 0, 'ab')
+    pump(lambda: len(worker._channel._unacked) == 1, worker)
+    pump(lambda: not worker._channel._unacked and not len(worker._reassembler), worker)
+    assert worker.streams == []
+    assert broker.message_count('artifacts') == 0
+
+
+def test_streams_are_redelivered_when_their_handler_fails(broker, pump):
+    worker = _ArtifactWorker(prefetch_count=0, retry=RetryPolicy(delays=(0.01,)))
+    worker.failures = 1
+    worker.subscribe('artifacts')
+
+    queue.QueueServer().publish_stream('artifacts', ['abcde'], chunk_size=2)
+    pump(lambda: worker.streams, worker)
+    assert worker.streams == ['abcde']
+    assert len(worker._channel._unacked) == 0
+
+
+def test_stream_queues_are_consumed_by_one_consumer(broker):
+    _ArtifactWorker(prefetch_count=0).subscribe('artifacts')
+    with pytest.raises(exceptions.ChannelClosed) as error:
+        _ArtifactWorker(prefetch_count=0).subscribe('artifacts')
+    assert error.value.args[0] == 403
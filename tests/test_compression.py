@@ -0,0 +1,32 @@
+from cottontail import compression, pubsub
+
+
+class _Subscriber(pubsub.Subscriber):
+
+    def __init__(self, *args, **kw):
+        self.received = []
+        super(_Subscriber, self).__init__(*args, **kw)
+
+    def _on_message(self, channel, basic_deliver, properties, body):
+        self.received.append((properties.content_encoding, body))
+        self.acknowledge(basic_deliver.delivery_tag)
+
+
+def test_zlib_round_trips_bodies():
+    compressor = compression.ZlibCompressor(level=9)
+    body = 'x' * 4096
+
+    assert len(compressor.compress(body)) < len(body)
+    assert compressor.decompress(compressor.compress(body)) == body
+
+
+def test_only_bodies_reaching_the_threshold_are_compressed(broker, pump):
+    subscriber = _Subscriber('logs')
+    subscriber.subscribe('logs.inbox')
+    publisher = pubsub.Publisher('logs', compression='deflate', compression_threshold=64)
+
+    publisher.publish('line', 'short')
+    publisher.publish('line', 'x' * 4096)
+    pump(lambda: len(subscriber.received) == 2, subscriber)
+
+    assert subscriber.received == [(None, 'line:short'), ('deflate', 'line:' + 'x' * 4096)]
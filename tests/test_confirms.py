@@ -0,0 +1,35 @@
+from pika import frame, spec
+
+from cottontail import base, confirms
+
+
+def _confirm(method):
+    return frame.Method(1, method)
+
+
+def test_confirms_resolve_the_messages_they_cover():
+    batch = confirms.PublishBatch(client=None)
+    batch.results = [None] * 4
+    batch._unconfirmed = {1: 0, 2: 1, 3: 2, 4: 3}
+
+    batch._on_delivery_confirmation(_confirm(spec.Basic.Ack(2, multiple=True)))
+    batch._on_delivery_confirmation(_confirm(spec.Basic.Nack(3)))
+
+    assert batch.results == [True, True, False, None]
+    assert list(batch._unconfirmed) == [4]
+
+
+def test_published_batches_are_confirmed(broker):
+    client = base.CottontailBase()
+    client.declare_queue('jobs')
+
+    assert client.publish_many([('jobs', 'a'), ('jobs', 'b')]) == [True, True]
+    assert broker.message_count('jobs') == 2
+
+
+def test_messages_a_full_queue_refuses_are_nacked(broker):
+    client = base.CottontailBase()
+    client.declare_queue('jobs', arguments={'x-max-length': 1, 'x-overflow': 'reject-publish'})
+
+    assert client.publish_many([('jobs', 'a'), ('jobs', 'b')]) == [True, False]
+    assert broker.message_count('jobs') == 1
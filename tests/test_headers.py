@@ -0,0 +1,52 @@
+import pytest
+
+from cottontail import errors, headers
+
+
+class _Subscriber(headers.HeadersSubscriber):
+
+    def __init__(self, *args, **kw):
+        self.received = []
+        super(_Subscriber, self).__init__(*args, **kw)
+
+    def _on_message(self, channel, basic_deliver, properties, body):
+        self.received.append(body)
+        self.acknowledge(basic_deliver.delivery_tag)
+
+
+@pytest.mark.parametrize('match, expected', [
+    (headers.MATCH_ALL, ['order:eu order']),
+    (headers.MATCH_ANY, ['order:eu order', 'order:eu refund', 'order:us order']),
+])
+def test_bindings_match_all_or_any_headers(broker, pump, match, expected):
+    subscriber = _Subscriber('events')
+    subscriber.subscribe('events.inbox', headers={'region': 'eu', 'kind': 'order'}, match=match)
+
+    publisher = headers.HeadersPublisher('events')
+    for region, kind in (('eu', 'order'), ('eu', 'refund'), ('us', 'order'), ('us', 'refund')):
+        publisher.publish('order', '{} {}'.format(region, kind), headers={'region': region, 'kind': kind})
+    pump(lambda: len(subscriber.received) == len(expected), subscriber)
+
+    assert subscriber.received == expected
+
+
+def test_filtered_deliveries_are_acked_without_being_handled(broker, pump):
+    subscriber = _Subscriber('events', header_filter={'size': lambda size: size > 1024})
+    subscriber.subscribe('events.inbox')
+
+    publisher = headers.HeadersPublisher('events')
+    publisher.publish('upload', 'small', headers={'size': 10})
+    publisher.publish('upload', 'large', headers={'size': 4096})
+    pump(lambda: subscriber.received and not subscriber._channel._unacked, subscriber)
+
+    assert subscriber.received == ['upload:large']
+    assert broker.message_count('events.inbox') == 0
+
+
+def test_compiled_filters_test_each_header():
+    accept = headers.compile_filter({'region': ('eu', 'us'), 'kind': 'order'}, match=headers.MATCH_ANY)
+
+    assert [accept({'region': 'eu'}), accept({'kind': 'order'}), accept({'region': 'ap'}), accept({})] == \
+        [True, True, False, False]
+    with pytest.raises(errors.CottontailError):
+        headers.compile_filter({}, match='most')
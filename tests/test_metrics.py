@@ -0,0 +1,49 @@
+import urllib2
+
+import pytest
+
+from cottontail import metrics, queue
+
+
+@pytest.fixture
+def registry():
+    yield metrics.enable()
+    metrics.disable()
+
+
+def test_published_messages_are_exposed(broker, registry):
+    server = queue.QueueServer('jobs')
+    server.publish('a', 'b')
+    with server.batch() as batch:
+        batch.publish('a', 'bc')
+
+    exposition = registry.exposition()
+    assert '# TYPE cottontail_published_total counter' in exposition
+    assert 'cottontail_published_total{exchange="jobs"} 2' in exposition
+    assert 'cottontail_published_bytes_total{exchange="jobs"} 7' in exposition
+
+
+def test_metrics_are_served_over_http(registry):
+    registry.counter('cottontail_acked_total').inc(3)
+    registry.histogram('cottontail_handler_seconds', exchange='jobs').observe(0.25)
+
+    server = metrics.MetricsServer(registry, port=0).start()
+    try:
+        response = urllib2.urlopen('http://127.0.0.1:{}/metrics'.format(server.port))
+        body = response.read()
+    finally:
+        server.stop()
+
+    assert response.info()['Content-Type'] == metrics.EXPOSITION_CONTENT_TYPE
+    assert 'cottontail_acked_total 3' in body
+    assert 'cottontail_handler_seconds_count{exchange="jobs"} 1' in body
+
+
+def test_histogram_quantiles_are_within_the_bucket_precision():
+    histogram = metrics.MetricsRegistry().histogram('cottontail_handler_seconds')
+    for millisecond in range(1, 1001):
+        histogram.observe(millisecond / 1000.0)
+
+    assert histogram.count == 1000
+    assert histogram.quantile(0.5) == pytest.approx(0.5, rel=0.04)
+    assert histogram.quantile(0.99) == pytest.approx(0.99, rel=0.04)
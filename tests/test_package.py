@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+
+import cottontail
+
+_IMPORTED = """
+import sys
+import cottontail
+# Python 2 records the implicit relative imports it tried as None
+print(sorted(name for name, module in sys.modules.items()
+             if module is not None and (name == 'pika' or name.startswith('cottontail.'))))
+cottontail.QueueWorker
+print('pika' in sys.modules and 'cottontail.queue' in sys.modules)
+"""
+
+
+def test_import_loads_submodules_on_first_use():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(cottontail.__file__)))
+    output = subprocess.check_output([sys.executable, '-c', _IMPORTED], cwd=root)
+
+    assert output.split('\n')[:2] == ['[]', 'True']
+
+
+def test_public_names_are_listed():
+    assert 'QueueWorker' in dir(cottontail)
+    assert cottontail.QueueWorker is cottontail.queue.QueueWorker
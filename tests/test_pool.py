@@ -0,0 +1,91 @@
+import socket
+import threading
+
+import pika
+
+from cottontail import connection as connection_module
+from cottontail import pool
+
+
+class _SocketConnection(object):
+    """
+    A connection over one end of a socket pair, which is open until its peer hangs up unnoticed
+    """
+    is_open = True
+
+    def __init__(self):
+        self.socket, self.peer = socket.socketpair()
+
+    def channel(self):
+        return _SocketChannel()
+
+    def close(self):
+        self.socket.close()
+
+
+class _SocketChannel(object):
+    is_open = True
+
+
+def test_lease_does_not_process_events(broker):
+    connections = pool.ConnectionPool()
+    connection, channel = connections.lease(pika.ConnectionParameters())
+    called = []
+    connection.add_timeout(0, lambda: called.append(True))
+    connections.release(connection, channel, reusable=True)
+
+    assert connections.lease(pika.ConnectionParameters()) == (connection, channel)
+    assert called == []
+    connections.close()
+
+
+def test_closed_connections_are_replaced(broker):
+    connections = pool.ConnectionPool()
+    connection, channel = connections.lease(pika.ConnectionParameters())
+    connections.release(connection, channel, reusable=True)
+
+    broker.restart()
+    replacement, channel = connections.lease(pika.ConnectionParameters())
+    assert replacement is not connection
+    assert replacement.is_open and channel.is_open
+    connections.close()
+
+
+def test_connections_the_broker_dropped_are_replaced_without_processing_events():
+    opened = []
+    connection_module.set_connection_factory(lambda parameters: opened.append(_SocketConnection()) or opened[-1])
+    try:
+        connections = pool.ConnectionPool(health_check_interval=0)
+        connection, channel = connections.lease(pika.ConnectionParameters())
+        connections.release(connection, channel, reusable=True)
+        assert connections.lease(pika.ConnectionParameters())[0] is connection
+
+        connection.peer.close()
+        assert connections.lease(pika.ConnectionParameters())[0] is not connection
+        assert len(opened) == 2
+    finally:
+        connection_module.set_connection_factory(None)
+
+
+def test_connections_of_exited_threads_are_closed(broker):
+    connections = pool.ConnectionPool()
+    leased = []
+    thread = threading.Thread(target=lambda: leased.append(connections.lease(pika.ConnectionParameters())))
+    thread.start()
+    thread.join()
+
+    connection, _ = connections.lease(pika.ConnectionParameters())
+    assert connection is not leased[0][0]
+    assert not leased[0][0].is_open
+    connections.close()
+
+
+def test_idle_channels_count_against_the_channel_limit(broker):
+    connections = pool.ConnectionPool(max_channels=2)
+    first, channel = connections.lease(pika.ConnectionParameters())
+    connections.release(first, channel, reusable=True)
+
+    leased = [connections.lease(pika.ConnectionParameters()) for _ in range(3)]
+    assert [connection for connection, _ in leased[:2]] == [first, first]
+    assert leased[2][0] is not first
+    connections.close()
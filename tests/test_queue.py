@@ -0,0 +1,32 @@
+from cottontail import queue
+
+
+def test_worker_takes_the_exchange_name_first(broker):
+    worker = queue.QueueWorker('work', prefetch_count=5)
+
+    assert worker.exchange_name == 'work'
+    assert broker._exchanges['work'].exchange_type == 'fanout'
+    assert worker.prefetch_count == 5
+    assert worker._channel._prefetch_count == 5
+
+
+def test_priority_queue_delivers_urgent_jobs_first(broker):
+    server = queue.QueueServer(priority=1)
+    server.declare_queue('jobs', max_priority=10)
+    for body, priority in (('low', None), ('urgent', 9), ('normal', 5)):
+        server.publish('jobs', body, priority=priority)
+
+    bodies = [server._channel.basic_get('jobs', no_ack=True)[2] for _ in range(3)]
+    assert bodies == ['jobs:urgent', 'jobs:normal', 'jobs:low']
+
+
+def test_batches_use_the_default_priority_and_expiration(broker):
+    server = queue.QueueServer(priority=7, expiration=60000)
+    server.declare_queue('jobs', max_priority=10)
+    with server.batch() as batch:
+        batch.publish('jobs', 'resize')
+        batch.publish('jobs', 'urgent', priority=9)
+
+    assert batch.results == [True, True]
+    properties = [message.properties for message in broker._queues['jobs'].messages]
+    assert [(p.priority, p.expiration) for p in properties] == [(9, '60000'), (7, '60000')]
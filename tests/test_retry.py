@@ -0,0 +1,19 @@
+from cottontail import queue, retry
+
+
+class _FailingWorker(queue.QueueWorker):
+
+    def _on_message(self, channel, basic_deliver, properties, body):
+        raise ValueError(body)
+
+
+def test_poison_messages_are_parked_after_max_attempts(broker, pump):
+    worker = _FailingWorker(retry=retry.RetryPolicy(delays=(0.01,), max_attempts=3))
+    worker.subscribe('jobs')
+    queue.QueueServer().publish('jobs', 'poison')
+
+    pump(lambda: broker.message_count('jobs.dead') == 1, worker)
+    _, properties, body = worker._channel.basic_get('jobs.dead')
+    assert body == 'jobs:poison'
+    assert properties.headers[retry.ATTEMPTS_HEADER] == 3
+    assert broker.message_count('jobs') == 0
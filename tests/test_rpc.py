@@ -0,0 +1,123 @@
+import threading
+
+from cottontail import queue, rpc
+from cottontail.cache import ResultCache
+from cottontail.retry import RetryPolicy
+
+
+class _Client(rpc.RPCClient):
+
+    def _compose_message(self, value):
+        return value
+
+
+class _Server(rpc.RPCServer):
+
+    def __init__(self, **kw):
+        self.decoded = 0
+        self.executed = []
+        super(_Server, self).__init__(**kw)
+
+    def _process_message(self, body):
+        self.decoded += 1
+        return [body], {}
+
+    def _execute_call(self, value):
+        self.executed.append(value)
+        return value.upper()
+
+
+class _UnhashableServer(_Server):
+
+    def _process_message(self, body):
+        return [bytearray(body)], {}
+
+    def _execute_call(self, value):
+        return str(value)
+
+
+class _FailingServer(_Server):
+    """
+    Fails each call whose body contains 'fail' the first 'failures' times it is made
+    """
+    failures = 1
+
+    def _execute_call(self, value):
+        self.executed.append(value)
+        if 'fail' in value and self.executed.count(value) <= self.failures:
+            raise ValueError(value)
+        return value.upper()
+
+
+def test_cached_reply_is_not_computed_again(broker, listening):
+    server = _Server(cache=ResultCache(ttl=60))
+    server.subscribe('upper')
+    listening(server)
+
+    client = _Client(timeout=5)
+    assert [client.call('upper', 'a'), client.call('upper', 'a')] == ['A', 'A']
+    assert server.executed == ['a']
+    assert server.decoded == 2
+
+
+def test_calls_with_unhashable_arguments_are_not_cached(broker, listening):
+    cache = ResultCache(ttl=60)
+    server = _UnhashableServer(cache=cache)
+    server.subscribe('echo')
+    listening(server)
+
+    client = _Client(timeout=5)
+    assert [client.call('echo', 'first'), client.call('echo', 'second')] == ['first', 'second']
+    assert len(cache) == 0
+
+
+def test_identical_calls_in_flight_share_one_request(broker, listening):
+    server = _Server()
+    server.subscribe('upper')
+
+    client = _Client(timeout=5, single_flight=True)
+    first, second = client.call_async('upper', 'a'), client.call_async('upper', 'a')
+    assert first is second
+
+    listening(server)
+    assert first.result() == 'A'
+    assert server.executed == ['a']
+
+
+def test_pooled_failures_are_retried_and_parked(broker, listening, pump):
+    server = _FailingServer(executor=rpc.EXECUTOR_THREAD, workers=2,
+                            retry=RetryPolicy(delays=(0.01,), max_attempts=2))
+    server.failures = 2
+    server.subscribe('calls')
+    thread = listening(server)
+
+    queue.QueueServer().publish('calls', 'fail')
+    pump(lambda: 'calls.dead' in broker._queues and broker.message_count('calls.dead') == 1)
+
+    assert thread.is_alive()
+    assert _Client(timeout=5).call('calls', 'ok') == 'OK'
+
+
+def test_pooled_failure_is_requeued_after_later_calls_complete(broker, listening):
+    class SlowFailingServer(_FailingServer):
+        def _execute_call(self, value):
+            if value == 'fail' and not self.executed:
+                threading.Event().wait(0.2)
+            return super(SlowFailingServer, self)._execute_call(value)
+
+    server = SlowFailingServer(executor=rpc.EXECUTOR_THREAD, workers=2, ack_batch_size=5, ack_interval=10000)
+    server.subscribe('calls')
+    thread = listening(server)
+
+    client = _Client(timeout=5)
+    failing = client.call_async('calls', 'fail')
+    assert client.call('calls', 'ok') == 'OK'
+    assert failing.result() == 'FAIL'
+    assert thread.is_alive()
+
+
+def test_server_takes_the_exchange_name_first(broker):
+    server = rpc.RPCServer('calls', executor=rpc.EXECUTOR_THREAD, workers=3)
+
+    assert server.exchange_name == 'calls'
+    assert server._channel._prefetch_count == 3
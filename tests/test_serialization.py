@@ -0,0 +1,50 @@
+import pytest
+
+from cottontail import errors, pubsub, serialization
+
+
+class _Subscriber(pubsub.Subscriber):
+
+    def __init__(self, *args, **kw):
+        self.received = []
+        super(_Subscriber, self).__init__(*args, **kw)
+
+    def _on_message(self, channel, basic_deliver, properties, body):
+        self.received.append(body)
+        self.acknowledge(basic_deliver.delivery_tag)
+
+
+@pytest.mark.parametrize('codec, content', [
+    (serialization.JSONCodec(), {'id': 1, 'tags': ['a', 'b']}),
+    (serialization.PickleCodec(), {'id': 1, 'when': (2014, 5)}),
+    (serialization.RawCodec(), '\x00\xff'),
+])
+def test_codecs_round_trip_content(codec, content):
+    assert codec.decode(codec.encode(content)) == content
+
+
+def test_unknown_content_types_cannot_be_resolved():
+    with pytest.raises(errors.CottontailError):
+        serialization.resolve_codec('application/x-unknown')
+
+
+def test_subscribers_decode_by_content_type(broker, pump):
+    subscriber = _Subscriber('events')
+    subscriber.subscribe('events.inbox')
+
+    pubsub.Publisher('events', codec='application/json').publish('order', {'id': 1})
+    pubsub.Publisher('events').publish('order', 'created')
+    pump(lambda: len(subscriber.received) == 2, subscriber)
+
+    assert subscriber.received == [{u'id': 1}, 'order:created']
+
+
+def test_binary_bodies_are_delivered_unchanged_as_memoryviews(broker, pump):
+    subscriber = _Subscriber('blobs', body_view=True)
+    subscriber.subscribe('blobs.inbox')
+
+    pubsub.Publisher('blobs').publish('image', bytearray('\x89PNG'))
+    pump(lambda: subscriber.received, subscriber)
+
+    assert isinstance(subscriber.received[0], memoryview)
+    assert subscriber.received[0].tobytes() == '\x89PNG'
@@ -0,0 +1,47 @@
+import pytest
+
+from cottontail import topic
+
+
+@pytest.mark.parametrize('pattern, matching, other', [
+    ('orders.*.created', ['orders.eu.created'], ['orders.created', 'orders.eu.west.created']),
+    ('audit.#', ['audit', 'audit.login', 'audit.login.failed'], ['auditing', 'user.audit']),
+    ('#.error', ['error', 'db.error', 'db.disk.error'], ['error.db']),
+    ('*.#.done', ['job.done', 'job.a.b.done'], ['done']),
+])
+def test_patterns_match_as_a_topic_exchange_does(pattern, matching, other):
+    router = topic.TopicRouter()
+    router.add(pattern, pattern)
+
+    assert [router.match(key) for key in matching] == [(pattern,)] * len(matching)
+    assert [router.match(key) for key in other] == [()] * len(other)
+
+
+def test_handlers_are_matched_once_in_registration_order():
+    router = topic.TopicRouter(cache_size=1)
+    first, second = object(), object()
+    router.add('a.#', first)
+    router.add('*.b', second)
+    router.add('#', first)
+
+    assert router.match('a.b') == (first, second)
+    assert router.match('c') == (first,)
+    assert router.match('a.b') == (first, second)
+    assert len(router._cache) == 1
+
+
+def test_handlers_receive_matching_messages(broker, pump):
+    received = []
+    subscriber = topic.TopicSubscriber('logs')
+    subscriber.add_handler('app.*', lambda deliver, properties, body: received.append(('app', body)))
+    subscriber.subscribe('logs.inbox')
+    subscriber.add_handler('#.error', lambda deliver, properties, body: received.append(('error', body)))
+
+    publisher = topic.TopicPublisher('logs')
+    for key in ('app.start', 'db.disk.error', 'db.start', 'app.error'):
+        publisher.publish(key, 'x')
+    pump(lambda: len(received) == 4, subscriber)
+
+    assert received == [('app', 'app.start:x'), ('error', 'db.disk.error:x'),
+                        ('app', 'app.error:x'), ('error', 'app.error:x')]
+    assert broker.message_count('logs.inbox') == 0
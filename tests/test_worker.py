@@ -0,0 +1,42 @@
+import pytest
+
+from cottontail import queue, worker
+
+
+class _BrokenWorker(queue.QueueWorker):
+
+    def subscribe(self, *args, **kw):
+        raise ValueError('subscribe failed')
+
+
+def test_errors_of_a_worker_that_never_connected_are_raised(broker, monkeypatch):
+    monkeypatch.setattr(worker.signal, 'signal', lambda signum, handler: None)
+    with pytest.raises(ValueError) as error:
+        worker._run_worker(_BrokenWorker, {'lazy': True}, 'jobs', None)
+    assert str(error.value) == 'subscribe failed'
+
+
+def _supervisor(workers):
+    supervisor = worker.Supervisor('jobs', min_workers=1, max_workers=4)
+    supervisor._workers = [worker._WorkerProcess(None) for _ in range(workers)]
+    supervisor.scaled = []
+    supervisor._scale_to = supervisor.scaled.append
+    return supervisor
+
+
+def test_growing_backlog_adds_a_worker_while_every_worker_consumes(broker):
+    consumer = queue.QueueWorker()
+    consumer.subscribe('jobs')
+    for body in ('a', 'b', 'c'):
+        queue.QueueServer().publish('jobs', body)
+
+    supervisor = _supervisor(1)
+    supervisor._last_depth = 1
+    supervisor._autoscale()
+    assert supervisor.queue_stats() == (2, 1)
+    assert supervisor.scaled == [2]
+
+    starting = _supervisor(2)
+    starting._last_depth = 1
+    starting._autoscale()
+    assert starting.scaled == []